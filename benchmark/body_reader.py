@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Compare memory allocations of response body readers.
+
+The legacy reader collects chunks into list, joins them and slices
+the result. The current reader of `Urllib3Transport` fills
+preallocated buffer with `readinto` when "Content-Length" is known,
+the buffer grows as data arrives and is returned without extra copy.
+
+Usage: python benchmark/body_reader.py [size_in_mb ...]
+"""
+import io
+import sys
+import time
+import tracemalloc
+from http.client import HTTPResponse as BaseHTTPResponse
+
+from urllib3 import HTTPResponse
+
+from grab.transport import Request, Urllib3Transport
+
+
+class FakeSocket:
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, *args, **kwargs):  # pylint: disable=unused-argument
+        return io.BufferedReader(io.BytesIO(self.data))
+
+
+def build_response(body):
+    raw = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+    orig = BaseHTTPResponse(FakeSocket(raw))
+    orig.begin()
+    return HTTPResponse(
+        body=orig,
+        headers=dict(orig.getheaders()),
+        status=orig.status,
+        original_response=orig,
+        preload_content=False,
+    )
+
+
+def build_transport(body, maxsize):
+    transport = Urllib3Transport()
+    req = Request()
+    req.config_body_maxsize = maxsize
+    req.op_started = time.time()
+    transport._request = req  # pylint: disable=protected-access
+    transport._response = build_response(body)  # pylint: disable=protected-access
+    return transport
+
+
+def legacy_read(transport):
+    # pylint: disable=protected-access
+    maxsize = transport._request.config_body_maxsize
+    chunks = []
+    chunk_size = min(10000, maxsize + 1) if maxsize else 10000
+    bytes_read = 0
+    while True:
+        chunk = transport._response.read(chunk_size)
+        if chunk:
+            bytes_read += len(chunk)
+            chunks.append(chunk)
+            if maxsize and bytes_read > maxsize:
+                break
+        else:
+            break
+    data = b"".join(chunks)
+    if maxsize:
+        data = data[:maxsize]
+    return data
+
+
+def current_read(transport):
+    return transport.read_body()
+
+
+def measure(func, body, maxsize):
+    transport = build_transport(body, maxsize)
+    tracemalloc.start()
+    started = time.perf_counter()
+    data = func(transport)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(data) == min(len(body), maxsize or len(body))
+    return peak, elapsed
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1, 8, 32]
+    print(
+        "%8s %10s %14s %14s %10s %10s"
+        % ("size", "maxsize", "legacy peak", "current peak", "legacy", "current")
+    )
+    for size_mb in sizes:
+        body = b"x" * (size_mb * 1024 * 1024)
+        for maxsize in (None, len(body) // 2):
+            legacy_peak, legacy_time = measure(legacy_read, body, maxsize)
+            current_peak, current_time = measure(current_read, body, maxsize)
+            print(
+                "%6dMB %10s %12.1fMB %12.1fMB %9.1fms %9.1fms"
+                % (
+                    size_mb,
+                    maxsize or "-",
+                    legacy_peak / 1024 / 1024,
+                    current_peak / 1024 / 1024,
+                    legacy_time * 1000,
+                    current_time * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Measure performance of delayed tasks in the memory task queue.
+
+The legacy queue scans and rebuilds the whole list of delayed tasks on
+each `get()` call. The current queue keeps delayed tasks in a heap
+ordered by schedule time.
+
+Usage: python benchmark/memory_queue.py [number_of_tasks]
+"""
+import sys
+import time
+from datetime import datetime, timedelta
+from queue import Empty, PriorityQueue
+from random import randint
+
+from grab.spider.queue_backend.memory import QueueBackend
+from grab.spider.task import Task
+
+# The legacy queue is too slow to process large number of tasks
+LEGACY_TASK_LIMIT = 20000
+SIZE_CALLS = 1000
+
+
+class LegacyQueueBackend(QueueBackend):
+    def __init__(self, spider_name, **kwargs):
+        super().__init__(spider_name, **kwargs)
+        self.queue_object = PriorityQueue()
+        self.schedule_list = []
+
+    def put(self, task, priority, schedule_time=None):
+        if schedule_time is None:
+            self.queue_object.put((priority, task))
+        else:
+            self.schedule_list.append((schedule_time, task))
+
+    def get(self):
+        now = datetime.utcnow()
+
+        removed_indexes = []
+        index = 0
+        for schedule_time, task in self.schedule_list:
+            if schedule_time <= now:
+                self.put(task, 1)
+                removed_indexes.append(index)
+            index += 1
+
+        self.schedule_list = [
+            x for idx, x in enumerate(self.schedule_list) if idx not in removed_indexes
+        ]
+
+        _, task = self.queue_object.get(block=False)
+        return task
+
+
+def build_tasks(number):
+    task = Task("page", url="http://example.com/")
+    now = datetime.utcnow()
+    # Half of tasks are ready to be processed, other half is delayed
+    return [
+        (task, now + timedelta(seconds=randint(-3600, 3600))) for _ in range(number)
+    ]
+
+
+def run_benchmark(queue_cls, tasks):
+    queue = queue_cls("bench")
+    started = time.time()
+    for task, schedule_time in tasks:
+        queue.put(task, 10, schedule_time=schedule_time)
+    put_time = time.time() - started
+
+    started = time.time()
+    for _ in range(SIZE_CALLS):
+        queue.size()
+    size_time = time.time() - started
+
+    count = 0
+    max_get_time = 0
+    started = time.time()
+    while True:
+        get_started = time.time()
+        try:
+            queue.get()
+        except Empty:
+            break
+        max_get_time = max(max_get_time, time.time() - get_started)
+        count += 1
+    total_get_time = time.time() - started
+    print(
+        "%s: put %d tasks: %.3fs, %d size() calls: %.3fs,"
+        " get %d ready tasks: %.3fs, slowest get() call: %.3fs"
+        % (
+            queue_cls.__name__,
+            len(tasks),
+            put_time,
+            SIZE_CALLS,
+            size_time,
+            count,
+            total_get_time,
+            max_get_time,
+        )
+    )
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tasks = build_tasks(number)
+    run_benchmark(QueueBackend, tasks)
+    if number <= LEGACY_TASK_LIMIT:
+        run_benchmark(LegacyQueueBackend, tasks)
+    else:
+        print(
+            "LegacyQueueBackend: skipped, run with %d tasks to compare"
+            % LEGACY_TASK_LIMIT
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Measure throughput of the SQLite task queue.
+
+Each task taken from the queue is acknowledged.
+
+Usage: python benchmark/sqlite_queue.py [number_of_tasks] [database_path]
+"""
+import os
+import sys
+import tempfile
+import time
+from queue import Empty
+
+from grab.spider.queue_backend.sqlite import QueueBackend
+from grab.spider.task import Task
+
+
+def run_benchmark(path, number):
+    queue = QueueBackend("bench", path=path)
+    queue.clear()
+    task = Task("page", url="http://example.com/", priority=10)
+
+    started = time.time()
+    for idx in range(number):
+        queue.put(task, idx % 100)
+    put_time = time.time() - started
+
+    count = 0
+    started = time.time()
+    while True:
+        try:
+            queue.ack(queue.get().lease)
+        except Empty:
+            break
+        count += 1
+    get_time = time.time() - started
+    queue.close()
+    print(
+        "put %d tasks: %.3fs (%d ops/s), get %d tasks: %.3fs (%d ops/s)"
+        % (number, put_time, number / put_time, count, get_time, count / get_time)
+    )
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    if len(sys.argv) > 2:
+        run_benchmark(sys.argv[2], number)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run_benchmark(os.path.join(tmp_dir, "queue.sqlite"), number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Compare task codecs of queue backends with pickling of the whole task.
+
+For each kind of task the script prints encode and decode time per task
+and the payload size. Codecs which require msgpack or zstandard packages
+are skipped if these packages are not installed.
+
+Usage: python benchmark/task_codec.py [number_of_tasks]
+"""
+import pickle
+import sys
+import time
+from importlib.util import find_spec
+
+from grab import Grab
+from grab.spider.queue_backend.codec import TaskCodec
+from grab.spider.task import Task
+
+# Options of TaskCodec: (serializer, compression)
+CODECS = [
+    ("json", None),
+    ("json", "zlib"),
+    ("json", "zstd"),
+    ("msgpack", None),
+    ("msgpack", "zlib"),
+    ("msgpack", "zstd"),
+]
+REQUIRED_MODULES = {"msgpack": "msgpack", "zstd": "zstandard"}
+
+
+class PickleCodec:
+    def encode(self, task):
+        return pickle.dumps(task, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+def build_task(kind):
+    url = "http://example.com/catalog/page?id=1"
+    if kind == "url":
+        return Task("page", url=url)
+    grab = Grab(url=url, timeout=10, headers={"Referer": "http://example.com/"})
+    for num in range(10):
+        grab.cookies.set("cookie%d" % num, "value%d" % num, domain="example.com")
+    return Task("page", grab=grab, category="books")
+
+
+def is_available(options):
+    return all(
+        find_spec(REQUIRED_MODULES[x]) is not None
+        for x in options
+        if x in REQUIRED_MODULES
+    )
+
+
+def run_benchmark(name, codec, task, number):
+    started = time.time()
+    for _ in range(number):
+        data = codec.encode(task)
+    encode_time = time.time() - started
+    started = time.time()
+    for _ in range(number):
+        codec.decode(data)
+    decode_time = time.time() - started
+    print(
+        "  %-14s encode: %5.1fus, decode: %5.1fus, size: %d bytes"
+        % (
+            name,
+            encode_time / number * 1000000,
+            decode_time / number * 1000000,
+            len(data),
+        )
+    )
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for kind in ("url", "grab"):
+        print("%s task:" % kind)
+        task = build_task(kind)
+        run_benchmark("pickle", PickleCodec(), task, number)
+        for serializer, compression in CODECS:
+            name = "%s+%s" % (serializer, compression or "none")
+            if is_available((serializer, compression)):
+                codec = TaskCodec(serializer=serializer, compression=compression)
+                run_benchmark(name, codec, task, number)
+            else:
+                print("  %-14s skipped, required package is not installed" % name)
+
+
+if __name__ == "__main__":
+    main()
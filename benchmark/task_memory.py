@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Measure memory used by tasks in the memory task queue and speed of
+`Task.clone`.
+
+The legacy task stored all attributes in `__dict__`, kept the full copy
+of the grab config and the unused list of coroutines. `LegacyTask` below
+reproduces that layout. The legacy `clone` built the new task with
+the `Task` constructor, it is compared with the current `clone`.
+
+Usage: python benchmark/task_memory.py [number_of_tasks]
+"""
+import sys
+import time
+import tracemalloc
+
+from grab import Grab
+from grab.base import copy_config
+from grab.spider.queue_backend.memory import QueueBackend
+from grab.spider.task import Task
+
+CLONE_CALLS = 100000
+
+
+class LegacyTask:
+    def __init__(self, task):
+        self.__dict__.update(task.__getstate__())
+        del self.__dict__["grab_config_diff"]
+        config = task.grab_config
+        self.grab_config = None if config is None else copy_config(config)
+        if not self.valid_status:
+            self.valid_status = []
+        self.coroutines_stack = []
+
+
+def build_task(num, kind):
+    url = "http://example.com/%d" % num
+    if kind == "url":
+        return Task("page", url=url)
+    if kind == "extra":
+        return Task("page", url=url, page=num, category="books")
+    grab = Grab(url=url, timeout=5, headers={"Referer": "http://example.com/"})
+    return Task("page", grab=grab)
+
+
+def measure_queue(number, factory):
+    queue = QueueBackend("bench")
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for num in range(number):
+        # Unique priorities, legacy tasks could not be compared
+        queue.put(factory(num), num)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / number
+
+
+def measure_clone(task, func):
+    started = time.time()
+    for _ in range(CLONE_CALLS):
+        func(task)
+    return time.time() - started
+
+
+def legacy_clone(task):
+    # Legacy `clone` passed all attributes to the constructor
+    kwargs = task.__getstate__()
+    del kwargs["grab_config_diff"]
+    del kwargs["lease"]
+    if task.grab_config is not None:
+        del kwargs["url"]
+        kwargs["grab_config"] = task.grab_config
+    return Task(**kwargs)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for kind in ("url", "extra", "grab"):
+        current = measure_queue(number, lambda num, kind=kind: build_task(num, kind))
+        legacy = measure_queue(
+            number, lambda num, kind=kind: LegacyTask(build_task(num, kind))
+        )
+        print(
+            "%s tasks: %d bytes per queued task, legacy layout: %d bytes"
+            % (kind, current, legacy)
+        )
+    for kind in ("url", "grab"):
+        task = build_task(0, kind)
+        print(
+            "%s task: %d clone() calls: %.3fs, legacy clone: %.3fs"
+            % (
+                kind,
+                CLONE_CALLS,
+                measure_clone(task, lambda x: x.clone()),
+                measure_clone(task, legacy_clone),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
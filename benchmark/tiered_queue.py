@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Compare memory usage of the memory and tiered task queues.
+
+Each backend is measured in separate process because memory
+of python process is not returned to the OS.
+
+Usage: python benchmark/tiered_queue.py [number_of_tasks]
+"""
+import resource
+import subprocess
+import sys
+import time
+from queue import Empty
+from random import randint
+
+from grab import Grab
+from grab.spider.task import Task
+
+
+def run_benchmark(backend, number):
+    mod = __import__(
+        "grab.spider.queue_backend.%s" % backend, globals(), locals(), ["foo"]
+    )
+    queue = mod.QueueBackend("bench")
+    grab = Grab()
+    started = time.time()
+    for idx in range(number):
+        grab.setup(url="http://example.com/%d" % idx)
+        queue.put(Task("page", grab=grab), randint(1, 100))
+    put_time = time.time() - started
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    count = 0
+    started = time.time()
+    while True:
+        try:
+            queue.get()
+        except Empty:
+            break
+        count += 1
+    get_time = time.time() - started
+    queue.close()
+    print(
+        "%s: put %d tasks: %.3fs, get %d tasks: %.3fs, max RSS: %d MB"
+        % (backend, number, put_time, count, get_time, max_rss // 1024)
+    )
+
+
+def main():
+    if len(sys.argv) > 2:
+        run_benchmark(sys.argv[2], int(sys.argv[1]))
+    else:
+        number = sys.argv[1] if len(sys.argv) > 1 else "200000"
+        for backend in ("memory", "tiered"):
+            subprocess.check_call([sys.executable, __file__, number, backend])
+
+
+if __name__ == "__main__":
+    main()
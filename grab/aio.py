@@ -0,0 +1,534 @@
+"""
+Minimal HTTP/1.1 client built on asyncio streams.
+
+It is used by `Urllib3Transport.arequest` to perform network requests
+without blocking the event loop. The raw response received from the network
+is wrapped into `urllib3.HTTPResponse` object, so the rest of response
+processing is done by the same code that processes responses of
+blocking requests. The raw body is kept in memory or, if the body is
+saved to the file, in the temporary file.
+"""
+import asyncio
+import io
+import ipaddress
+import socket
+import ssl
+import struct
+import tempfile
+import time
+import weakref
+from base64 import b64encode
+from collections import defaultdict
+from http.client import HTTPException
+from http.client import HTTPResponse as BaseHTTPResponse
+from urllib.parse import urlsplit
+
+import certifi
+from urllib3 import HTTPResponse, exceptions
+
+from grab import error
+from grab.util.encoding import make_bytes, make_str
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+# Max. number of idle keep-alive connections kept for each host
+ASYNC_POOL_MAXSIZE = 10
+# Max. size of response head
+MAX_HEAD_SIZE = 65536
+READ_CHUNK_SIZE = 65536
+# Responses to these requests/status codes never have a body
+NO_BODY_STATUSES = (204, 304)
+
+SSL_CONTEXT = None
+# Each event loop has its own pool of idle connections
+LOOP_POOLS = weakref.WeakKeyDictionary()
+
+
+def get_ssl_context():
+    global SSL_CONTEXT  # pylint: disable=global-statement
+    if SSL_CONTEXT is None:
+        SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+    return SSL_CONTEXT
+
+
+class FakeSocket:
+    """
+    Object which allows `http.client.HTTPResponse` to parse data
+    from the raw stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def makefile(self, *args, **kwargs):  # pylint: disable=unused-argument
+        return io.BufferedReader(self.stream)
+
+
+class ResponseStream(io.RawIOBase):
+    """
+    Raw stream of the response: the head followed by the body.
+
+    The head is parsed before the body is read from the network,
+    the body file must be rewound before the body is read from the stream.
+    """
+
+    def __init__(self, head, body):
+        super().__init__()
+        self.head = head
+        self.head_pos = 0
+        self.body = body
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        pos = self.head_pos
+        if pos < len(self.head):
+            num = min(len(buf), len(self.head) - pos)
+            buf[:num] = self.head[pos : pos + num]
+            self.head_pos += num
+            return num
+        return self.body.readinto(buf)
+
+    def close(self):
+        self.body.close()
+        super().close()
+
+
+class AsyncConnectionPool:
+    """
+    Idle keep-alive connections of one event loop.
+    """
+
+    def __init__(self, maxsize=ASYNC_POOL_MAXSIZE):
+        self.maxsize = maxsize
+        self.connections = defaultdict(list)
+
+    def get(self, key):
+        items = self.connections.get(key)
+        while items:
+            reader, writer = items.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    def put(self, key, conn):
+        items = self.connections[key]
+        if len(items) < self.maxsize:
+            items.append(conn)
+        else:
+            conn[1].close()
+
+    def clear(self):
+        for items in self.connections.values():
+            for _, writer in items:
+                writer.close()
+        self.connections.clear()
+
+
+def get_loop_pool():
+    loop = asyncio.get_running_loop()
+    try:
+        return LOOP_POOLS[loop]
+    except KeyError:
+        pool = LOOP_POOLS[loop] = AsyncConnectionPool()
+        return pool
+
+
+class AsyncRequestSession:
+    """
+    Performs one HTTP request described by `grab.transport.Request` object.
+    """
+
+    def __init__(self, req, pool):
+        self.req = req
+        self.pool = pool
+        self.url = urlsplit(make_str(req.url))
+        self.scheme = self.url.scheme.lower()
+        if self.scheme not in DEFAULT_PORTS:
+            raise error.GrabInvalidUrl("Unsupported URL scheme: %s" % self.scheme)
+        self.host = self.url.hostname
+        self.port = self.url.port or DEFAULT_PORTS[self.scheme]
+        self.method = make_str(req.method)
+        self.conn_key = (
+            self.scheme,
+            self.host,
+            self.port,
+            req.proxy_type if req.proxy else None,
+            req.proxy,
+            req.proxy_userpwd,
+        )
+
+    # Timeouts
+
+    def remaining_time(self):
+        if not self.req.timeout:
+            return None
+        remaining = self.req.timeout - (time.time() - self.req.op_started)
+        if remaining <= 0:
+            raise error.GrabTimeoutError(
+                "ReadTimeoutError",
+                exceptions.ReadTimeoutError(None, self.req.url, "Read timed out."),
+            )
+        return remaining
+
+    async def read(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self.remaining_time())
+        except asyncio.TimeoutError:
+            raise error.GrabTimeoutError(
+                "ReadTimeoutError",
+                exceptions.ReadTimeoutError(None, self.req.url, "Read timed out."),
+            )
+
+    # Connection
+
+    def is_http_proxy(self):
+        return bool(self.req.proxy) and self.req.proxy_type not in (
+            "socks4",
+            "socks5",
+        )
+
+    async def open_connection(self):
+        loop = asyncio.get_running_loop()
+        if self.req.proxy:
+            proxy_host, proxy_port = self.req.proxy.rsplit(":", 1)
+            address = (proxy_host, int(proxy_port))
+        else:
+            address = (self.host, self.port)
+        infos = await loop.getaddrinfo(address[0], address[1], type=socket.SOCK_STREAM)
+        if not infos:
+            raise error.GrabCouldNotResolveHostError(
+                "Could not resolve host: %s" % address[0]
+            )
+        family, socktype, proto, _, sockaddr = infos[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(False)
+        try:
+            return await asyncio.wait_for(
+                self.setup_connection(loop, sock, sockaddr), self.req.connect_timeout
+            )
+        except asyncio.TimeoutError:
+            sock.close()
+            raise error.GrabConnectionError(
+                "ConnectTimeoutError",
+                exceptions.ConnectTimeoutError("Connection timed out"),
+            )
+        except BaseException:
+            sock.close()
+            raise
+
+    async def setup_connection(self, loop, sock, sockaddr):
+        await loop.sock_connect(sock, sockaddr)
+        if self.req.proxy:
+            if self.req.proxy_type == "socks5":
+                await self.socks5_handshake(loop, sock)
+            elif self.req.proxy_type == "socks4":
+                await self.socks4_handshake(loop, sock)
+            elif self.scheme == "https":
+                await self.connect_tunnel(loop, sock)
+        if self.scheme == "https":
+            return await asyncio.open_connection(
+                sock=sock,
+                ssl=get_ssl_context(),
+                server_hostname=self.host,
+                limit=MAX_HEAD_SIZE,
+            )
+        return await asyncio.open_connection(sock=sock, limit=MAX_HEAD_SIZE)
+
+    async def recv_exactly(self, loop, sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = await loop.sock_recv(sock, size - len(data))
+            if not chunk:
+                raise error.GrabConnectionError(
+                    "ProxyError", ConnectionError("Proxy closed connection")
+                )
+            data += chunk
+        return data
+
+    async def socks5_handshake(self, loop, sock):
+        userpwd = self.req.proxy_userpwd
+        methods = b"\x00\x02" if userpwd else b"\x00"
+        await loop.sock_sendall(sock, b"\x05" + bytes([len(methods)]) + methods)
+        _, method = await self.recv_exactly(loop, sock, 2)
+        if method == 2 and userpwd:
+            user, pwd = [make_bytes(x) for x in userpwd.split(":", 1)]
+            await loop.sock_sendall(
+                sock,
+                b"\x01" + bytes([len(user)]) + user + bytes([len(pwd)]) + pwd,
+            )
+            _, status = await self.recv_exactly(loop, sock, 2)
+            if status != 0:
+                raise error.GrabConnectionError(
+                    "ProxyError", ConnectionError("SOCKS5 authentication failed")
+                )
+        elif method != 0:
+            raise error.GrabConnectionError(
+                "ProxyError", ConnectionError("SOCKS5 auth method is not supported")
+            )
+        host = make_bytes(self.host, encoding="idna")
+        await loop.sock_sendall(
+            sock,
+            b"\x05\x01\x00\x03"
+            + bytes([len(host)])
+            + host
+            + struct.pack(">H", self.port),
+        )
+        _, status, _, atyp = await self.recv_exactly(loop, sock, 4)
+        if status != 0:
+            raise error.GrabConnectionError(
+                "ProxyError", ConnectionError("SOCKS5 error code: %d" % status)
+            )
+        if atyp == 1:
+            addr_size = 4
+        elif atyp == 4:
+            addr_size = 16
+        else:
+            addr_size = (await self.recv_exactly(loop, sock, 1))[0]
+        await self.recv_exactly(loop, sock, addr_size + 2)
+
+    async def socks4_handshake(self, loop, sock):
+        infos = await loop.getaddrinfo(
+            self.host, self.port, family=socket.AF_INET, type=socket.SOCK_STREAM
+        )
+        ip_addr = ipaddress.IPv4Address(infos[0][4][0]).packed
+        if self.req.proxy_userpwd:
+            user = make_bytes(self.req.proxy_userpwd.split(":", 1)[0])
+        else:
+            user = b""
+        await loop.sock_sendall(
+            sock, b"\x04\x01" + struct.pack(">H", self.port) + ip_addr + user + b"\x00"
+        )
+        _, status = (await self.recv_exactly(loop, sock, 8))[:2]
+        if status != 0x5A:
+            raise error.GrabConnectionError(
+                "ProxyError", ConnectionError("SOCKS4 error code: %d" % status)
+            )
+
+    def proxy_auth_headers(self):
+        if self.req.proxy_userpwd:
+            token = b64encode(make_bytes(self.req.proxy_userpwd)).decode("ascii")
+            return {"Proxy-Authorization": "Basic %s" % token}
+        return {}
+
+    async def connect_tunnel(self, loop, sock):
+        lines = ["CONNECT %s:%d HTTP/1.1" % (self.host, self.port)]
+        lines.append("Host: %s:%d" % (self.host, self.port))
+        for key, val in self.proxy_auth_headers().items():
+            lines.append("%s: %s" % (key, val))
+        await loop.sock_sendall(sock, ("\r\n".join(lines) + "\r\n\r\n").encode())
+        head = b""
+        while b"\r\n\r\n" not in head:
+            chunk = await loop.sock_recv(sock, 1)
+            if not chunk or len(head) > MAX_HEAD_SIZE:
+                raise error.GrabConnectionError(
+                    "ProxyError", ConnectionError("Invalid proxy response")
+                )
+            head += chunk
+        status = head.split(b" ", 2)[1]
+        if status != b"200":
+            raise error.GrabConnectionError(
+                "ProxyError",
+                ConnectionError("Proxy responded with status %s" % make_str(status)),
+            )
+
+    # Request
+
+    def build_request_head(self):
+        if self.is_http_proxy() and self.scheme == "http":
+            target = make_str(self.req.url)
+        else:
+            target = self.url.path or "/"
+            if self.url.query:
+                target += "?" + self.url.query
+        headers = {}
+        if self.port == DEFAULT_PORTS[self.scheme]:
+            headers["Host"] = self.url.hostname
+        else:
+            headers["Host"] = "%s:%d" % (self.url.hostname, self.port)
+        if self.is_http_proxy() and self.scheme == "http":
+            headers.update(self.proxy_auth_headers())
+        headers.update(self.req.headers)
+        if self.req.data is not None and "Content-Length" not in headers:
+            headers["Content-Length"] = len(self.req.data)
+        lines = ["%s %s HTTP/1.1" % (self.method, target)]
+        for key, val in headers.items():
+            lines.append("%s: %s" % (key, val))
+        return make_bytes("\r\n".join(lines) + "\r\n\r\n")
+
+    async def read_head(self, reader):
+        while True:
+            try:
+                head = await self.read(reader.readuntil(b"\r\n\r\n"))
+            except asyncio.LimitOverrunError as ex:
+                raise error.GrabInvalidResponse("Response head is too large", ex)
+            # Skip informational responses like "100 Continue"
+            status_line = head.split(b"\r\n", 1)[0].split(b" ", 2)
+            if len(status_line) < 2 or not status_line[1].startswith(b"1"):
+                return head
+
+    async def copy_exactly(self, reader, out, size):
+        while size > 0:
+            chunk = await self.read(reader.readexactly(min(size, READ_CHUNK_SIZE)))
+            out.write(chunk)
+            size -= len(chunk)
+
+    async def read_chunked_body(self, reader, out, maxsize):
+        """
+        Copy chunked body to `out` file.
+
+        The body larger than `maxsize` is cut and terminated with
+        the last chunk, the rest of the body is not read.
+
+        Returns flag which tells if connection could be reused.
+        """
+        bytes_read = 0
+        while True:
+            line = await self.read(reader.readuntil(b"\r\n"))
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                out.write(line)
+                # Read trailers
+                while True:
+                    line = await self.read(reader.readuntil(b"\r\n"))
+                    out.write(line)
+                    if line == b"\r\n":
+                        return True
+            if maxsize and bytes_read + size > maxsize:
+                size = maxsize - bytes_read
+                if size:
+                    out.write(b"%x\r\n" % size)
+                    await self.copy_exactly(reader, out, size)
+                    out.write(b"\r\n")
+                out.write(b"0\r\n\r\n")
+                return False
+            out.write(line)
+            await self.copy_exactly(reader, out, size + 2)
+            bytes_read += size
+
+    async def read_until_eof(self, reader, out, maxsize):
+        bytes_read = 0
+        while True:
+            chunk = await self.read(reader.read(READ_CHUNK_SIZE))
+            if not chunk:
+                return
+            out.write(chunk)
+            bytes_read += len(chunk)
+            if maxsize and bytes_read > maxsize:
+                return
+
+    async def read_body(self, reader, msg, status, out):
+        """
+        Copy raw body to `out` file.
+
+        Returns flag which tells if connection could be reused.
+        """
+        if self.method == "HEAD" or status in NO_BODY_STATUSES:
+            return True
+        if self.req.config_nobody:
+            return False
+        encoded = msg.get("Content-Encoding", "identity").lower() != "identity"
+        maxsize = None if encoded else self.req.config_body_maxsize
+        if "chunked" in msg.get("Transfer-Encoding", "").lower():
+            return await self.read_chunked_body(reader, out, maxsize)
+        if msg.get("Content-Length") is not None:
+            size = int(msg["Content-Length"])
+            if maxsize and maxsize < size:
+                await self.copy_exactly(reader, out, maxsize)
+                return False
+            await self.copy_exactly(reader, out, size)
+            return True
+        await self.read_until_eof(reader, out, maxsize)
+        return False
+
+    def create_body_file(self):
+        # Body which is saved to the file is not kept in memory
+        if self.req.response_file is not None:
+            return tempfile.TemporaryFile()
+        return io.BytesIO()
+
+    async def fetch(self, reuse=True):
+        conn = self.pool.get(self.conn_key) if reuse else None
+        reused = conn is not None
+        if conn is None:
+            conn = await self.open_connection()
+        reader, writer = conn
+        try:
+            try:
+                writer.write(self.build_request_head())
+                if self.req.data:
+                    writer.write(self.req.data)
+                await writer.drain()
+                head = await self.read_head(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                # Idle connection has been closed by the server
+                writer.close()
+                return await self.fetch(reuse=False)
+            orig, reusable = await self.read_response(reader, head)
+        except BaseException:
+            writer.close()
+            raise
+        if reusable and not orig.will_close:
+            self.pool.put(self.conn_key, conn)
+        else:
+            writer.close()
+        return self.build_response(orig)
+
+    async def read_response(self, reader, head):
+        """
+        Parse the head and read the body of the response.
+
+        Returns `http.client.HTTPResponse` and flag which tells
+        if connection could be reused.
+        """
+        stream = ResponseStream(head, self.create_body_file())
+        orig = BaseHTTPResponse(FakeSocket(stream), method=self.method)
+        try:
+            orig.begin()
+            reusable = await self.read_body(reader, orig.msg, orig.status, stream.body)
+        except BaseException:
+            stream.close()
+            raise
+        stream.body.seek(0)
+        return orig, reusable
+
+    def build_response(self, orig):
+        return HTTPResponse(
+            body=orig,
+            headers=orig.getheaders(),
+            status=orig.status,
+            version=orig.version,
+            reason=orig.reason,
+            original_response=orig,
+            preload_content=False,
+            request_method=self.method,
+            request_url=make_str(self.req.url),
+        )
+
+
+async def fetch(req):
+    """
+    Perform network request and return `urllib3.HTTPResponse`.
+    """
+    session = AsyncRequestSession(req, get_loop_pool())
+    try:
+        return await session.fetch()
+    except error.GrabError:
+        raise
+    except asyncio.IncompleteReadError as ex:
+        raise error.GrabConnectionError(
+            "ProtocolError", exceptions.ProtocolError("Connection aborted.", ex)
+        )
+    except ssl.SSLError as ex:
+        raise error.GrabConnectionError("SSLError", ex)
+    except socket.gaierror as ex:
+        raise error.GrabCouldNotResolveHostError("NameResolutionError", ex)
+    except (HTTPException, ValueError) as ex:
+        raise error.GrabInvalidResponse(str(ex), ex)
+    except OSError as ex:
+        raise error.GrabConnectionError(
+            "ProtocolError", exceptions.ProtocolError("Connection aborted.", ex)
+        )
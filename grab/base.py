@@ -446,6 +446,47 @@ class Grab:
         Returns: ``Document`` objects.
         """
 
+        steps = self.iterate_request_steps(**kwargs)
+        for _ in steps:
+            try:
+                self.transport.request()
+            except error.GrabError as ex:
+                steps.throw(ex)
+        return self.doc
+
+    async def arequest(self, **kwargs):
+        """
+        Perform network request without blocking the event loop.
+
+        Coroutine version of `request` method. It handles options,
+        redirects, cookies and proxies in the same way.
+
+        Returns: ``Document`` objects.
+        """
+
+        steps = self.iterate_request_steps(**kwargs)
+        for _ in steps:
+            if not hasattr(self.transport, "arequest"):
+                raise error.GrabMisuseError(
+                    "Transport %s does not support asyncio requests"
+                    % self.transport.__class__.__name__
+                )
+            try:
+                await self.transport.arequest()
+            except error.GrabError as ex:
+                steps.throw(ex)
+        return self.doc
+
+    def iterate_request_steps(self, **kwargs):
+        """
+        Prepare requests and process their results following redirects.
+
+        The generator yields each time the transport should perform
+        the network request, errors of the request are thrown into
+        the generator. It is shared by `request` and `arequest` methods,
+        the document of the last request is stored in `doc` attribute.
+        """
+
         self.prepare_request(**kwargs)
         refresh_count = 0
 
@@ -453,40 +494,55 @@ class Grab:
             self.log_request()
 
             try:
-                self.transport.request()
+                yield
             except error.GrabError as ex:
-                self.exception = ex
-                self.reset_temporary_options()
-                if self.config["log_dir"]:
-                    self.save_failed_dump()
+                self.process_request_error(ex)
                 raise
-            else:
-                with self.transport.wrap_transport_error():
-                    doc = self.process_request_result()
-
-                if self.config["follow_location"]:
-                    if doc.code in (301, 302, 303, 307, 308):
-                        if doc.headers.get("Location"):
-                            refresh_count += 1
-                            if refresh_count > self.config["redirect_limit"]:
-                                raise error.GrabTooManyRedirectsError()
-                            url = doc.headers.get("Location")
-                            self.prepare_request(
-                                url=self.make_url_absolute(url), referer=None
-                            )
-                            continue
-
-                if self.config["follow_refresh"]:
-                    refresh_url = self.doc.get_meta_refresh_url()
-                    if refresh_url is not None:
-                        refresh_count += 1
-                        if refresh_count > self.config["redirect_limit"]:
-                            raise error.GrabTooManyRedirectsError()
-                        self.prepare_request(
-                            url=self.make_url_absolute(refresh_url), referer=None
-                        )
-                        continue
-                return doc
+            with self.transport.wrap_transport_error():
+                doc = self.process_request_result()
+
+            redirect_url = self.find_redirect_url(doc)
+            if redirect_url is None:
+                return
+            refresh_count += 1
+            if refresh_count > self.config["redirect_limit"]:
+                raise error.GrabTooManyRedirectsError()
+            self.prepare_request(url=redirect_url, referer=None)
+
+    async def ago(self, url, **kwargs):
+        """
+        Go to ``url`` without blocking the event loop.
+
+        Coroutine version of `go` method.
+        """
+
+        return await self.arequest(url=url, **kwargs)
+
+    def process_request_error(self, ex):
+        self.exception = ex
+        self.reset_temporary_options()
+        if self.config["log_dir"]:
+            self.save_failed_dump()
+
+    def find_redirect_url(self, doc):
+        """
+        Return absolute URL which should be requested next
+        according to `follow_location` and `follow_refresh` options.
+
+        Return None if no redirect should be done.
+        """
+
+        if self.config["follow_location"]:
+            if doc.code in (301, 302, 303, 307, 308):
+                if doc.headers.get("Location"):
+                    url = doc.headers.get("Location")
+                    return self.make_url_absolute(url)
+
+        if self.config["follow_refresh"]:
+            refresh_url = self.doc.get_meta_refresh_url()
+            if refresh_url is not None:
+                return self.make_url_absolute(refresh_url)
+        return None
 
     def submit(self, make_request=True, **kwargs):
         """
@@ -205,7 +205,8 @@ class Document:
             self.headers = email.message_from_string(response)
 
         if charset is None:
-            if isinstance(self.body, str):
+            # Do not load body stored in the file into memory
+            if not self.body_path and isinstance(self.body, str):
                 self.charset = "utf-8"
             else:
                 self.detect_charset()
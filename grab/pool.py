@@ -0,0 +1,261 @@
+"""
+Process-wide registry of urllib3 connection pools.
+
+All `Urllib3Transport` instances share the pool manager provided by
+the registry, so keep-alive connections opened by one `Grab` instance
+are reused by any other `Grab` instance in the same process.
+
+Proxy managers are cached in the same registry, keyed by proxy type,
+proxy address and proxy credentials.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import certifi
+from urllib3 import PoolManager, ProxyManager, make_headers
+from urllib3.contrib.socks import SOCKSProxyManager
+
+# Max. number of host pools kept by the pool manager
+DEFAULT_NUM_POOLS = 100
+# Max. number of connections kept alive for each host
+DEFAULT_POOL_MAXSIZE = 10
+# Host pool which has not been used for that number of seconds is closed
+DEFAULT_POOL_IDLE_TIMEOUT = 60
+# Max. number of cached proxy managers
+DEFAULT_PROXY_CACHE_SIZE = 500
+
+logger = logging.getLogger("grab.pool")  # pylint: disable=invalid-name
+
+
+def get_host_key(url):
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower() or "http"
+    port = parts.port
+    if port is None:
+        port = 443 if scheme == "https" else 80
+    return scheme, (parts.hostname or "").lower(), port
+
+
+class PoolRegistry:
+    """
+    Thread-safe holder of the shared `PoolManager`.
+
+    The registry remembers when each host pool was used last time and
+    closes host pools which have been idle longer than `idle_timeout`.
+
+    Proxy managers are kept in LRU cache limited by `proxy_cache_size`.
+    Proxy manager which has not been used for `idle_timeout` seconds
+    is closed as well.
+    """
+
+    def __init__(
+        self,
+        num_pools=DEFAULT_NUM_POOLS,
+        maxsize=DEFAULT_POOL_MAXSIZE,
+        idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+        proxy_cache_size=DEFAULT_PROXY_CACHE_SIZE,
+    ):
+        self.num_pools = num_pools
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.proxy_cache_size = proxy_cache_size
+        self.lock = threading.RLock()
+        self.manager = None
+        self.last_used = {}
+        # Values are (proxy_manager, last_used_time) pairs
+        # Most recently used item is the last item
+        self.proxy_managers = OrderedDict()
+        self.eviction_time = time.time()
+
+    def configure(
+        self, num_pools=None, maxsize=None, idle_timeout=None, proxy_cache_size=None
+    ):
+        """
+        Change settings of the registry.
+
+        Changing `num_pools` or `maxsize` replaces the pool manager and
+        proxy managers: new requests use new managers created with new
+        settings. Old managers are not closed because requests in progress
+        could still use them, their connections are closed when the old
+        managers are garbage collected.
+        """
+        with self.lock:
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+            if proxy_cache_size is not None:
+                self.proxy_cache_size = proxy_cache_size
+                self.shrink_proxy_cache()
+            changed = False
+            if num_pools is not None and num_pools != self.num_pools:
+                self.num_pools = num_pools
+                changed = True
+            if maxsize is not None and maxsize != self.maxsize:
+                self.maxsize = maxsize
+                changed = True
+            if changed:
+                self.manager = None
+                self.last_used = {}
+                self.proxy_managers = OrderedDict()
+
+    def ensure_maxsize(self, maxsize):
+        """
+        Increase per-host limit of connections if it is less than `maxsize`.
+        """
+        with self.lock:
+            if maxsize > self.maxsize:
+                self.configure(maxsize=maxsize)
+
+    def build_manager(self):
+        # http://urllib3.readthedocs.io/en/latest/user-guide.html#certificate-verification
+        return PoolManager(
+            self.num_pools,
+            maxsize=self.maxsize,
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=certifi.where(),
+        )
+
+    def build_proxy_manager(self, proxy_type, proxy, userpwd):
+        proxy_url = "%s://%s" % (proxy_type, proxy)
+        if proxy_type == "socks5":
+            return SOCKSProxyManager(
+                proxy_url,
+                num_pools=self.num_pools,
+                maxsize=self.maxsize,
+                cert_reqs="CERT_REQUIRED",
+                ca_certs=certifi.where(),
+            )
+        if userpwd:
+            headers = make_headers(proxy_basic_auth=userpwd)
+        else:
+            headers = None
+        return ProxyManager(
+            proxy_url,
+            num_pools=self.num_pools,
+            maxsize=self.maxsize,
+            proxy_headers=headers,
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=certifi.where(),
+        )
+
+    def check_idle(self, now):
+        if self.idle_timeout and now - self.eviction_time > min(self.idle_timeout, 10):
+            self.evict_idle(now)
+
+    def acquire(self, url):
+        """
+        Return shared pool manager to use for request to the `url`.
+        """
+        now = time.time()
+        with self.lock:
+            if self.manager is None:
+                self.manager = self.build_manager()
+            self.check_idle(now)
+            self.last_used[get_host_key(url)] = now
+            return self.manager
+
+    def acquire_proxy(self, proxy_type, proxy, userpwd=None):
+        """
+        Return cached proxy manager for given proxy settings.
+        """
+        now = time.time()
+        key = (proxy_type, proxy, userpwd)
+        with self.lock:
+            self.check_idle(now)
+            try:
+                manager, _ = self.proxy_managers.pop(key)
+            except KeyError:
+                manager = self.build_proxy_manager(proxy_type, proxy, userpwd)
+            self.proxy_managers[key] = (manager, now)
+            self.shrink_proxy_cache()
+            return manager
+
+    def shrink_proxy_cache(self):
+        with self.lock:
+            while len(self.proxy_managers) > max(self.proxy_cache_size, 0):
+                _, (manager, _) = self.proxy_managers.popitem(last=False)
+                manager.clear()
+
+    def evict_idle_proxies(self, now):
+        count = 0
+        with self.lock:
+            for key, (manager, ts) in list(self.proxy_managers.items()):
+                if now - ts > self.idle_timeout:
+                    del self.proxy_managers[key]
+                    manager.clear()
+                    count += 1
+        return count
+
+    def evict_idle(self, now=None):
+        """
+        Close host pools and proxy managers which have not been used
+        for `idle_timeout` seconds.
+
+        Returns number of closed host pools and proxy managers.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.eviction_time = now
+            if not self.idle_timeout:
+                return 0
+            count = self.evict_idle_proxies(now)
+            if self.manager is None:
+                return count
+            idle_hosts = set(
+                key
+                for key, ts in self.last_used.items()
+                if now - ts > self.idle_timeout
+            )
+            if not idle_hosts:
+                return count
+            for pool_key in self.manager.pools.keys():
+                host_key = (pool_key.key_scheme, pool_key.key_host, pool_key.key_port)
+                if host_key in idle_hosts:
+                    # Removing pool from container calls `pool.close()`
+                    self.manager.pools.pop(pool_key, None)
+                    count += 1
+            for key in idle_hosts:
+                del self.last_used[key]
+            if count:
+                logger.debug("Closed %d idle connection pool(s)", count)
+            return count
+
+    def size(self):
+        """
+        Return number of open host pools.
+        """
+        with self.lock:
+            if self.manager is None:
+                return 0
+            return len(self.manager.pools)
+
+    def proxy_cache_count(self):
+        """
+        Return number of cached proxy managers.
+        """
+        with self.lock:
+            return len(self.proxy_managers)
+
+    def clear(self):
+        """
+        Close all host pools and proxy managers.
+        """
+        with self.lock:
+            if self.manager is not None:
+                self.manager.clear()
+            self.manager = None
+            self.last_used = {}
+            for manager, _ in self.proxy_managers.values():
+                manager.clear()
+            self.proxy_managers = OrderedDict()
+
+
+# The registry used by default by all Grab instances
+POOL_REGISTRY = PoolRegistry()
+
+
+def get_pool_registry():
+    return POOL_REGISTRY
@@ -10,14 +10,22 @@ from traceback import format_exception, format_stack
 from grab.base import Grab
 from grab.error import raise_feature_is_deprecated
 from grab.proxylist import BaseProxySource, ProxyList
+from grab.spider.concurrency import AdaptiveConcurrency
+from grab.spider.dedup_backend.base import get_task_fingerprint
 from grab.spider.error import NoTaskHandler, SpiderError, SpiderMisuseError
+from grab.spider.host_scheduler import HostScheduler, get_task_host
+from grab.spider.queue_backend.base import datetime_to_timestamp
+from grab.spider.profiler import HandlerProfiler
 from grab.spider.task import Task
-from grab.stat import Stat
+from grab.spider.tracing import Tracer
+from grab.stat import DEFAULT_PERCENTILES, Stat, get_collection_total
+from grab.util.http import DEFAULT_TRACKING_PARAMS
 from grab.util.metrics import format_traffic_value
 from grab.util.misc import camel_case_to_underscore
 from grab.util.warning import warn
 
-from .service.parser import ParserService
+from .service.base import IDLE_WAIT_TIMEOUT, Notifier, WorkCounter
+from .service.parser import ParserService, ParserServiceProcess
 from .service.task_dispatcher import TaskDispatcherService
 from .service.task_generator import TaskGeneratorService
 
@@ -26,6 +34,20 @@ DEFAULT_NETWORK_STREAM_NUMBER = 3
 DEFAULT_TASK_TRY_LIMIT = 5
 DEFAULT_NETWORK_TRY_LIMIT = 5
 RANDOM_TASK_PRIORITY_RANGE = (50, 100)
+# Max. time network worker waits for new task if the task queue is shared:
+# tasks put by other processes do not wake up workers of this process
+SHARED_QUEUE_POLL_TIMEOUT = 0.1
+# Stat collections which grow during the whole run are bounded:
+# rejected URLs are sampled, the most recent errors are kept
+STAT_COLLECTIONS = {
+    "task-count-rejected": "reservoir",
+    "network-count-rejected": "reservoir",
+    "task-with-invalid-url": "reservoir",
+    "fatal": "recent",
+}
+# Max. number of histograms of each metric broken down by host
+# or by proxy which are printed by `render_stats`
+RENDER_HISTOGRAM_LIMIT = 10
 NULL = object()
 
 # pylint: disable=invalid-name
@@ -118,6 +140,7 @@ class Spider(metaclass=SpiderMetaClass):
         args=None,
         parser_requests_per_process=10000,
         parser_pool_size=1,
+        parser_service="threaded",
         network_service="threaded",
         grab_transport="urllib3",
         # Deprecated
@@ -126,6 +149,13 @@ class Spider(metaclass=SpiderMetaClass):
         """
         Arguments:
         * thread-number - Number of concurrent network streams
+        * parser_service - "threaded" (task handlers are executed in
+            threads) or "process" (task handlers are executed in
+            separate processes)
+        * parser_requests_per_process - number of responses processed by
+            parser thread or process before it is restarted
+        * network_service - "threaded" (thread per network stream) or
+            "async" (all network streams are run by one asyncio event loop)
         * network_try_limit - How many times try to send request
             again if network error was occurred, use 0 to disable
         * task_try_limit - Limit of tries to execute some task
@@ -143,13 +173,27 @@ class Spider(metaclass=SpiderMetaClass):
         """
 
         self.fatal_error_queue = Queue()
+        # Number of items being processed by spider services
+        self.work_counter = WorkCounter()
+        # Wakes up network workers when new task is added
+        self.task_notifier = Notifier()
         self.task_queue_parameters = None
         self._started = None
         assert grab_transport in ["urllib3"]
         self.grab_transport_name = grab_transport
         self.parser_requests_per_process = parser_requests_per_process
-        self.stat = Stat()
+        self.stat = Stat(collection_kinds=STAT_COLLECTIONS)
         self.task_queue = None
+        # Time when leases of tasks in progress are extended next time
+        self.lease_extend_time = None
+        self.host_scheduler = None
+        self.concurrency_controller = None
+        self.dedup = None
+        self.dedup_tracking_params = None
+        self.tracer = None
+        self.handler_profiler = None
+        # Passes tasks to other worker processes of `SpiderRunner`
+        self.task_router = None
         if args is None:
             self.args = {}
         else:
@@ -188,25 +232,33 @@ class Spider(metaclass=SpiderMetaClass):
         self.proxy_auto_change = False
         self.interrupted = False
         self.parser_pool_size = parser_pool_size
-        self.parser_service = ParserService(
-            spider=self,
-            pool_size=self.parser_pool_size,
-        )
+        assert parser_service in ("threaded", "process")
+        if parser_service == "threaded":
+            self.parser_service = ParserService(
+                spider=self,
+                pool_size=self.parser_pool_size,
+            )
+        else:
+            self.parser_service = ParserServiceProcess(
+                spider=self,
+                pool_size=self.parser_pool_size,
+            )
         if transport is not None:
             warn(
                 'The "transport" argument of Spider constructor is'
                 ' deprecated. Use "network_service" argument.'
             )
             network_service = transport
-        assert network_service in ("threaded",)
-        if network_service == "threaded":
-            # pylint: disable=no-name-in-module, import-error
-            # pylint: disable=import-outside-toplevel
-            from .service.network import NetworkServiceThreaded
-
-            # pylint: enable=import-outside-toplevel
+        assert network_service in ("threaded", "async")
+        # pylint: disable=no-name-in-module, import-error
+        # pylint: disable=import-outside-toplevel
+        from .service.network import NetworkServiceAsync, NetworkServiceThreaded
 
+        # pylint: enable=import-outside-toplevel
+        if network_service == "threaded":
             self.network_service = NetworkServiceThreaded(self, self.thread_number)
+        else:
+            self.network_service = NetworkServiceAsync(self, self.thread_number)
         self.task_dispatcher = TaskDispatcherService(self)
         self.task_generator_service = TaskGeneratorService(self, self.task_generator())
 
@@ -218,7 +270,10 @@ class Spider(metaclass=SpiderMetaClass):
         Setup queue.
 
         :param backend: Backend name
-            Should be one of the following: 'memory', 'redis' or 'mongo'.
+            Should be one of the following: 'memory', 'tiered', 'redis',
+            'mongo' or 'sqlite'. The 'sqlite' backend keeps tasks in the database
+            file at `path` and the next run of the spider resumes processing
+            of tasks left in the queue.
         :param kwargs: Additional credentials for backend.
         """
         if backend == "mongo":
@@ -230,11 +285,131 @@ class Spider(metaclass=SpiderMetaClass):
         )
         self.task_queue = mod.QueueBackend(spider_name=self.get_spider_name(), **kwargs)
 
+    def setup_dedup(
+        self, backend="memory", tracking_params=DEFAULT_TRACKING_PARAMS, **kwargs
+    ):
+        """
+        Setup filter of duplicate tasks.
+
+        New task is not added to the task queue if the task with same
+        canonical URL, HTTP method and POST data has been added before.
+        Retries of tasks and tasks created with `dedup=False` are not
+        filtered.
+
+        :param backend: Backend name
+            Should be one of the following: 'memory' (exact set of task
+            fingerprints), 'bloom' (scalable Bloom filter) or 'sqlite'
+            (fingerprints stored in the database file at `path`).
+        :param tracking_params: names of query parameters which are
+            removed from URL before comparison, None to keep all parameters
+        :param kwargs: Additional arguments for backend.
+        """
+        logger.debug("Using %s backend for dedup", backend)
+        mod = __import__(
+            "grab.spider.dedup_backend.%s" % backend, globals(), locals(), ["foo"]
+        )
+        if self.dedup is not None:
+            self.dedup.close()
+        self.dedup = mod.DedupBackend(spider_name=self.get_spider_name(), **kwargs)
+        self.dedup_tracking_params = tracking_params
+
+    def is_duplicate_task(self, task):
+        """
+        Check the task against the dedup filter and save its fingerprint.
+        """
+        if (
+            self.dedup is None
+            or not task.dedup
+            or task.network_try_count
+            or task.task_try_count > 1
+        ):
+            return False
+        fingerprint = get_task_fingerprint(task, self.dedup_tracking_params)
+        if self.dedup.add(fingerprint):
+            return False
+        self.stat.inc("spider:task-duplicate")
+        return True
+
+    def setup_adaptive_concurrency(self, **kwargs):
+        """
+        Adjust number of concurrent network requests to the network conditions.
+
+        :param kwargs: arguments of
+            `grab.spider.concurrency.AdaptiveConcurrency` e.g. `min_limit`,
+            `max_limit` and `initial_limit`. The `max_limit` can not be
+            greater than `thread_number` which is used by default.
+        """
+        kwargs.setdefault("max_limit", self.thread_number)
+        if kwargs["max_limit"] > self.thread_number:
+            raise SpiderMisuseError(
+                "Option max_limit could not be greater than thread_number"
+            )
+        self.concurrency_controller = AdaptiveConcurrency(stat=self.stat, **kwargs)
+
+    def setup_host_scheduler(self, **kwargs):
+        """
+        Setup per-host scheduling of tasks.
+
+        :param kwargs: arguments of `grab.spider.host_scheduler.HostScheduler`
+            e.g. `concurrency`, `delay` and `domains`
+        """
+        self.host_scheduler = HostScheduler(**kwargs)
+
+    def setup_tracing(self, sample_rate=1.0, path=None, sink=None):
+        """
+        Record timestamped spans of processing stages of sampled tasks.
+
+        :param sample_rate: share of tasks which are traced, from 0 to 1
+        :param path: spans are appended to this JSONL file
+        :param sink: callable which receives each span as dict
+        """
+        if self.tracer is not None:
+            self.tracer.close()
+        self.tracer = Tracer(sample_rate=sample_rate, path=path, sink=sink)
+
+    def setup_handler_profiling(self, profile_rate=0, snapshot_number=5, path=None):
+        """
+        Measure wall and CPU time of task handlers and integrity functions.
+
+        The report is written when the spider stops working.
+
+        :param profile_rate: share of handler calls which are run under
+            cProfile, from 0 to 1
+        :param snapshot_number: number of profiles of the slowest calls kept
+            for each handler
+        :param path: the report is written to this file, otherwise it is
+            logged by "grab.spider.profiler" logger
+        """
+        self.handler_profiler = HandlerProfiler(
+            profile_rate=profile_rate, snapshot_number=snapshot_number, path=path
+        )
+
+    def trace_span(self, task, name, start, end=None, **attrs):
+        """
+        Add the span to the trace of the task if the task is traced.
+        """
+        if task.trace_id and self.tracer is not None:
+            self.tracer.add_span(task, name, start, end, **attrs)
+
     def add_task(self, task, queue=None, raise_error=False):
         """
         Add task to the task queue.
+
+        Returns False if the task has invalid URL or it is
+        filtered as duplicate.
+
+        If the task has been taken from the task queue with a lease
+        (e.g. it is restarted after network error) then the lease is
+        acknowledged after the task is added.
         """
+        lease, task.lease = task.lease, None
+        try:
+            return self.put_task(task, queue, raise_error)
+        finally:
+            if lease is not None:
+                self.task_queue.ack(lease)
 
+    def put_task(self, task, queue, raise_error):
         if queue is None:
             queue = self.task_queue
         if queue is None:
@@ -261,17 +436,90 @@ class Spider(metaclass=SpiderMetaClass):
                 "".join(format_stack()),
             )
             return False
+        if (
+            self.task_router is not None
+            and queue is self.task_queue
+            and self.task_router.forward(task)
+        ):
+            return True
+        if self.is_duplicate_task(task):
+            return False
         # TODO: keep original task priority if it was set explicitly
         # WTF the previous comment means?
+        if task.schedule_time is None:
+            task.queue_time = time.time()
+        else:
+            task.queue_time = datetime_to_timestamp(task.schedule_time)
+        if self.tracer is not None:
+            self.trace_task_added(task)
         queue.put(task, priority=task.priority, schedule_time=task.schedule_time)
+        self.task_notifier.notify()
         return True
 
+    def trace_task_added(self, task):
+        if task.trace_id is None:
+            self.tracer.start_trace(task)
+        self.trace_span(
+            task,
+            "add_task",
+            time.time(),
+            priority=task.priority,
+            task_try=task.task_try_count,
+            network_try=task.network_try_count,
+        )
+
+    def ack_task(self, task, lease=None):
+        """
+        Acknowledge the lease of the task taken from the task queue.
+
+        The lease is not acknowledged before all tasks generated by
+        the task handler are added to the task queue so the crash
+        of the spider does not lose them.
+        """
+        if lease is None:
+            lease = task.lease
+        if lease is not None:
+            if task.lease == lease:
+                task.lease = None
+            self.task_queue.ack(lease)
+
+    def extend_task_leases(self):
+        """
+        Extend leases of tasks taken from the task queue which have not
+        been acknowledged yet, if half of the visibility timeout has passed
+        since the previous extension.
+
+        Tasks waiting in the buffer of host scheduler, in the service queues
+        and running in task handlers keep their leases until they are
+        acknowledged. Returns number of seconds until the next extension
+        or None if the task queue does not lease tasks.
+        """
+        timeout = self.task_queue.visibility_timeout
+        if not timeout:
+            return None
+        now = time.time()
+        if self.lease_extend_time is None:
+            # Leases are taken after this moment
+            self.lease_extend_time = now + timeout / 2
+        elif self.lease_extend_time <= now:
+            self.task_queue.extend_leases()
+            self.lease_extend_time = now + timeout / 2
+        return self.lease_extend_time - now
+
     def stop(self):
         """
         This method set internal flag which signal spider
         to stop processing new task and shuts down.
         """
         self.work_allowed = False
+        self.work_counter.notify()
+
+    def report_fatal_error(self, exc_info):
+        """
+        Pass the error to the main thread which stops the spider.
+        """
+        self.fatal_error_queue.put(exc_info)
+        self.work_counter.notify()
 
     def load_proxylist(
         self,
@@ -369,18 +617,24 @@ class Spider(metaclass=SpiderMetaClass):
 
         out.append("Lists:")
         # Process collections sorted by size desc
-        col_sizes = [(x, len(y)) for x, y in self.stat.collections.items()]
+        col_sizes = [
+            (x, get_collection_total(y), len(y))
+            for x, y in self.stat.collections.items()
+        ]
         col_sizes = sorted(col_sizes, key=lambda x: x[1], reverse=True)
-        for col_size in col_sizes:
-            out.append("  %s: %d" % col_size)
+        for key, total, size in col_sizes:
+            if total == size:
+                out.append("  %s: %d" % (key, total))
+            else:
+                out.append("  %s: %d (%d kept)" % (key, total, size))
         out.append("")
 
+        out.extend(self.render_latency_stats())
+
         # Process extra metrics
-        if "download-size" in self.stat.counters:
-            out.append(
-                "Network download: %s"
-                % format_traffic_value(self.stat.counters["download-size"])
-            )
+        download_size = self.stat.get_counter("download-size")
+        if download_size:
+            out.append("Network download: %s" % format_traffic_value(download_size))
         out.append(
             "Queue size: %d" % self.task_queue.size() if self.task_queue else "NA"
         )
@@ -481,6 +735,12 @@ class Spider(metaclass=SpiderMetaClass):
                 self.add_task(Task("initial", url=url))
 
     def get_task_from_queue(self):
+        if self.host_scheduler is not None:
+            task = self.host_scheduler.get_task(self.task_queue)
+            if task is None:
+                if self.host_scheduler.size() or self.task_queue.size():
+                    return True
+            return task
         try:
             return self.task_queue.get()
         except Empty:
@@ -489,10 +749,43 @@ class Spider(metaclass=SpiderMetaClass):
                 return True
             return None
 
+    def release_task(self, task):
+        """
+        Called by network service when network request of the task
+        is completed.
+        """
+        if self.host_scheduler is not None:
+            self.host_scheduler.release(task)
+            # Host slot is released, the host could have tasks to process
+            self.task_notifier.notify()
+
+    def get_task_wait_timeout(self):
+        """
+        Return max. time network worker could wait for new task.
+
+        New tasks put by this spider wake up the workers, the wait is limited
+        by the time when the next delayed task becomes ready, and by the poll
+        timeout if tasks could be put by other processes.
+        """
+        if self.task_queue.shared:
+            timeout = SHARED_QUEUE_POLL_TIMEOUT
+        else:
+            timeout = IDLE_WAIT_TIMEOUT
+        schedule_time = self.task_queue.get_next_schedule_time()
+        if schedule_time is not None:
+            wait_time = (schedule_time - datetime.utcnow()).total_seconds()
+            timeout = min(timeout, max(wait_time, 0))
+        if self.host_scheduler is not None:
+            wait_time = self.host_scheduler.get_wait_time()
+            if wait_time is not None:
+                timeout = min(timeout, wait_time)
+        return timeout
+
     def setup_grab_for_task(self, task):
         grab = self.create_grab_instance()
-        if task.grab_config:
-            grab.load_config(task.grab_config)
+        grab_config = task.grab_config
+        if grab_config:
+            grab.load_config(grab_config)
         else:
             grab.setup(url=task.url)
 
@@ -553,9 +846,9 @@ class Spider(metaclass=SpiderMetaClass):
         # Increase stat counters
         self.stat.inc("spider:request-processed")
         self.stat.inc("spider:task")
-        self.stat.inc("spider:task-%s" % task.name)
+        self.stat.inc(self.stat.format_key("spider:task-%s", task.name))
         if task.network_try_count == 1 and task.task_try_count == 1:
-            self.stat.inc("spider:task-%s-initial" % task.name)
+            self.stat.inc(self.stat.format_key("spider:task-%s-initial", task.name))
 
         # Update traffic statistics
         if res["grab"] and res["grab"].doc:
@@ -563,6 +856,57 @@ class Spider(metaclass=SpiderMetaClass):
             self.stat.inc("spider:download-size", doc.download_size)
             self.stat.inc("spider:upload-size", doc.upload_size)
 
+    def log_task_latency(self, metric, task, value, grab=None):
+        """
+        Add the latency (in seconds) of the task processing stage
+        to the "latency:<metric>" histogram and to histograms broken down
+        by task name, host and proxy (if grab instance is given).
+        """
+        stat = self.stat
+        stat.observe(stat.format_key("latency:%s", metric), value)
+        stat.observe(stat.format_key("latency:%s:task:%s", (metric, task.name)), value)
+        stat.observe(
+            stat.format_key("latency:%s:host:%s", (metric, get_task_host(task))),
+            value,
+        )
+        if grab is not None:
+            proxy = grab.config["proxy"] or "none"
+            stat.observe(stat.format_key("latency:%s:proxy:%s", (metric, proxy)), value)
+
+    def render_latency_stats(self):
+        """
+        Return lines with percentiles of latency histograms.
+
+        Only the most used hosts and proxies are listed.
+        """
+        out = [
+            "Latency (count: %s):" % " / ".join("p%d" % x for x in DEFAULT_PERCENTILES)
+        ]
+        groups = {}
+        for key, hist in self.stat.histograms.items():
+            parts = key.split(":", 3)
+            if parts[0] == "latency":
+                group = tuple(parts[1:3]) if len(parts) == 4 else (parts[1],)
+                groups.setdefault(group, []).append((key, hist))
+        for group, items in sorted(groups.items()):
+            if group[-1] in ("host", "proxy"):
+                items = sorted(items, key=lambda x: x[1].count, reverse=True)
+                items = items[:RENDER_HISTOGRAM_LIMIT]
+            for key, hist in sorted(items, key=lambda x: x[0]):
+                out.append(
+                    "  %s: %d: %s"
+                    % (
+                        key,
+                        hist.count,
+                        " / ".join(
+                            "%.1fms" % (hist.percentile(x) * 1000)
+                            for x in DEFAULT_PERCENTILES
+                        ),
+                    )
+                )
+        out.append("")
+        return out
+
     def process_grab_proxy(self, task, grab):
         """Assign new proxy from proxylist to the task"""
 
@@ -605,31 +949,36 @@ class Spider(metaclass=SpiderMetaClass):
             self.prepare()
             if self.task_queue is None:
                 self.setup_queue()
+            self.lease_extend_time = None
             self.process_initial_urls()
+            # Parser service is started first: process parser service
+            # forks its fork server before other threads are started
             services = [
+                self.parser_service,
                 self.task_dispatcher,
                 self.task_generator_service,
-                self.parser_service,
                 self.network_service,
             ]
             for srv in services:
                 srv.start()
+            self.stat.start_logging()
             while self.work_allowed:
                 try:
-                    exc_info = self.fatal_error_queue.get(True, 0.5)
+                    exc_info = self.fatal_error_queue.get_nowait()
                 except Empty:
                     pass
                 else:
                     # The trackeback of fatal error MUST BE
                     # rendered by the sender
                     raise exc_info[1]
-                if self.is_idle():
-                    for srv in services:
-                        srv.pause()
+                if self.task_router is None:
                     if self.is_idle():
                         break
-                    for srv in services:
-                        srv.resume()
+                elif self.task_router.is_done(self.is_idle):
+                    break
+                # Services wake up the main thread when all work is done
+                # or fatal error happens
+                self.work_counter.wait(IDLE_WAIT_TIMEOUT)
         except KeyboardInterrupt:
             self.interrupted = True
             raise
@@ -650,30 +999,52 @@ class Spider(metaclass=SpiderMetaClass):
             for srv in services:
                 if srv.is_alive():
                     print("The %s has not stopped :(" % srv)
+            self.stat.stop_logging()
             self.stat.print_progress_line()
             self.shutdown()
+            # Worker processes of `SpiderRunner` pass the profiler
+            # to the main process
+            if self.handler_profiler and self.task_router is None:
+                self.handler_profiler.write_report()
+            durable_queue = getattr(self.task_queue, "durable", False)
+            if self.host_scheduler:
+                if durable_queue:
+                    self.host_scheduler.flush(self.task_queue)
+                else:
+                    self.host_scheduler.clear()
             if self.task_queue:
-                self.task_queue.clear()
+                if not durable_queue:
+                    self.task_queue.clear()
                 self.task_queue.close()
+            if self.dedup:
+                self.dedup.close()
+            if self.tracer:
+                self.tracer.close()
             logger.debug("Work done")
 
     def is_idle(self):
-        return (
-            not self.task_generator_service.is_alive()
-            and not self.task_queue.size()
-            and not self.task_dispatcher.input_queue.qsize()
-            and not self.parser_service.input_queue.qsize()
-            and not self.parser_service.is_busy()
-            and not self.network_service.get_active_threads_number()
-            and not self.network_service.is_busy()
-        )
+        """
+        Check that task generator is exhausted and there are no tasks
+        in the task queue or being processed by spider services.
+        """
+        if self.task_generator_service.is_busy():
+            return False
+        # Network worker increments the counter before it takes
+        # the task from the queue, so the task being taken
+        # is either in the queue or counted.
+        with self.work_counter.cond:
+            return (
+                not self.work_counter.value
+                and not self.task_queue.size()
+                and not (self.host_scheduler and self.host_scheduler.size())
+            )
 
     def log_failed_network_result(self, res):
         if res["ok"]:
             msg = "http-%s" % res["grab"].doc.code
         else:
             msg = res["error_abbr"]
-        self.stat.inc("error:%s" % msg)
+        self.stat.inc(self.stat.format_key("error:%s", msg))
 
     def log_rejected_task(self, task, reason):
         if reason == "task-try-count":
@@ -0,0 +1,162 @@
+"""
+Adaptive control of number of concurrent network requests.
+
+The controller follows AIMD (additive increase, multiplicative decrease)
+approach. Results of network requests are collected for `interval`
+seconds. If the share of failed requests (timeouts, connection errors,
+HTTP 429 and 503 responses) is too high or the average latency grows
+too much compared to the best observed latency then the concurrency
+limit is multiplied by `decrease_factor`, otherwise the limit is
+increased by `increase_step`.
+"""
+import logging
+import time
+from threading import Lock
+
+# HTTP codes which mean the server is overloaded or limits the rate
+OVERLOAD_HTTP_CODES = (429, 503)
+# Min. number of results required to change the concurrency limit
+MIN_WINDOW_SIZE = 5
+# The best observed latency slowly follows the current latency
+# to adapt to the permanent changes of network conditions
+BASE_LATENCY_DRIFT = 0.05
+
+logger = logging.getLogger("grab.spider.concurrency")  # pylint: disable=invalid-name
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller of number of active network requests.
+
+    :param min_limit: the concurrency limit is never less than this value
+    :param max_limit: the concurrency limit is never greater than this value
+    :param initial_limit: the concurrency limit at the start,
+        `min_limit` by default
+    :param increase_step: value added to the limit if network works well
+    :param decrease_factor: value the limit is multiplied by
+        if network is overloaded
+    :param error_threshold: max. share of failed requests
+    :param latency_factor: max. ratio of average latency to the best
+        observed latency
+    :param interval: min. time in seconds between limit changes
+    """
+
+    def __init__(
+        self,
+        min_limit=1,
+        max_limit=100,
+        initial_limit=None,
+        increase_step=1,
+        decrease_factor=0.5,
+        error_threshold=0.1,
+        latency_factor=3.0,
+        interval=1.0,
+        stat=None,
+    ):
+        assert 1 <= min_limit <= max_limit
+        assert 0 < decrease_factor < 1
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min_limit if initial_limit is None else initial_limit)
+        self.limit = min(max(self.limit, min_limit), max_limit)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.error_threshold = error_threshold
+        self.latency_factor = latency_factor
+        self.interval = interval
+        self.stat = stat
+        self.lock = Lock()
+        self.active = 0
+        self.base_latency = None
+        self.window_start = time.time()
+        self.reset_window()
+        self.export_limit()
+
+    def reset_window(self):
+        self.window_count = 0
+        self.window_errors = 0
+        self.window_latency = 0
+        # Max. number of active requests during the window
+        self.window_max_active = self.active
+
+    def get_limit(self):
+        return int(self.limit)
+
+    def acquire(self):
+        """
+        Occupy the slot for network request.
+
+        Returns False if the limit of concurrent requests is reached.
+        """
+        with self.lock:
+            if self.active >= int(self.limit):
+                return False
+            self.active += 1
+            self.window_max_active = max(self.window_max_active, self.active)
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    def report(self, is_error, latency=None, now=None):
+        """
+        Register result of network request.
+
+        Returns True if the limit has been increased.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.window_count += 1
+            if is_error:
+                self.window_errors += 1
+            elif latency is not None:
+                self.window_latency += latency
+            if (
+                now - self.window_start >= self.interval
+                and self.window_count >= MIN_WINDOW_SIZE
+            ):
+                return self.adjust(now)
+            return False
+
+    def adjust(self, now):
+        prev_limit = int(self.limit)
+        error_rate = self.window_errors / self.window_count
+        success_count = self.window_count - self.window_errors
+        avg_latency = self.window_latency / success_count if success_count else None
+        if avg_latency is not None:
+            if self.base_latency is None or avg_latency < self.base_latency:
+                self.base_latency = avg_latency
+            else:
+                self.base_latency += (
+                    avg_latency - self.base_latency
+                ) * BASE_LATENCY_DRIFT
+        if error_rate > self.error_threshold or (
+            avg_latency is not None
+            and avg_latency > self.base_latency * self.latency_factor
+        ):
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            if self.stat:
+                self.stat.inc("spider:concurrency-decrease")
+        elif self.window_max_active >= prev_limit:
+            # Increase the limit only if the current limit was reached,
+            # otherwise there is no evidence the higher limit is useful
+            self.limit = min(self.max_limit, self.limit + self.increase_step)
+            if self.stat:
+                self.stat.inc("spider:concurrency-increase")
+        self.window_start = now
+        self.reset_window()
+        if int(self.limit) != prev_limit:
+            logger.debug(
+                "Concurrency limit changed: %d -> %d (error rate: %.2f)",
+                prev_limit,
+                int(self.limit),
+                error_rate,
+            )
+        self.export_limit()
+        return int(self.limit) > prev_limit
+
+    def export_limit(self):
+        if self.stat:
+            self.stat.set("spider:concurrency", int(self.limit))
@@ -3,6 +3,19 @@ import functools
 from grab.error import ResponseNotValid
 
 
+def call_integrity_func(spider, func, grab):
+    """
+    Call the integrity function, measure it if profiling of handlers
+    is enabled.
+    """
+    profiler = getattr(spider, "handler_profiler", None)
+    if profiler is None:
+        func(grab)
+    else:
+        with profiler.measure("integrity:%s" % getattr(func, "__name__", "NONE")):
+            func(grab)
+
+
 def integrity(integrity_func, retry_errors=(ResponseNotValid,)):
     """
     Args:
@@ -20,9 +33,9 @@ def integrity(integrity_func, retry_errors=(ResponseNotValid,)):
             try:
                 for int_func in int_funcs:
                     if isinstance(int_func, str):
-                        getattr(self, int_func)(grab)
+                        call_integrity_func(self, getattr(self, int_func), grab)
                     else:
-                        int_func(grab)
+                        call_integrity_func(self, int_func, grab)
             except retry_errors as ex:
                 yield task.clone()
                 error_code = ex.__class__.__name__.replace("_", "-")
@@ -0,0 +1,47 @@
+"""
+DedupInterface defines interface of backend storing fingerprints
+of tasks which have been added to the task queue.
+"""
+from hashlib import sha1
+
+from grab.util.http import DEFAULT_TRACKING_PARAMS, canonicalize_url
+
+
+def get_task_fingerprint(task, tracking_params=DEFAULT_TRACKING_PARAMS):
+    """
+    Return 20-bytes fingerprint of the task.
+
+    Fingerprint is built from the canonical form of the task URL,
+    HTTP method and POST data.
+    """
+    parts = [canonicalize_url(task.url, tracking_params)]
+    config = task.grab_config
+    if config:
+        post = config.get("post") or config.get("multipart_post")
+        if config.get("method") or post:
+            parts.append(config.get("method") or "POST")
+            parts.append(repr(post))
+    return sha1("\n".join(parts).encode("utf-8")).digest()
+
+
+class DedupInterface:
+    def __init__(self, spider_name, **kwargs):
+        pass
+
+    def add(self, fingerprint):
+        """
+        Save fingerprint.
+
+        Return False if the fingerprint has been already saved.
+        """
+        raise NotImplementedError
+
+    def size(self):
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all fingerprints."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
@@ -0,0 +1,104 @@
+"""
+Scalable Bloom filter of task fingerprints
+
+The filter uses constant memory per fingerprint (about 2 bytes for
+0.001 error rate) instead of storing fingerprints themselves. Some new
+tasks could be considered as duplicates with probability close to
+`error_rate`, a duplicated task is never considered as new one.
+
+When the current filter is filled up to its capacity, new filter with
+`growth_factor` times larger capacity and `tightening_ratio` times lower
+error rate is added, so the total error rate stays below `error_rate`.
+"""
+import math
+from threading import Lock
+
+from grab.spider.dedup_backend.base import DedupInterface
+
+DEFAULT_INITIAL_CAPACITY = 100000
+DEFAULT_ERROR_RATE = 0.001
+
+
+class BloomFilter:
+    __slots__ = ("capacity", "count", "num_bits", "num_hashes", "bits")
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.count = 0
+        self.num_bits = int(
+            math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def get_positions(self, fingerprint):
+        # Double hashing: k hash functions are built from two hashes
+        hash1 = int.from_bytes(fingerprint[:8], "little")
+        hash2 = int.from_bytes(fingerprint[8:16], "little") | 1
+        return [(hash1 + idx * hash2) % self.num_bits for idx in range(self.num_hashes)]
+
+    def contains(self, positions):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions)
+
+    def add(self, positions):
+        bits = self.bits
+        for pos in positions:
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+
+class DedupBackend(DedupInterface):
+    def __init__(
+        self,
+        spider_name,
+        initial_capacity=DEFAULT_INITIAL_CAPACITY,
+        error_rate=DEFAULT_ERROR_RATE,
+        growth_factor=2,
+        tightening_ratio=0.5,
+        **kwargs
+    ):
+        super().__init__(spider_name, **kwargs)
+        assert 0 < error_rate < 1
+        assert 0 < tightening_ratio < 1
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth_factor = growth_factor
+        self.tightening_ratio = tightening_ratio
+        self.lock = Lock()
+        self.filters = []
+        self.add_filter()
+
+    def add_filter(self):
+        if self.filters:
+            capacity = self.filters[-1].capacity * self.growth_factor
+        else:
+            capacity = self.initial_capacity
+        # Sum of error rates of all filters is a geometric series
+        # which converges to `error_rate`
+        error_rate = (
+            self.error_rate
+            * (1 - self.tightening_ratio)
+            * self.tightening_ratio ** len(self.filters)
+        )
+        self.filters.append(BloomFilter(capacity, error_rate))
+
+    def add(self, fingerprint):
+        with self.lock:
+            for bfilter in self.filters:
+                if bfilter.contains(bfilter.get_positions(fingerprint)):
+                    return False
+            bfilter = self.filters[-1]
+            if bfilter.count >= bfilter.capacity:
+                self.add_filter()
+                bfilter = self.filters[-1]
+            bfilter.add(bfilter.get_positions(fingerprint))
+            return True
+
+    def size(self):
+        return sum(x.count for x in self.filters)
+
+    def clear(self):
+        with self.lock:
+            self.filters = []
+            self.add_filter()
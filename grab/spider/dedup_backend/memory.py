@@ -0,0 +1,27 @@
+"""
+Exact set of task fingerprints kept in memory
+"""
+from threading import Lock
+
+from grab.spider.dedup_backend.base import DedupInterface
+
+
+class DedupBackend(DedupInterface):
+    def __init__(self, spider_name, **kwargs):
+        super().__init__(spider_name, **kwargs)
+        self.fingerprints = set()
+        self.lock = Lock()
+
+    def add(self, fingerprint):
+        with self.lock:
+            if fingerprint in self.fingerprints:
+                return False
+            self.fingerprints.add(fingerprint)
+            return True
+
+    def size(self):
+        return len(self.fingerprints)
+
+    def clear(self):
+        with self.lock:
+            self.fingerprints = set()
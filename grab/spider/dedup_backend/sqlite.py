@@ -0,0 +1,89 @@
+"""
+Task fingerprints stored in SQLite database
+
+The fingerprints survive restarts of the spider, so tasks processed
+by the previous runs are not fetched again. New fingerprints are committed
+once per `commit_interval` additions or once per `commit_timeout` seconds.
+"""
+import logging
+import sqlite3
+import time
+from threading import Lock
+
+from grab.spider.dedup_backend.base import DedupInterface
+
+# Number of added fingerprints after which the transaction is committed
+DEFAULT_COMMIT_INTERVAL = 1000
+# Max. number of seconds between commits
+DEFAULT_COMMIT_TIMEOUT = 1
+
+logger = logging.getLogger(  # pylint: disable=invalid-name
+    "grab.spider.dedup_backend.sqlite"
+)
+
+
+class DedupBackend(DedupInterface):
+    def __init__(
+        self,
+        spider_name,
+        path,
+        table_name=None,
+        commit_interval=DEFAULT_COMMIT_INTERVAL,
+        commit_timeout=DEFAULT_COMMIT_TIMEOUT,
+        **kwargs
+    ):
+        super().__init__(spider_name, **kwargs)
+        if table_name is None:
+            table_name = "dedup_%s" % spider_name
+        self.path = path
+        self.table_name = table_name
+        self.commit_interval = commit_interval
+        self.commit_timeout = commit_timeout
+        self.pending = 0
+        self.commit_time = time.time()
+        self.lock = Lock()
+        # Connection is used by all threads under the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS "%s" (fingerprint BLOB PRIMARY KEY)'
+            " WITHOUT ROWID" % self.table_name
+        )
+        self.connection.commit()
+        logger.debug("Using table %s of database %s", self.table_name, self.path)
+
+    def add(self, fingerprint):
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO "%s" VALUES (?)' % self.table_name,
+                (fingerprint,),
+            )
+            if not cursor.rowcount:
+                return False
+            self.pending += 1
+            if (
+                self.pending >= self.commit_interval
+                or time.time() - self.commit_time >= self.commit_timeout
+            ):
+                self.commit()
+            return True
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+        self.commit_time = time.time()
+
+    def size(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM "%s"' % self.table_name
+            ).fetchone()[0]
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM "%s"' % self.table_name)
+            self.commit()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.connection.close()
@@ -4,7 +4,7 @@ from grab.error import GrabError
 
 __all__ = ('SpiderError', 'SpiderMisuseError', 'FatalError',
            'SpiderInternalError',
-           'NoTaskHandler', 'NoDataHandler',
+           'NoTaskHandler', 'NoDataHandler', 'ParserProcessError',
            )
 
 
@@ -43,3 +43,10 @@ class NoDataHandler(SpiderError):
     Used then it is not possible to find which
     handler should be used to process Data object.
     """
+
+
+class ParserProcessError(SpiderError):
+    """
+    Used then parser process has died while processing
+    the network response.
+    """
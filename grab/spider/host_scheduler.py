@@ -0,0 +1,249 @@
+"""
+Per-host scheduler of spider tasks.
+
+The scheduler takes tasks from the task queue and groups them by host
+of the task URL. The task is passed to the network service only if its
+host has free slot for concurrent request and the minimal delay since
+the previous request to that host has passed. Tasks of other hosts
+are processed meanwhile.
+
+Buffered tasks keep leases of the task queue, the spider extends them
+as leases of other tasks in progress.
+"""
+import heapq
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from itertools import count
+from queue import Empty
+from threading import Lock
+from urllib.parse import urlsplit
+
+from grab.spider.error import SpiderMisuseError
+
+# Max. number of tasks taken from the task queue by one `get_task` call
+DEFAULT_PULL_BATCH_SIZE = 10
+# Max. number of tasks kept by the scheduler
+DEFAULT_BUFFER_SIZE = 1000
+# Max. number of tasks kept by the scheduler for one host, other
+# tasks of that host are returned to the task queue as delayed tasks
+DEFAULT_HOST_BUFFER_SIZE = 100
+# Min. delay of task returned to the task queue
+DEFAULT_DEFER_TIME = 1
+
+
+def get_task_host(task):
+    return (urlsplit(task.url).hostname or "").lower()
+
+
+class HostState:
+    __slots__ = ("host", "concurrency", "delay", "tasks", "active", "next_time")
+
+    def __init__(self, host, concurrency, delay):
+        self.host = host
+        self.concurrency = concurrency
+        self.delay = delay
+        self.tasks = deque()
+        self.active = 0
+        self.next_time = 0
+
+    def is_available(self):
+        """
+        Check that the host has tasks and free slot to process them.
+        """
+        return bool(self.tasks) and (
+            not self.concurrency or self.active < self.concurrency
+        )
+
+
+class HostScheduler:
+    """
+    Schedule tasks of each host with concurrency and rate limits.
+
+    :param concurrency: max. number of concurrent requests to one host,
+        None or 0 means no limit
+    :param delay: min. number of seconds between starts of requests
+        to one host
+    :param domains: dict of per-domain settings which overrides default
+        `concurrency` and `delay` values, e.g.
+        {"example.com": {"concurrency": 1, "delay": 2}}. The settings
+        of domain are applied to its subdomains too.
+    """
+
+    def __init__(
+        self,
+        concurrency=None,
+        delay=0,
+        domains=None,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        host_buffer_size=DEFAULT_HOST_BUFFER_SIZE,
+        pull_batch_size=DEFAULT_PULL_BATCH_SIZE,
+    ):
+        self.concurrency = concurrency
+        self.delay = delay
+        self.domains = {}
+        for domain, rule in (domains or {}).items():
+            self.domains[domain.lower().lstrip(".")] = rule
+        self.buffer_size = buffer_size
+        self.host_buffer_size = host_buffer_size
+        self.pull_batch_size = pull_batch_size
+        self.lock = Lock()
+        self.hosts = {}
+        # Heap of (next_time, sequence_number, host) items for hosts
+        # which have tasks and free slots
+        self.ready_hosts = []
+        self.ready_counter = count()
+        self.buffered = 0
+        # Number of tasks returned to the task queue
+        self.deferred = 0
+
+    def get_host_rule(self, host):
+        """
+        Return (concurrency, delay) settings of the host.
+        """
+        domain = host
+        while True:
+            rule = self.domains.get(domain)
+            if rule is not None:
+                return (
+                    rule.get("concurrency", self.concurrency),
+                    rule.get("delay", self.delay),
+                )
+            if "." not in domain:
+                return self.concurrency, self.delay
+            domain = domain.split(".", 1)[1]
+
+    def get_host_state(self, host):
+        try:
+            return self.hosts[host]
+        except KeyError:
+            state = self.hosts[host] = HostState(host, *self.get_host_rule(host))
+            return state
+
+    def push_ready_host(self, state):
+        heapq.heappush(
+            self.ready_hosts, (state.next_time, next(self.ready_counter), state.host)
+        )
+
+    def pull_tasks(self, queue):
+        """
+        Move tasks from the task queue to host buffers.
+        """
+        for _ in range(self.pull_batch_size):
+            if self.buffered >= self.buffer_size:
+                return
+            try:
+                task = queue.get()
+            except Empty:
+                return
+            state = self.get_host_state(get_task_host(task))
+            if len(state.tasks) >= self.host_buffer_size and self.defer_task(
+                queue, task, state
+            ):
+                continue
+            was_available = state.is_available()
+            state.tasks.append(task)
+            self.buffered += 1
+            if not was_available and state.is_available():
+                self.push_ready_host(state)
+
+    def defer_task(self, queue, task, state):
+        """
+        Return the task of the host with full buffer back to the task queue.
+
+        The task is delayed to let the spider process tasks of other hosts.
+        Returns False if the task queue does not support delayed tasks.
+        """
+        defer_time = max(DEFAULT_DEFER_TIME, state.delay * len(state.tasks))
+        lease, task.lease = task.lease, None
+        try:
+            queue.put(
+                task,
+                task.priority,
+                schedule_time=datetime.utcnow() + timedelta(seconds=defer_time),
+            )
+        except SpiderMisuseError:
+            task.lease = lease
+            return False
+        if lease is not None:
+            queue.ack(lease)
+        self.deferred += 1
+        return True
+
+    def get_task(self, queue):
+        """
+        Return task which could be processed right now or None.
+
+        The returned task must be released with `release` method
+        when its network request is completed.
+        """
+        with self.lock:
+            self.pull_tasks(queue)
+            now = time.time()
+            while self.ready_hosts:
+                next_time, _, host = self.ready_hosts[0]
+                if next_time > now:
+                    return None
+                heapq.heappop(self.ready_hosts)
+                state = self.hosts[host]
+                if not state.is_available():
+                    # Outdated item
+                    continue
+                task = state.tasks.popleft()
+                self.buffered -= 1
+                state.active += 1
+                state.next_time = now + state.delay
+                if state.is_available():
+                    self.push_ready_host(state)
+                return task
+            return None
+
+    def release(self, task):
+        """
+        Release the slot of the host occupied by the task.
+        """
+        with self.lock:
+            state = self.hosts.get(get_task_host(task))
+            if state is None or not state.active:
+                return
+            was_available = state.is_available()
+            state.active -= 1
+            if not was_available and state.is_available():
+                self.push_ready_host(state)
+            elif (
+                not state.active and not state.tasks and state.next_time <= time.time()
+            ):
+                # Forget the host only if its delay has passed
+                del self.hosts[state.host]
+
+    def get_wait_time(self):
+        """
+        Return number of seconds until some host gets ready or None
+        if there are no hosts which wait for delay.
+        """
+        with self.lock:
+            if not self.ready_hosts:
+                return None
+            return max(0, self.ready_hosts[0][0] - time.time())
+
+    def size(self):
+        return self.buffered
+
+    def flush(self, queue):
+        """
+        Return all buffered tasks to the task queue.
+        """
+        with self.lock:
+            for state in self.hosts.values():
+                for task in state.tasks:
+                    lease, task.lease = task.lease, None
+                    queue.put(task, task.priority)
+                    if lease is not None:
+                        queue.ack(lease)
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.hosts = {}
+            self.ready_hosts = []
+            self.buffered = 0
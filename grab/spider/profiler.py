@@ -0,0 +1,275 @@
+"""
+Profiling of spider task handlers.
+
+The profiler measures wall and CPU time of each call of task handlers
+and integrity functions (see `grab.spider.decorators.integrity`). Wall
+time of the handler includes the time of its integrity functions and does
+not include the time spent by the spider to process items yielded by the
+handler. Random calls are run under cProfile, profiles of the slowest
+of them are kept and aggregated in the report written at the end of
+the spider work.
+"""
+import cProfile
+import heapq
+import io
+import logging
+import pstats
+import random
+import time
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock
+
+# Number of functions of aggregated profile listed in the report
+REPORT_FUNCTION_NUMBER = 20
+
+logger = logging.getLogger("grab.spider.profiler")  # pylint: disable=invalid-name
+
+
+class ProfileSnapshot:
+    """
+    Profile of one call which could be loaded by `pstats.Stats`.
+    """
+
+    def __init__(self, wall_time, stats):
+        self.wall_time = wall_time
+        self.stats = stats
+
+    def create_stats(self):
+        # Called by `pstats.Stats`, stats are already created
+        pass
+
+
+class HandlerStats:
+    """
+    Timings of calls of one handler and profiles of its slowest calls.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_time = 0
+        self.cpu_time = 0
+        self.max_wall_time = 0
+        # Heap of (wall_time, seq, snapshot) items
+        self.snapshots = []
+
+
+class HandlerCall:
+    """
+    Measurement of one call of the handler which could be paused
+    e.g. while the caller processes items yielded by the handler.
+    """
+
+    __slots__ = ("profiler", "name", "profile", "wall_time", "cpu_time", "started")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.profile = profiler.start_profile()
+        self.wall_time = 0
+        self.cpu_time = 0
+        # (wall, cpu) time of the start of measured period
+        self.started = None
+
+    def resume(self):
+        if self.profile is not None:
+            self.profile.enable()
+        self.started = time.perf_counter(), time.thread_time()
+
+    def pause(self):
+        wall_started, cpu_started = self.started
+        self.wall_time += time.perf_counter() - wall_started
+        self.cpu_time += time.thread_time() - cpu_started
+        self.started = None
+        if self.profile is not None:
+            self.profile.disable()
+
+    def finish(self):
+        if self.started is not None:
+            self.pause()
+        snapshot = None
+        if self.profile is not None:
+            self.profiler.profile_lock.release()
+            self.profile.create_stats()
+            snapshot = ProfileSnapshot(self.wall_time, self.profile.stats)
+        self.profiler.add_call(self.name, self.wall_time, self.cpu_time, snapshot)
+
+
+class HandlerProfiler:
+    """
+    Collects timings and profiles of task handlers.
+
+    :param profile_rate: share of calls which are run under cProfile,
+        from 0 to 1
+    :param snapshot_number: number of profiles of the slowest calls kept
+        for each handler
+    :param path: the report is written to this file, otherwise it is
+        logged by "grab.spider.profiler" logger
+    """
+
+    def __init__(self, profile_rate=0, snapshot_number=5, path=None):
+        self.profile_rate = profile_rate
+        self.snapshot_number = snapshot_number
+        self.path = path
+        self.lock = Lock()
+        # Only one call is profiled at a time
+        self.profile_lock = Lock()
+        self.seq = count()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.handlers = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        del state["profile_lock"]
+        del state["seq"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+        self.profile_lock = Lock()
+        self.seq = count()
+
+    def start_profile(self):
+        if (
+            self.profile_rate
+            and random.random() < self.profile_rate
+            and self.profile_lock.acquire(blocking=False)
+        ):
+            return cProfile.Profile()
+        return None
+
+    def start_call(self, name):
+        """
+        Return new `HandlerCall` of the handler `name`.
+        """
+        return HandlerCall(self, name)
+
+    @contextmanager
+    def measure(self, name):
+        """
+        Measure the time of the code block run by the handler `name`.
+        """
+        call = self.start_call(name)
+        call.resume()
+        try:
+            yield
+        finally:
+            call.finish()
+
+    def iterate_call(self, name, func, *args):
+        """
+        Call `func` run by the handler `name` and yield items of its result.
+
+        Time spent by the caller to process the yielded items is not
+        measured.
+        """
+        call = self.start_call(name)
+        call.resume()
+        try:
+            result = func(*args)
+            if result is None:
+                return
+            iterator = iter(result)
+            while True:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                call.pause()
+                yield item
+                call.resume()
+        finally:
+            call.finish()
+
+    def add_call(self, name, wall_time, cpu_time, snapshot=None):
+        with self.lock:
+            stats = self.handlers.get(name)
+            if stats is None:
+                stats = self.handlers[name] = HandlerStats()
+            stats.calls += 1
+            stats.wall_time += wall_time
+            stats.cpu_time += cpu_time
+            stats.max_wall_time = max(stats.max_wall_time, wall_time)
+            if snapshot is not None:
+                self.add_snapshot(stats, snapshot)
+
+    def add_snapshot(self, stats, snapshot):
+        item = (snapshot.wall_time, next(self.seq), snapshot)
+        if len(stats.snapshots) < self.snapshot_number:
+            heapq.heappush(stats.snapshots, item)
+        elif stats.snapshots and item[0] > stats.snapshots[0][0]:
+            heapq.heapreplace(stats.snapshots, item)
+
+    def merge(self, other):
+        """
+        Add timings and profiles collected by other profiler
+        e.g. in other process.
+        """
+        with self.lock:
+            for name, other_stats in other.handlers.items():
+                stats = self.handlers.get(name)
+                if stats is None:
+                    stats = self.handlers[name] = HandlerStats()
+                stats.calls += other_stats.calls
+                stats.wall_time += other_stats.wall_time
+                stats.cpu_time += other_stats.cpu_time
+                stats.max_wall_time = max(
+                    stats.max_wall_time, other_stats.max_wall_time
+                )
+                for _, _, snapshot in other_stats.snapshots:
+                    self.add_snapshot(stats, snapshot)
+
+    def render_report(self):
+        with self.lock:
+            handlers = sorted(
+                self.handlers.items(), key=lambda x: x[1].wall_time, reverse=True
+            )
+        out = [
+            "Handler profiling (seconds):",
+            "  %-30s %8s %10s %10s %10s %10s %10s"
+            % ("handler", "calls", "wall", "wall avg", "wall max", "cpu", "cpu avg"),
+        ]
+        for name, stats in handlers:
+            out.append(
+                "  %-30s %8d %10.3f %10.4f %10.4f %10.3f %10.4f"
+                % (
+                    name,
+                    stats.calls,
+                    stats.wall_time,
+                    stats.wall_time / stats.calls,
+                    stats.max_wall_time,
+                    stats.cpu_time,
+                    stats.cpu_time / stats.calls,
+                )
+            )
+        for name, stats in handlers:
+            if stats.snapshots:
+                snapshots = [x[2] for x in sorted(stats.snapshots, reverse=True)]
+                out.append("")
+                out.append(
+                    "Profile of %d slowest profiled calls of %s (%s):"
+                    % (
+                        len(snapshots),
+                        name,
+                        ", ".join("%.4fs" % x.wall_time for x in snapshots),
+                    )
+                )
+                stream = io.StringIO()
+                pstats.Stats(*snapshots, stream=stream).sort_stats(
+                    "cumulative"
+                ).print_stats(REPORT_FUNCTION_NUMBER)
+                out.append(stream.getvalue().strip("\n"))
+        return "\n".join(out) + "\n"
+
+    def write_report(self):
+        report = self.render_report()
+        if self.path:
+            with open(self.path, "w", encoding="utf-8") as out:
+                out.write(report)
+        else:
+            logger.info(report)
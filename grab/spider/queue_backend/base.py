@@ -1,9 +1,45 @@
 """
 QueueInterface defines interface of queue backend.
 """
+import calendar
+
+from grab.spider.queue_backend.codec import TaskCodec
+
+# Codec used by default by backends which serialize tasks
+DEFAULT_TASK_CODEC = TaskCodec()
+
+
+def datetime_to_timestamp(value):
+    """
+    Convert naive datetime in UTC timezone to unix timestamp.
+    """
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1000000
+
+
+def pack_task(task):
+    """
+    Serialize task into compact payload with the default codec.
+    """
+    return DEFAULT_TASK_CODEC.encode(task)
+
+
+def unpack_task(data):
+    """
+    Build task from the payload created with `pack_task`.
+    """
+    return DEFAULT_TASK_CODEC.decode(data)
 
 
 class QueueInterface:
+    # Durable queue keeps tasks when the spider stops,
+    # next run of the spider continues to process them
+    durable = False
+    # Shared queue could be used by several spider processes at once
+    shared = False
+    # Number of seconds after which the unacknowledged task returns
+    # to the queue, None if the backend does not lease tasks
+    visibility_timeout = None
+
     def __init__(self, spider_name, **kwargs):
         pass
 
@@ -19,6 +55,36 @@ class QueueInterface:
         """
         raise NotImplementedError
 
+    def ack(self, lease):
+        """
+        Confirm that the task taken with the given lease has been processed.
+
+        Backends which support leases set `lease` attribute of the task
+        returned by `get`. Unacknowledged task returns to the queue
+        when its visibility timeout expires. Other backends remove the task
+        from the queue in `get` and ignore this call.
+        """
+
+    def extend_leases(self):
+        """
+        Restart visibility timeout of all leases taken by this queue object
+        which have not been acknowledged yet.
+
+        The spider calls it periodically, so tasks which are still being
+        processed do not return to the queue.
+        """
+
+    def get_next_schedule_time(self):
+        """
+        Return the earliest schedule time (naive datetime in UTC) of delayed
+        tasks or None if there are no delayed tasks or the backend could not
+        tell it cheaply.
+
+        The spider uses it to wake up network workers when delayed task
+        becomes ready.
+        """
+        return None
+
     def size(self):
         raise NotImplementedError
 
@@ -0,0 +1,287 @@
+"""
+Serialization of tasks stored by queue backends
+
+Payload starts with three bytes header: format version, serializer and
+compression. The state of the task is converted into plain JSON/msgpack
+values: datetimes, tuples, bytes and cookies of grab config are stored
+as tagged values, cookies are stored as compact lists of attributes.
+Values of other types (callbacks, custom objects in task attributes) are
+pickled. Attributes of the task which have default values are not saved.
+
+Payloads created by previous versions of queue backends (pickled task)
+are still decoded.
+"""
+import json
+import pickle
+import zlib
+from base64 import b64decode, b64encode
+from datetime import datetime
+from http.cookiejar import Cookie
+from operator import attrgetter
+
+from grab.spider.error import SpiderError, SpiderMisuseError
+from grab.spider.task import Task
+
+FORMAT_VERSION = 1
+# Payloads larger than this number of bytes are compressed
+COMPRESS_THRESHOLD = 512
+DEFAULT_TASK_STATE = Task("task", url="http://example.com/").__getstate__()
+# Usual values of Cookie constructor arguments (see `grab.cookie.create_cookie`),
+# only arguments which have other values are saved
+COOKIE_DEFAULTS = {
+    "version": 0,
+    "port": None,
+    "port_specified": False,
+    "domain_specified": True,
+    "domain_initial_dot": False,
+    "path": "/",
+    "path_specified": True,
+    "secure": False,
+    "expires": None,
+    "discard": True,
+    "comment": None,
+    "comment_url": None,
+    "rest": {"HttpOnly": None},
+    "rfc2109": False,
+}
+COOKIE_DEFAULT_VALUES = tuple(COOKIE_DEFAULTS.values())
+# Cookie object stores "rest" argument in "_rest" attribute
+get_cookie_values = attrgetter(  # pylint: disable=invalid-name
+    *["_rest" if x == "rest" else x for x in COOKIE_DEFAULTS]
+)
+# First byte of pickled task saved by previous versions
+LEGACY_PICKLE_PREFIX = b"\x80"
+
+
+class JsonSerializer:
+    code = 1
+    native_bytes = False
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode(
+            "utf-8"
+        )
+
+    def loads(self, data):
+        return json.loads(data.decode("utf-8"))
+
+
+class MsgpackSerializer:
+    code = 2
+    native_bytes = True
+
+    def __init__(self):
+        import msgpack  # pylint: disable=import-outside-toplevel
+
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+class ZlibCompressor:
+    code = 1
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCompressor:
+    code = 2
+
+    def __init__(self, level=3):
+        import zstandard  # pylint: disable=import-outside-toplevel
+
+        self.zstandard = zstandard
+        self.level = level
+
+    def compress(self, data):
+        return self.zstandard.compress(data, self.level)
+
+    def decompress(self, data):
+        return self.zstandard.decompress(data)
+
+
+SERIALIZERS = {"json": JsonSerializer, "msgpack": MsgpackSerializer}
+COMPRESSORS = {"zlib": ZlibCompressor, "zstd": ZstdCompressor}
+SERIALIZER_CODES = {cls.code: cls for cls in SERIALIZERS.values()}
+COMPRESSOR_CODES = {cls.code: cls for cls in COMPRESSORS.values()}
+
+
+def encode_value(value, native_bytes):
+    """
+    Convert the value into plain JSON/msgpack value.
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, list):
+        return [encode_value(x, native_bytes) for x in value]
+    if isinstance(value, dict):
+        if all(isinstance(x, str) and not x.startswith("$") for x in value):
+            return {key: encode_value(val, native_bytes) for key, val in value.items()}
+        return {
+            "$d": [
+                [encode_value(key, native_bytes), encode_value(val, native_bytes)]
+                for key, val in value.items()
+            ]
+        }
+    if isinstance(value, bytes) and native_bytes:
+        return value
+    return encode_tagged_value(value, native_bytes)
+
+
+def encode_tagged_value(value, native_bytes):
+    if isinstance(value, bytes):
+        return {"$b": b64encode(value).decode("ascii")}
+    if isinstance(value, tuple):
+        return {"$t": [encode_value(x, native_bytes) for x in value]}
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, Cookie):
+        return {"$c": encode_cookie(value, native_bytes)}
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    return {"$p": encode_value(data, native_bytes)}
+
+
+def encode_cookie(cookie, native_bytes):
+    """
+    Return [name, value, domain, {other_non_default_arguments}] list.
+    """
+    values = get_cookie_values(cookie)
+    if values == COOKIE_DEFAULT_VALUES:
+        return [cookie.name, cookie.value, cookie.domain, {}]
+    options = {
+        key: encode_value(val, native_bytes)
+        for key, val, default in zip(COOKIE_DEFAULTS, values, COOKIE_DEFAULT_VALUES)
+        if val != default
+    }
+    return [cookie.name, cookie.value, cookie.domain, options]
+
+
+def decode_cookie(value):
+    name, cookie_value, domain, options = value
+    kwargs = dict(COOKIE_DEFAULTS, rest=dict(COOKIE_DEFAULTS["rest"]))
+    if options:
+        kwargs.update(decode_value(options))
+    return Cookie(name=name, value=cookie_value, domain=domain, **kwargs)
+
+
+def decode_value(value):
+    """
+    Restore the value converted with `encode_value`.
+    """
+    if isinstance(value, list):
+        return [decode_value(x) for x in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        key = next(iter(value))
+        if key.startswith("$"):
+            return decode_tagged_value(key, value[key])
+    return {key: decode_value(val) for key, val in value.items()}
+
+
+def decode_tagged_value(tag, value):
+    if tag == "$d":
+        return {decode_value(key): decode_value(val) for key, val in value}
+    if tag == "$b":
+        return b64decode(value)
+    if tag == "$t":
+        return tuple(decode_value(x) for x in value)
+    if tag == "$dt":
+        return datetime.fromisoformat(value)
+    if tag == "$c":
+        return decode_cookie(value)
+    if tag == "$p":
+        return pickle.loads(decode_value(value))
+    raise SpiderError("Unknown tag of task payload value: %s" % tag)
+
+
+class TaskCodec:
+    """
+    Encode tasks into bytes and decode them back.
+
+    :param serializer: "json" (default) or "msgpack" (requires msgpack
+        package)
+    :param compression: "zlib" (default), "zstd" (requires zstandard
+        package) or None
+    :param compress_threshold: payloads larger than this number of bytes
+        are compressed
+    """
+
+    def __init__(
+        self,
+        serializer="json",
+        compression="zlib",
+        compress_threshold=COMPRESS_THRESHOLD,
+    ):
+        if serializer not in SERIALIZERS:
+            raise SpiderMisuseError("Unknown task serializer: %s" % serializer)
+        if compression is not None and compression not in COMPRESSORS:
+            raise SpiderMisuseError("Unknown task compression: %s" % compression)
+        self.serializer = SERIALIZERS[serializer]()
+        self.compressor = None if compression is None else COMPRESSORS[compression]()
+        self.compress_threshold = compress_threshold
+        # Serializers and compressors of decoded payloads by their codes
+        self.serializers = {self.serializer.code: self.serializer}
+        self.compressors = {}
+        if self.compressor is not None:
+            self.compressors[self.compressor.code] = self.compressor
+
+    def encode(self, task):
+        state = {
+            key: encode_value(val, self.serializer.native_bytes)
+            for key, val in task.__getstate__().items()
+            if key not in DEFAULT_TASK_STATE or DEFAULT_TASK_STATE[key] != val
+        }
+        data = self.serializer.dumps(state)
+        compression = 0
+        if self.compressor is not None and len(data) > self.compress_threshold:
+            data = self.compressor.compress(data)
+            compression = self.compressor.code
+        return bytes((FORMAT_VERSION, self.serializer.code, compression)) + data
+
+    def decode(self, data):
+        data = bytes(data)
+        if data[:1] == LEGACY_PICKLE_PREFIX:
+            return pickle.loads(data)
+        if data[0] != FORMAT_VERSION:
+            raise SpiderError("Unsupported version of task payload: %d" % data[0])
+        serializer = self.get_serializer(data[1])
+        body = data[3:]
+        if data[2]:
+            body = self.get_compressor(data[2]).decompress(body)
+        state = serializer.loads(body)
+        return build_task({key: decode_value(val) for key, val in state.items()})
+
+    def get_serializer(self, code):
+        if code not in self.serializers:
+            if code not in SERIALIZER_CODES:
+                raise SpiderError("Unknown serializer of task payload: %d" % code)
+            self.serializers[code] = SERIALIZER_CODES[code]()
+        return self.serializers[code]
+
+    def get_compressor(self, code):
+        if code not in self.compressors:
+            if code not in COMPRESSOR_CODES:
+                raise SpiderError("Unknown compression of task payload: %d" % code)
+            self.compressors[code] = COMPRESSOR_CODES[code]()
+        return self.compressors[code]
+
+
+def build_task(state):
+    task = Task.__new__(Task)
+    # Default values of task attributes are immutable
+    task_state = dict(DEFAULT_TASK_STATE)
+    task_state.update(state)
+    task.__setstate__(task_state)
+    return task
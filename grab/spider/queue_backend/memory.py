@@ -1,39 +1,98 @@
+import heapq
+import time
 from datetime import datetime
+from itertools import count
 from queue import Empty, PriorityQueue
+from threading import Lock
 
 from grab.spider.queue_backend.base import QueueInterface
 
+# Max. number of delayed tasks moved to the main queue by one `get` call
+SCHEDULE_BATCH_SIZE = 1000
+# Number of seconds after which the unacknowledged task returns to the queue
+DEFAULT_VISIBILITY_TIMEOUT = 600
+
 
 class QueueBackend(QueueInterface):
-    def __init__(self, spider_name, **kwargs):
+    def __init__(
+        self, spider_name, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, **kwargs
+    ):
         super().__init__(spider_name, **kwargs)
         self.queue_object = PriorityQueue()
+        # Heap of (schedule_time, sequence_number, task) items
+        # The sequence number keeps order of tasks with same schedule time
+        # and prevents comparison of task objects
         self.schedule_list = []
+        self.schedule_counter = count()
+        self.schedule_lock = Lock()
+        self.visibility_timeout = visibility_timeout
+        # Tasks taken from the queue and not acknowledged yet,
+        # {lease: (deadline, priority, task)} in order of deadlines
+        self.leases = {}
+        self.lease_counter = count(1)
+        self.lease_lock = Lock()
 
     def put(self, task, priority, schedule_time=None):
         if schedule_time is None:
             self.queue_object.put((priority, task))
         else:
-            self.schedule_list.append((schedule_time, task))
+            with self.schedule_lock:
+                heapq.heappush(
+                    self.schedule_list,
+                    (schedule_time, next(self.schedule_counter), task),
+                )
 
     def get(self):
-        now = datetime.utcnow()
-
-        removed_indexes = []
-        index = 0
-        for schedule_time, task in self.schedule_list:
-            if schedule_time <= now:
-                self.put(task, 1)
-                removed_indexes.append(index)
-            index += 1
+        if self.schedule_list:
+            now = datetime.utcnow()
+            with self.schedule_lock:
+                for _ in range(SCHEDULE_BATCH_SIZE):
+                    if not self.schedule_list or self.schedule_list[0][0] > now:
+                        break
+                    _, _, task = heapq.heappop(self.schedule_list)
+                    self.put(task, 1)
 
-        self.schedule_list = [
-            x for idx, x in enumerate(self.schedule_list) if idx not in removed_indexes
-        ]
+        now = time.time()
+        if self.leases:
+            self.restore_expired_leases(now)
 
-        _, task = self.queue_object.get(block=False)
+        priority, task = self.queue_object.get(block=False)
+        with self.lease_lock:
+            lease = next(self.lease_counter)
+            self.leases[lease] = (now + self.visibility_timeout, priority, task)
+        task.lease = lease
         return task
 
+    def restore_expired_leases(self, now):
+        """
+        Return tasks with expired leases to the queue.
+        """
+        with self.lease_lock:
+            expired = []
+            for lease, (deadline, _, _) in self.leases.items():
+                if deadline > now:
+                    break
+                expired.append(lease)
+            for lease in expired:
+                _, priority, task = self.leases.pop(lease)
+                self.put(task, priority)
+
+    def ack(self, lease):
+        with self.lease_lock:
+            self.leases.pop(lease, None)
+
+    def extend_leases(self):
+        deadline = time.time() + self.visibility_timeout
+        with self.lease_lock:
+            for lease, item in self.leases.items():
+                self.leases[lease] = (deadline,) + item[1:]
+
+    def get_next_schedule_time(self):
+        try:
+            return self.schedule_list[0][0]
+        except IndexError:
+            return None
+
     def size(self):
         return self.queue_object.qsize() + len(self.schedule_list)
 
@@ -43,7 +102,10 @@ class QueueBackend(QueueInterface):
                 self.queue_object.get(False)
         except Empty:
             pass
-        self.schedule_list = []
+        with self.schedule_lock:
+            self.schedule_list = []
+        with self.lease_lock:
+            self.leases = {}
 
     def close(self):
         pass
@@ -1,12 +1,32 @@
+"""
+Spider task queue backend powered by MongoDB
+
+Tasks are claimed by batches of `prefetch_size` tasks. Claimed task gets
+a lease: its `schedule_time` is moved `lease_timeout` seconds forward and
+its `lease` field is set to the unique token of the claim. Tasks are
+deleted by batches when their leases are acknowledged. If the spider
+crashes, leases of tasks which it has claimed expire and other spiders
+process these tasks.
+"""
 import logging
-import pickle
 import queue
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
+from threading import Lock
 
 import pymongo
 from bson import Binary
 
-from grab.spider.queue_backend.base import QueueInterface
+from grab.spider.queue_backend.base import DEFAULT_TASK_CODEC, QueueInterface
+
+# Number of tasks claimed by one query
+DEFAULT_PREFETCH_SIZE = 10
+# Number of seconds after which the claimed task returns to the queue
+DEFAULT_LEASE_TIMEOUT = 600
+# Number of seconds the cached size of the queue is used
+DEFAULT_SIZE_CACHE_TIMEOUT = 1
+# Max. number of acknowledged tasks which are not deleted yet
+DELETE_BATCH_SIZE = 100
 
 # pylint: disable=invalid-name
 logger = logging.getLogger("grab.spider.queue_backend.mongodb")
@@ -14,48 +34,209 @@ logger = logging.getLogger("grab.spider.queue_backend.mongodb")
 
 
 class QueueBackend(QueueInterface):
-    def __init__(self, spider_name, database=None, queue_name=None, **kwargs):
+    shared = True
+
+    def __init__(
+        self,
+        spider_name,
+        database=None,
+        queue_name=None,
+        connection=None,
+        prefetch_size=DEFAULT_PREFETCH_SIZE,
+        lease_timeout=DEFAULT_LEASE_TIMEOUT,
+        size_cache_timeout=DEFAULT_SIZE_CACHE_TIMEOUT,
+        codec=None,
+        **kwargs
+    ):
         """
-        All "unexpected" kwargs goes to `pymongo.MongoClient()` method
+        All "unexpected" kwargs goes to `pymongo.MongoClient()` method.
+        Existing client could be passed in `connection` argument.
+        Tasks are serialized with `codec`, see
+        `grab.spider.queue_backend.codec.TaskCodec`.
         """
         if queue_name is None:
             queue_name = "task_queue_%s" % spider_name
 
         self.database = database
         self.queue_name = queue_name
-        self.connection = pymongo.MongoClient(**kwargs)
+        # The connection passed by user is not closed by `close` method
+        self.own_connection = connection is None
+        if connection is None:
+            connection = pymongo.MongoClient(**kwargs)
+        self.connection = connection
         self.collection = self.connection[self.database][self.queue_name]
         logger.debug("Using collection: %s", self.collection)
+        self.prefetch_size = prefetch_size
+        self.lease_timeout = lease_timeout
+        self.size_cache_timeout = size_cache_timeout
+        self.codec = DEFAULT_TASK_CODEC if codec is None else codec
+
+        self.collection.create_index(
+            [("priority", pymongo.ASCENDING), ("schedule_time", pymongo.ASCENDING)]
+        )
+        self.collection.create_index([("lease", pymongo.ASCENDING)], sparse=True)
 
-        self.collection.create_index([("priority", 1)])
+        self.lock = Lock()
+        # Claimed documents in reversed order
+        self.prefetched = []
+        # Tasks returned by `get` which are not acknowledged yet,
+        # {task_id: claim_token}
+        self.active_ids = {}
+        # IDs of acknowledged tasks which are not deleted yet
+        self.taken_ids = []
+        self.size_cache = None
+        self.size_cache_time = None
 
         super().__init__(spider_name, **kwargs)
 
     def size(self):
-        return self.collection.count_documents({})
+        """
+        Return number of tasks including claimed tasks.
+
+        Tasks claimed by other spiders which share the queue are counted,
+        so the spider does not stop while other spiders could generate
+        new tasks.
+        """
+        with self.lock:
+            now = datetime.utcnow()
+            if self.size_cache is None or now - self.size_cache_time > timedelta(
+                seconds=self.size_cache_timeout
+            ):
+                self.delete_taken()
+                self.size_cache = self.collection.estimated_document_count()
+                self.size_cache_time = now
+            return self.size_cache - len(self.taken_ids)
 
     def put(self, task, priority, schedule_time=None):
         if schedule_time is None:
             schedule_time = datetime.utcnow()
 
         item = {
-            "task": Binary(pickle.dumps(task)),
+            "task": Binary(self.codec.encode(task)),
             "priority": priority,
             "schedule_time": schedule_time,
         }
         self.collection.insert_one(item)
+        with self.lock:
+            if self.size_cache is not None:
+                self.size_cache += 1
 
     def get(self):
-        item = self.collection.find_one_and_delete(
-            {"schedule_time": {"$lt": datetime.utcnow()}},
-            sort=[("priority", pymongo.ASCENDING)],
+        with self.lock:
+            if not self.prefetched:
+                self.prefetch()
+                if not self.prefetched:
+                    raise queue.Empty()
+            item = self.prefetched.pop()
+            self.active_ids[item["_id"]] = item["lease"]
+        task = self.codec.decode(item["task"])
+        task.lease = item["_id"]
+        return task
+
+    def ack(self, lease):
+        with self.lock:
+            if lease in self.active_ids:
+                del self.active_ids[lease]
+                self.taken_ids.append(lease)
+                if len(self.taken_ids) >= DELETE_BATCH_SIZE:
+                    self.delete_taken()
+
+    @property
+    def visibility_timeout(self):
+        return self.lease_timeout
+
+    def extend_leases(self):
+        with self.lock:
+            # Prefetched tasks are claimed too
+            claims = {}
+            for item in self.prefetched:
+                claims.setdefault(item["lease"], []).append(item["_id"])
+            for task_id, token in self.active_ids.items():
+                claims.setdefault(token, []).append(task_id)
+            schedule_time = datetime.utcnow() + timedelta(seconds=self.lease_timeout)
+            # Tasks with expired leases could be claimed by other spider
+            for token, ids in claims.items():
+                self.collection.update_many(
+                    {"_id": {"$in": ids}, "lease": token},
+                    {"$set": {"schedule_time": schedule_time}},
+                )
+
+    def prefetch(self):
+        """
+        Claim the batch of ready tasks with the best priority.
+        """
+        now = datetime.utcnow()
+        ids = [
+            x["_id"]
+            for x in self.collection.find(
+                {"schedule_time": {"$lte": now}},
+                projection={"_id": 1},
+                sort=[("priority", pymongo.ASCENDING)],
+                limit=self.prefetch_size,
+            )
+        ]
+        if not ids:
+            return
+        token = uuid.uuid4().hex
+        # Other spider could claim some of these tasks meanwhile
+        self.collection.update_many(
+            {"_id": {"$in": ids}, "schedule_time": {"$lte": now}},
+            {
+                "$set": {
+                    "schedule_time": now + timedelta(seconds=self.lease_timeout),
+                    "lease": token,
+                }
+            },
+        )
+        self.prefetched = list(
+            self.collection.find(
+                {"lease": token},
+                projection={"task": 1, "lease": 1},
+                sort=[("priority", pymongo.DESCENDING)],
+            )
         )
-        if item is None:
-            raise queue.Empty()
-        return pickle.loads(item["task"])
+
+    def delete_taken(self):
+        if self.taken_ids:
+            self.collection.delete_many({"_id": {"$in": self.taken_ids}})
+            if self.size_cache is not None:
+                self.size_cache -= len(self.taken_ids)
+            self.taken_ids = []
+
+    def release_prefetched(self):
+        """
+        Return claimed tasks which have not been taken or acknowledged
+        to the queue.
+        """
+        claims = {}
+        for item in self.prefetched:
+            claims.setdefault(item["lease"], []).append(item["_id"])
+        for task_id, token in self.active_ids.items():
+            claims.setdefault(token, []).append(task_id)
+        # Tasks with expired leases could be claimed by other spider,
+        # these tasks have other token
+        for token, ids in claims.items():
+            self.collection.update_many(
+                {"_id": {"$in": ids}, "lease": token},
+                {
+                    "$set": {"schedule_time": datetime.utcnow()},
+                    "$unset": {"lease": ""},
+                },
+            )
+        self.prefetched = []
+        self.active_ids = {}
 
     def clear(self):
-        self.collection.delete_many({})
+        with self.lock:
+            self.prefetched = []
+            self.active_ids = {}
+            self.taken_ids = []
+            self.size_cache = None
+            self.collection.delete_many({})
 
     def close(self):
-        self.connection.close()
+        with self.lock:
+            self.delete_taken()
+            self.release_prefetched()
+        if self.own_connection:
+            self.connection.close()
@@ -1,68 +1,264 @@
 """
 Spider task queue backend powered by redis
+
+Ready tasks are stored in sorted set scored by task priority. Delayed
+tasks are stored in separate sorted set scored by schedule time, they
+are moved to the set of ready tasks by the same Lua script which takes
+tasks from the queue. Tasks are put and taken in batches: one round trip
+to redis server per `batch_size` new tasks and per `prefetch_size` taken
+tasks.
+
+Taken tasks are moved to the sorted set of leased tasks scored by the time
+when the lease expires. Leases are acknowledged in batches. The task which
+has not been acknowledged in `visibility_timeout` seconds returns to the set
+of ready tasks, so tasks of crashed spider are processed by other spiders
+which share the queue.
 """
 import logging
-import pickle
 import queue
-import random
+import time
+from threading import Lock
 
-from fastrq.priorityqueue import PriorityQueue  # pytype: disable=import-error
 from redis import StrictRedis
 
-from grab.spider.error import SpiderMisuseError
-from grab.spider.queue_backend.base import QueueInterface
+from grab.spider.queue_backend.base import (
+    DEFAULT_TASK_CODEC,
+    QueueInterface,
+    datetime_to_timestamp,
+)
 
+# Max. number of new tasks sent to redis server at once
+DEFAULT_BATCH_SIZE = 100
+# Number of tasks taken from redis server at once
+DEFAULT_PREFETCH_SIZE = 10
+# Number of seconds after which the unacknowledged task returns to the queue
+DEFAULT_VISIBILITY_TIMEOUT = 600
+# Max. number of delayed tasks moved to ready tasks by one script call
+SCHEDULE_BATCH_SIZE = 1000
 
-class CustomPriorityQueue(PriorityQueue):
-    def __init__(self, key, **kwargs):
-        # sets `key` to `self._key`
-        super().__init__(key)
-        self._conn_kwargs = kwargs
+# Members of sorted sets are prefixed with unique sequence number
+# to store multiple tasks with same payload and to keep order of tasks
+# with same priority
+PUSH_SCRIPT = """
+local count = #ARGV / 3
+local seq = redis.call('INCRBY', KEYS[3], count) - count
+for i = 1, #ARGV, 3 do
+    seq = seq + 1
+    local member = string.format('%016x', seq) .. ARGV[i + 2]
+    if ARGV[i] == '' then
+        redis.call('ZADD', KEYS[1], ARGV[i + 1], member)
+    else
+        redis.call('ZADD', KEYS[2], ARGV[i], ARGV[i + 1] .. '\\n' .. member)
+    end
+end
+return count
+"""
+# Members of sets of delayed and leased tasks are "<priority>\n<member>"
+POP_SCRIPT = """
+local function restore(key)
+    local due = redis.call(
+        'ZRANGEBYSCORE', key, '-inf', ARGV[1], 'LIMIT', 0, ARGV[3]
+    )
+    for _, item in ipairs(due) do
+        local pos = string.find(item, '\\n', 1, true)
+        redis.call(
+            'ZADD', KEYS[1], string.sub(item, 1, pos - 1), string.sub(item, pos + 1)
+        )
+        redis.call('ZREM', key, item)
+    end
+end
+restore(KEYS[2])
+restore(KEYS[3])
+local items = redis.call('ZRANGE', KEYS[1], 0, ARGV[2] - 1, 'WITHSCORES')
+if #items > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #items / 2 - 1)
+    for i = 1, #items, 2 do
+        redis.call('ZADD', KEYS[3], ARGV[4], items[i + 1] .. '\\n' .. items[i])
+    end
+end
+return items
+"""
+# Leased tasks are returned to the queue only if their leases
+# have not expired yet
+RELEASE_SCRIPT = """
+for _, item in ipairs(ARGV) do
+    if redis.call('ZREM', KEYS[2], item) == 1 then
+        local pos = string.find(item, '\\n', 1, true)
+        redis.call(
+            'ZADD', KEYS[1], string.sub(item, 1, pos - 1), string.sub(item, pos + 1)
+        )
+    end
+end
+return #ARGV
+"""
+SEQUENCE_PREFIX_SIZE = 16
 
-    # https://github.com/limen/fastrq/blob/master/fastrq/base.py
-    def connect(self):
-        if self._redis is None:
-            self._redis = StrictRedis(decode_responses=False, **self._conn_kwargs)
-        return self._redis
-
-    def clear(self):
-        if self._redis:
-            self._redis.delete(self._key)
+logger = logging.getLogger(  # pylint: disable=invalid-name
+    "grab.spider.queue_backend.redis"
+)
 
 
 class QueueBackend(QueueInterface):
-    def __init__(self, spider_name, queue_name=None, **kwargs):
-        super().__init__(spider_name, **kwargs)
+    shared = True
+
+    def __init__(
+        self,
+        spider_name,
+        queue_name=None,
+        connection=None,
+        batch_size=DEFAULT_BATCH_SIZE,
+        prefetch_size=DEFAULT_PREFETCH_SIZE,
+        visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+        codec=None,
+        **kwargs
+    ):
+        """
+        All "unexpected" kwargs goes to `redis.StrictRedis()` constructor.
+        Existing redis client could be passed in `connection` argument.
+        Tasks are serialized with `codec`, see
+        `grab.spider.queue_backend.codec.TaskCodec`.
+        """
+        super().__init__(spider_name)
         self.spider_name = spider_name
         if queue_name is None:
             queue_name = "task_queue_%s" % spider_name
         self.queue_name = queue_name
-        self.queue_object = CustomPriorityQueue(queue_name, **kwargs)
-        logging.debug("Redis queue key: %s", self.queue_name)
+        self.delayed_name = "%s:delayed" % queue_name
+        self.leased_name = "%s:leased" % queue_name
+        self.sequence_name = "%s:seq" % queue_name
+        if connection is None:
+            connection = StrictRedis(decode_responses=False, **kwargs)
+        self.connection = connection
+        self.batch_size = batch_size
+        self.prefetch_size = prefetch_size
+        self.visibility_timeout = visibility_timeout
+        self.codec = DEFAULT_TASK_CODEC if codec is None else codec
+        self.push_script = self.connection.register_script(PUSH_SCRIPT)
+        self.pop_script = self.connection.register_script(POP_SCRIPT)
+        self.release_script = self.connection.register_script(RELEASE_SCRIPT)
+        self.lock = Lock()
+        # Flat list of [schedule_time, priority, payload, ...] items
+        # which are not sent to redis yet
+        self.write_buffer = []
+        # List of (member, priority) items taken from redis in reversed order
+        self.prefetched = []
+        # Leases of tasks returned by `get` which are not acknowledged yet
+        self.active_leases = set()
+        # Acknowledged leases which are not removed from redis yet
+        self.ack_buffer = []
+        logger.debug("Redis queue key: %s", self.queue_name)
 
     def put(self, task, priority, schedule_time=None):
-        if schedule_time is not None:
-            raise SpiderMisuseError("Redis task queue does not support delayed task")
-        # Add attribute with random value
-        # This is required because qr library
-        # does not allow to store multiple values with same hash
-        # in the PriorityQueue
+        payload = self.codec.encode(task)
+        if schedule_time is None:
+            schedule_score = ""
+        else:
+            schedule_score = repr(datetime_to_timestamp(schedule_time))
+        with self.lock:
+            self.write_buffer.extend((schedule_score, repr(priority), payload))
+            if len(self.write_buffer) >= self.batch_size * 3:
+                self.flush()
 
-        task.redis_qr_rnd = random.random()
-        self.queue_object.push({pickle.dumps(task): priority})
+    def flush(self):
+        # New tasks are sent before acknowledgements: tasks generated by
+        # the task handler must be saved before its task is removed
+        if self.write_buffer:
+            self.push_script(
+                keys=[self.queue_name, self.delayed_name, self.sequence_name],
+                args=self.write_buffer,
+            )
+            self.write_buffer = []
+        if self.ack_buffer:
+            self.connection.zrem(self.leased_name, *self.ack_buffer)
+            self.ack_buffer = []
 
     def get(self):
-        task = self.queue_object.pop()
-        if task is None:
-            raise queue.Empty()
-        return pickle.loads(task[0])  # pylint: disable=unsubscriptable-object
+        with self.lock:
+            if not self.prefetched:
+                self.flush()
+                now = time.time()
+                items = self.pop_script(
+                    keys=[self.queue_name, self.delayed_name, self.leased_name],
+                    args=[
+                        now,
+                        self.prefetch_size,
+                        SCHEDULE_BATCH_SIZE,
+                        now + self.visibility_timeout,
+                    ],
+                )
+                # Items are [member, score, member, score, ...]
+                self.prefetched = list(zip(items[::2], items[1::2]))
+                self.prefetched.reverse()
+                if not self.prefetched:
+                    raise queue.Empty()
+            member, priority = self.prefetched.pop()
+            lease = priority + b"\n" + member
+            self.active_leases.add(lease)
+        task = self.codec.decode(member[SEQUENCE_PREFIX_SIZE:])
+        task.lease = lease
+        return task
+
+    def ack(self, lease):
+        with self.lock:
+            if lease in self.active_leases:
+                self.active_leases.remove(lease)
+                self.ack_buffer.append(lease)
+                if len(self.ack_buffer) >= self.batch_size:
+                    self.flush()
+
+    def extend_leases(self):
+        with self.lock:
+            deadline = time.time() + self.visibility_timeout
+            # Prefetched tasks are leased too
+            leases = self.active_leases.union(
+                priority + b"\n" + member for member, priority in self.prefetched
+            )
+            if leases:
+                # Expired leases could be restored and taken by other spider
+                # already, these leases are not in the set anymore
+                self.connection.zadd(
+                    self.leased_name, dict.fromkeys(leases, deadline), xx=True
+                )
 
     def size(self):
-        return len(self.queue_object)
+        """
+        Return number of ready, delayed and leased tasks.
+
+        Tasks leased by other spiders which share the queue are counted,
+        so the spider does not stop while other spiders could generate
+        new tasks.
+        """
+        with self.lock:
+            self.flush()
+            pipe = self.connection.pipeline(transaction=False)
+            pipe.zcard(self.queue_name)
+            pipe.zcard(self.delayed_name)
+            pipe.zcard(self.leased_name)
+            return sum(pipe.execute())
 
     def clear(self):
-        self.queue_object.clear()
+        with self.lock:
+            self.write_buffer = []
+            self.prefetched = []
+            self.active_leases = set()
+            self.ack_buffer = []
+            self.connection.delete(
+                self.queue_name,
+                self.delayed_name,
+                self.leased_name,
+                self.sequence_name,
+            )
 
     def close(self):
-        # get connection opened by qr and close it
-        pass
+        with self.lock:
+            self.flush()
+            # Return prefetched and unacknowledged tasks to the queue
+            leases = self.active_leases.union(
+                priority + b"\n" + member for member, priority in self.prefetched
+            )
+            if leases:
+                self.release_script(
+                    keys=[self.queue_name, self.leased_name], args=list(leases)
+                )
+            self.prefetched = []
+            self.active_leases = set()
@@ -0,0 +1,290 @@
+"""
+Spider task queue backend stored in SQLite database file
+
+Tasks survive crash and restart of the spider process. Changes are
+committed in batches: once per `commit_interval` operations or once per
+`commit_timeout` seconds. Task returned by `get` is marked as leased and
+it is deleted from the database when its lease is acknowledged. Leased
+tasks return to the queue when the visibility timeout expires or when
+the database is opened again after a crash or stop of the spider.
+"""
+import logging
+import queue
+import sqlite3
+import time
+from datetime import datetime
+from itertools import count, groupby
+from threading import Lock
+
+from grab.spider.queue_backend.base import (
+    DEFAULT_TASK_CODEC,
+    QueueInterface,
+    datetime_to_timestamp,
+)
+
+# Max. number of changes in one transaction
+DEFAULT_COMMIT_INTERVAL = 1000
+# Max. number of seconds between commits
+DEFAULT_COMMIT_TIMEOUT = 1
+# Number of tasks loaded from the database by one query
+DEFAULT_PREFETCH_SIZE = 100
+# Number of seconds after which the unacknowledged task returns to the queue
+DEFAULT_VISIBILITY_TIMEOUT = 600
+# Queries applying changes of leased tasks
+CHANGE_QUERIES = {
+    "lease": 'UPDATE "%s" SET leased = 1 WHERE id = ?',
+    "restore": 'UPDATE "%s" SET leased = 0 WHERE id = ?',
+    "delete": 'DELETE FROM "%s" WHERE id = ?',
+}
+
+logger = logging.getLogger(  # pylint: disable=invalid-name
+    "grab.spider.queue_backend.sqlite"
+)
+
+
+class QueueBackend(QueueInterface):
+    # Tasks are not removed when the spider stops
+    durable = True
+
+    def __init__(
+        self,
+        spider_name,
+        path,
+        queue_name=None,
+        commit_interval=DEFAULT_COMMIT_INTERVAL,
+        commit_timeout=DEFAULT_COMMIT_TIMEOUT,
+        prefetch_size=DEFAULT_PREFETCH_SIZE,
+        visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+        synchronous="FULL",
+        codec=None,
+        **kwargs
+    ):
+        super().__init__(spider_name, **kwargs)
+        # Tasks saved by previous versions as pickled objects
+        # are decoded by any codec
+        self.codec = DEFAULT_TASK_CODEC if codec is None else codec
+        if queue_name is None:
+            queue_name = "task_queue_%s" % spider_name
+        self.path = path
+        self.queue_name = queue_name
+        self.delayed_name = "%s_delayed" % queue_name
+        self.commit_interval = commit_interval
+        self.commit_timeout = commit_timeout
+        self.prefetch_size = prefetch_size
+        self.visibility_timeout = visibility_timeout
+        self.lock = Lock()
+        # Connection is used by all threads under the lock
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=%s" % synchronous)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS "{queue}" (
+                id INTEGER PRIMARY KEY, priority INTEGER, task BLOB,
+                leased INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS "{queue}_ready"
+                ON "{queue}" (priority, id) WHERE leased = 0;
+            CREATE TABLE IF NOT EXISTS "{delayed}" (
+                id INTEGER PRIMARY KEY, schedule_time REAL,
+                priority INTEGER, task BLOB
+            );
+            CREATE INDEX IF NOT EXISTS "{delayed}_schedule_time"
+                ON "{delayed}" (schedule_time);
+            """.format(
+                queue=self.queue_name, delayed=self.delayed_name
+            )
+        )
+        # Tasks loaded from the database, they are still stored
+        # in the database until they are returned by `get`
+        self.prefetched = []
+        # Tasks taken from the queue and not acknowledged yet,
+        # {lease: (deadline, task_id)} in order of deadlines
+        self.leases = {}
+        self.lease_counter = count(1)
+        # (change, task_id) items not applied to the database yet,
+        # change is a key of CHANGE_QUERIES
+        self.changes = []
+        self.pending_changes = 0
+        self.commit_time = time.time()
+        self.connection.execute("BEGIN")
+        # Tasks leased by the previous run of the spider
+        self.connection.execute('UPDATE "%s" SET leased = 0' % self.queue_name)
+        self.ready_size = self.count_rows(self.queue_name)
+        self.delayed_size = self.count_rows(self.delayed_name)
+        self.next_schedule_time = self.select_next_schedule_time()
+        logger.debug(
+            "Using table %s of database %s, tasks: %d",
+            self.queue_name,
+            self.path,
+            self.ready_size + self.delayed_size,
+        )
+
+    def count_rows(self, table):
+        query = 'SELECT COUNT(*) FROM "%s"' % table
+        return self.connection.execute(query).fetchone()[0]
+
+    def select_next_schedule_time(self):
+        return self.connection.execute(
+            'SELECT MIN(schedule_time) FROM "%s"' % self.delayed_name
+        ).fetchone()[0]
+
+    def put(self, task, priority, schedule_time=None):
+        data = self.codec.encode(task)
+        with self.lock:
+            if schedule_time is None:
+                self.connection.execute(
+                    'INSERT INTO "%s" (priority, task) VALUES (?, ?)' % self.queue_name,
+                    (priority, data),
+                )
+                self.ready_size += 1
+            else:
+                timestamp = datetime_to_timestamp(schedule_time)
+                self.connection.execute(
+                    'INSERT INTO "%s" (schedule_time, priority, task)'
+                    " VALUES (?, ?, ?)" % self.delayed_name,
+                    (timestamp, priority, data),
+                )
+                self.delayed_size += 1
+                if (
+                    self.next_schedule_time is None
+                    or timestamp < self.next_schedule_time
+                ):
+                    self.next_schedule_time = timestamp
+            self.register_change()
+
+    def get(self):
+        with self.lock:
+            now = time.time()
+            if self.leases:
+                self.restore_expired_leases(now)
+            if not self.prefetched:
+                self.prefetch(now)
+                if not self.prefetched:
+                    raise queue.Empty()
+            task_id, data = self.prefetched.pop()
+            lease = next(self.lease_counter)
+            self.leases[lease] = (now + self.visibility_timeout, task_id)
+            self.changes.append(("lease", task_id))
+            self.ready_size -= 1
+            self.register_change()
+        task = self.codec.decode(data)
+        task.lease = lease
+        return task
+
+    def restore_expired_leases(self, now):
+        """
+        Return tasks with expired leases to the queue.
+        """
+        expired = []
+        for lease, (deadline, _) in self.leases.items():
+            if deadline > now:
+                break
+            expired.append(lease)
+        for lease in expired:
+            _, task_id = self.leases.pop(lease)
+            self.changes.append(("restore", task_id))
+            self.ready_size += 1
+        if expired:
+            # Restored tasks are loaded by the next prefetch
+            self.prefetched = []
+            self.register_change()
+
+    def ack(self, lease):
+        with self.lock:
+            item = self.leases.pop(lease, None)
+            if item is not None:
+                self.changes.append(("delete", item[1]))
+                self.register_change()
+
+    def extend_leases(self):
+        with self.lock:
+            deadline = time.time() + self.visibility_timeout
+            for lease, item in self.leases.items():
+                self.leases[lease] = (deadline, item[1])
+
+    def prefetch(self, now):
+        self.apply_changes()
+        if self.next_schedule_time is not None and self.next_schedule_time <= now:
+            self.move_scheduled_tasks(now)
+        rows = self.connection.execute(
+            'SELECT id, task FROM "%s" WHERE leased = 0 ORDER BY priority, id LIMIT ?'
+            % self.queue_name,
+            (self.prefetch_size,),
+        ).fetchall()
+        rows.reverse()
+        self.prefetched = rows
+
+    def move_scheduled_tasks(self, now):
+        self.connection.execute(
+            'INSERT INTO "%s" (priority, task) SELECT priority, task FROM "%s"'
+            " WHERE schedule_time <= ? ORDER BY schedule_time, id"
+            % (self.queue_name, self.delayed_name),
+            (now,),
+        )
+        moved = self.connection.execute(
+            'DELETE FROM "%s" WHERE schedule_time <= ?' % self.delayed_name, (now,)
+        ).rowcount
+        self.ready_size += moved
+        self.delayed_size -= moved
+        self.next_schedule_time = self.select_next_schedule_time()
+        self.register_change()
+
+    def apply_changes(self):
+        # Changes are applied in order, one query per group of same changes
+        for change, items in groupby(self.changes, key=lambda x: x[0]):
+            self.connection.executemany(
+                CHANGE_QUERIES[change] % self.queue_name, [(x[1],) for x in items]
+            )
+        self.changes = []
+
+    def register_change(self):
+        self.pending_changes += 1
+        if (
+            self.pending_changes >= self.commit_interval
+            or time.time() - self.commit_time >= self.commit_timeout
+        ):
+            self.commit()
+
+    def commit(self):
+        self.apply_changes()
+        self.connection.execute("COMMIT")
+        self.connection.execute("BEGIN")
+        self.pending_changes = 0
+        self.commit_time = time.time()
+
+    def get_next_schedule_time(self):
+        timestamp = self.next_schedule_time
+        if timestamp is None:
+            return None
+        return datetime.utcfromtimestamp(timestamp)
+
+    def size(self):
+        with self.lock:
+            if (
+                self.pending_changes
+                and time.time() - self.commit_time >= self.commit_timeout
+            ):
+                self.commit()
+            # Leased tasks are kept in the database until they are processed
+            return self.ready_size + self.delayed_size + len(self.leases)
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM "%s"' % self.queue_name)
+            self.connection.execute('DELETE FROM "%s"' % self.delayed_name)
+            self.prefetched = []
+            self.leases = {}
+            self.changes = []
+            self.ready_size = 0
+            self.delayed_size = 0
+            self.next_schedule_time = None
+            self.commit()
+
+    def close(self):
+        with self.lock:
+            self.apply_changes()
+            self.connection.execute("COMMIT")
+            self.connection.close()
@@ -0,0 +1,296 @@
+"""
+Spider task queue backend which keeps the head of the queue in memory
+and spills the tail of the queue to files on disk
+
+At most `memory_size` ready tasks are kept in memory, the limit is the
+number of tasks, not bytes. Other tasks are collected into batches of
+`segment_size` tasks which are sorted by priority and saved to segment files
+as a sequence of separately serialized chunks. Segments are merged like runs
+of external sort: the next chunk of a segment is loaded into memory when its
+best priority is better than the best priority of tasks in memory, e.g. when
+the in-memory head of the queue has been drained. Each task is deserialized
+only once.
+
+Delayed tasks are stored in the same way in separate heap ordered by
+schedule time, at most `delayed_memory_size` of them are kept in memory.
+"""
+import heapq
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import zlib
+from datetime import datetime
+from itertools import count
+from queue import Empty
+from threading import Lock
+
+from grab.spider.queue_backend.base import QueueInterface
+from grab.spider.queue_backend.codec import TaskCodec
+
+# Max. number of ready tasks kept in memory
+DEFAULT_MEMORY_SIZE = 100000
+# Max. number of delayed tasks kept in memory
+DEFAULT_DELAYED_MEMORY_SIZE = 10000
+# Number of tasks in one segment file
+DEFAULT_SEGMENT_SIZE = 10000
+# Number of tasks in one chunk of segment file
+DEFAULT_CHUNK_SIZE = 500
+# Max. number of delayed tasks moved to the main queue by one `get` call
+SCHEDULE_BATCH_SIZE = 1000
+
+logger = logging.getLogger(  # pylint: disable=invalid-name
+    "grab.spider.queue_backend.tiered"
+)
+
+
+class Segment:
+    """
+    File with tasks sorted by key.
+    """
+
+    __slots__ = ("path", "chunks")
+
+    def __init__(self, path, chunks):
+        self.path = path
+        # List of (best_key, offset, length, number_of_tasks) items
+        # in reversed order, the next chunk is the last item
+        self.chunks = chunks
+
+    def get_key(self):
+        return self.chunks[-1][0]
+
+
+class TieredHeap:
+    """
+    Heap of tasks ordered by key which keeps at most `memory_size` tasks
+    in memory and saves other tasks to segment files.
+
+    The caller must serialize access to the heap.
+    """
+
+    def __init__(
+        self, path, name, memory_size, segment_size, chunk_size, compress, codec
+    ):
+        self.path = path
+        self.name = name
+        self.memory_size = memory_size
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.codec = codec
+        self.counter = count()
+        # Heap of (key, sequence_number, task) items
+        self.head = []
+        # Tasks which do not fit into memory and wait to be saved to segment
+        self.spill_buffer = []
+        self.spill_buffer_key = None
+        # Heap of (key_of_next_chunk, sequence_number, segment) items
+        self.segments = []
+        self.segment_tasks = 0
+
+    def push(self, key, task):
+        item = (key, next(self.counter), task)
+        if len(self.head) < self.memory_size:
+            heapq.heappush(self.head, item)
+            return
+        self.spill_buffer.append(item)
+        if self.spill_buffer_key is None or key < self.spill_buffer_key:
+            self.spill_buffer_key = key
+        if len(self.spill_buffer) >= self.segment_size:
+            self.save_segment(self.spill_buffer)
+            self.spill_buffer = []
+            self.spill_buffer_key = None
+
+    def get_key(self):
+        """
+        Return the best key or None if the heap is empty.
+        """
+        self.refill()
+        return self.head[0][0] if self.head else None
+
+    def pop(self):
+        """
+        Return the task with the best key or raise `Queue.Empty` exception.
+        """
+        self.refill()
+        if not self.head:
+            raise Empty
+        return heapq.heappop(self.head)[2]
+
+    def refill(self):
+        """
+        Move tasks with the best key from disk and spill buffer to memory.
+        """
+        while self.segments and (
+            not self.head or self.segments[0][0] < self.head[0][0]
+        ):
+            self.load_segment()
+        if self.spill_buffer and (
+            not self.head or self.spill_buffer_key < self.head[0][0]
+        ):
+            for item in self.spill_buffer:
+                heapq.heappush(self.head, item)
+            self.spill_buffer = []
+            self.spill_buffer_key = None
+        if len(self.head) > self.memory_size + self.segment_size:
+            # Too many segments have been loaded, save the worst tasks back
+            self.head.sort()
+            limit, size = self.memory_size, self.segment_size
+            tail = self.head[limit:]
+            del self.head[limit:]
+            while tail:
+                self.save_segment(tail[-size:])
+                del tail[-size:]
+
+    def save_segment(self, items):
+        items = sorted(items)
+        # Queues of several processes could share the directory
+        file_path = os.path.join(
+            self.path,
+            "%s-segment-%d-%d" % (self.name, os.getpid(), next(self.counter)),
+        )
+        chunks = []
+        offset = 0
+        with open(file_path, "wb") as out:
+            for pos in range(0, len(items), self.chunk_size):
+                end = pos + self.chunk_size
+                chunk = [
+                    (key, self.codec.encode(task)) for key, _, task in items[pos:end]
+                ]
+                data = pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+                if self.compress:
+                    data = zlib.compress(data, 1)
+                out.write(data)
+                chunks.append((chunk[0][0], offset, len(data), len(chunk)))
+                offset += len(data)
+        chunks.reverse()
+        segment = Segment(file_path, chunks)
+        heapq.heappush(self.segments, (segment.get_key(), next(self.counter), segment))
+        self.segment_tasks += len(items)
+
+    def load_segment(self):
+        """
+        Load the next chunk of the segment with the best key.
+        """
+        _, _, segment = heapq.heappop(self.segments)
+        _, offset, length, size = segment.chunks.pop()
+        with open(segment.path, "rb") as inp:
+            inp.seek(offset)
+            data = inp.read(length)
+        if segment.chunks:
+            heapq.heappush(
+                self.segments, (segment.get_key(), next(self.counter), segment)
+            )
+        else:
+            os.unlink(segment.path)
+        if self.compress:
+            data = zlib.decompress(data)
+        for key, task_data in pickle.loads(data):
+            heapq.heappush(
+                self.head, (key, next(self.counter), self.codec.decode(task_data))
+            )
+        self.segment_tasks -= size
+
+    def size(self):
+        return len(self.head) + len(self.spill_buffer) + self.segment_tasks
+
+    def clear(self):
+        for _, _, segment in self.segments:
+            os.unlink(segment.path)
+        self.head = []
+        self.spill_buffer = []
+        self.spill_buffer_key = None
+        self.segments = []
+        self.segment_tasks = 0
+
+
+class QueueBackend(QueueInterface):
+    def __init__(
+        self,
+        spider_name,
+        memory_size=DEFAULT_MEMORY_SIZE,
+        segment_size=DEFAULT_SEGMENT_SIZE,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        path=None,
+        compress=True,
+        codec=None,
+        delayed_memory_size=DEFAULT_DELAYED_MEMORY_SIZE,
+        **kwargs
+    ):
+        super().__init__(spider_name, **kwargs)
+        # Chunks are compressed as a whole, tasks are not compressed
+        # by the default codec
+        self.codec = TaskCodec(compression=None) if codec is None else codec
+        if path is None:
+            self.path = tempfile.mkdtemp(prefix="grab_queue_%s_" % spider_name)
+            self.remove_path = True
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.path = path
+            self.remove_path = False
+        self.lock = Lock()
+        # Ready tasks ordered by priority
+        self.ready = TieredHeap(
+            self.path,
+            "ready",
+            memory_size,
+            segment_size,
+            chunk_size,
+            compress,
+            self.codec,
+        )
+        # Delayed tasks ordered by schedule time
+        self.delayed = TieredHeap(
+            self.path,
+            "delayed",
+            delayed_memory_size,
+            segment_size,
+            chunk_size,
+            compress,
+            self.codec,
+        )
+        self.schedule_lock = Lock()
+        logger.debug("Segments of task queue are stored in %s", self.path)
+
+    def put(self, task, priority, schedule_time=None):
+        if schedule_time is not None:
+            with self.schedule_lock:
+                self.delayed.push(schedule_time, task)
+            return
+        with self.lock:
+            self.ready.push(priority, task)
+
+    def get(self):
+        if self.delayed.size():
+            now = datetime.utcnow()
+            with self.schedule_lock:
+                for _ in range(SCHEDULE_BATCH_SIZE):
+                    schedule_time = self.delayed.get_key()
+                    if schedule_time is None or schedule_time > now:
+                        break
+                    self.put(self.delayed.pop(), 1)
+
+        with self.lock:
+            return self.ready.pop()
+
+    def get_next_schedule_time(self):
+        if not self.delayed.size():
+            return None
+        with self.schedule_lock:
+            return self.delayed.get_key()
+
+    def size(self):
+        return self.ready.size() + self.delayed.size()
+
+    def clear(self):
+        with self.lock:
+            self.ready.clear()
+        with self.schedule_lock:
+            self.delayed.clear()
+
+    def close(self):
+        self.clear()
+        if self.remove_path:
+            shutil.rmtree(self.path, ignore_errors=True)
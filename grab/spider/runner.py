@@ -0,0 +1,347 @@
+"""
+Runner which processes spider tasks in several worker processes.
+
+Each worker process is a fork of the configured spider with its own
+network and parser services. Tasks are partitioned between workers by
+hash of the task host: the task added in one worker is passed to the
+worker which owns its host, so per-host limits and the dedup filter of
+each worker apply to all tasks of its hosts. Shared task queues (redis,
+mongodb) are not partitioned, all workers take tasks from the same queue.
+
+The work is done when all workers are idle and all tasks passed between
+workers have been received. Workers report their state through shared
+counters which the runner checks twice in a row to get consistent view.
+"""
+import logging
+import multiprocessing
+import signal
+import zlib
+from queue import Empty
+from threading import Lock, Thread
+from traceback import format_exc
+
+from grab.pool import get_pool_registry
+from grab.spider.error import SpiderError, SpiderMisuseError
+from grab.spider.host_scheduler import get_task_host
+from grab.spider.queue_backend.base import pack_task, unpack_task
+from grab.spider.queue_backend.memory import QueueBackend as MemoryQueueBackend
+
+# Number of seconds between checks of worker processes state
+CHECK_INTERVAL = 0.1
+# Max. number of seconds to wait for worker process to exit
+# after it has sent its result
+PROCESS_JOIN_TIMEOUT = 10
+# Value of worker state which means that the worker is busy
+BUSY = -1
+
+logger = logging.getLogger("grab.spider.runner")  # pylint: disable=invalid-name
+
+
+def get_task_partition(task, partition_number):
+    """
+    Return index of the worker process which owns the host of the task.
+    """
+    return zlib.crc32(get_task_host(task).encode("utf-8")) % partition_number
+
+
+class TaskRouter:
+    """
+    Passes tasks between worker processes and reports state of the worker.
+
+    The router is created in worker process and is assigned to
+    `task_router` attribute of the spider.
+    """
+
+    def __init__(self, spider, index, runner):
+        self.spider = spider
+        self.index = index
+        self.partition_number = runner.process_number
+        self.inboxes = runner.inboxes
+        self.sent = runner.sent
+        self.received = runner.received
+        self.state = runner.state
+        self.done_event = runner.done_event
+        self.lock = Lock()
+        self.receiver = None
+
+    def stop(self):
+        if self.receiver is not None:
+            self.inboxes[self.index].put(None)
+            self.receiver.join()
+        # Tasks which have not been received by stopped workers
+        # must not block the exit of the process
+        for inbox in self.inboxes:
+            inbox.cancel_join_thread()
+
+    def forward(self, task):
+        """
+        Pass the task to the worker which owns its host.
+
+        Returns False if the task belongs to the current worker.
+        """
+        if getattr(self.spider.task_queue, "shared", False):
+            return False
+        index = get_task_partition(task, self.partition_number)
+        if index == self.index:
+            return False
+        data = pack_task(task)
+        # The task is counted before it is sent, so the runner
+        # could not miss the task which is being passed
+        with self.lock:
+            self.sent[self.index] += 1
+        self.inboxes[index].put(data)
+        self.spider.stat.inc("spider:task-forwarded")
+        return True
+
+    def receive_tasks(self):
+        inbox = self.inboxes[self.index]
+        while True:
+            data = inbox.get()
+            if data is None:
+                break
+            self.spider.add_task(unpack_task(data))
+            # The task is counted after it is added to the task queue,
+            # so the worker could not look idle while it has the task
+            self.received[self.index] += 1
+
+    def is_done(self, is_idle):
+        """
+        Report state of the worker to the runner and check if
+        the work of all workers is done.
+        """
+        if self.receiver is None:
+            # Tasks of other workers are received when the task queue
+            # of the spider is ready
+            self.receiver = Thread(target=self.receive_tasks, daemon=True)
+            self.receiver.start()
+        received = self.received[self.index]
+        if is_idle():
+            self.state[self.index] = received
+        else:
+            self.state[self.index] = BUSY
+        return self.done_event.is_set()
+
+
+class SpiderRunner:
+    """
+    Run the spider in `process_number` worker processes.
+
+    The spider must be configured before the run. Tasks added to the
+    memory task queue before the run are distributed between workers,
+    the task generator and `initial_urls` are processed by the first
+    worker. Methods `prepare` and `shutdown` are called in each worker
+    process, resources which could not be shared by forked processes
+    (database connections, open files) must be created in `prepare`.
+
+    If one worker stops due to fatal error or `stop` call, other workers
+    are stopped too. Statistics of all workers is merged into `stat`
+    of the spider.
+    """
+
+    def __init__(self, spider, process_number=None):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise SpiderMisuseError(
+                "Spider runner requires fork start method"
+                " which is not available on this platform"
+            )
+        self.spider = spider
+        self.process_number = process_number or multiprocessing.cpu_count()
+        self.mp_context = multiprocessing.get_context("fork")
+        self.inboxes = []
+        self.sent = None
+        self.received = None
+        self.state = None
+        self.done_event = None
+        self.result_queue = None
+
+    def run(self):
+        spider = self.spider
+        task_queue = spider.task_queue
+        # Only tasks of the memory queue are copied to worker processes
+        # safely, other not shared backends keep tasks in files
+        if (
+            task_queue is not None
+            and not getattr(task_queue, "shared", False)
+            and not isinstance(task_queue, MemoryQueueBackend)
+        ):
+            raise SpiderMisuseError(
+                "Task queue of %s backend could not be used by several worker"
+                " processes, setup the task queue in `prepare` method"
+                % type(task_queue).__module__.rsplit(".", 1)[-1]
+            )
+        ctx = self.mp_context
+        number = self.process_number
+        self.inboxes = [ctx.Queue() for _ in range(number)]
+        self.sent = ctx.RawArray("q", number)
+        self.received = ctx.RawArray("q", number)
+        self.state = ctx.RawArray("q", [BUSY] * number)
+        self.done_event = ctx.Event()
+        self.result_queue = ctx.Queue()
+        processes = []
+        try:
+            for index in range(number):
+                # Worker process is not daemonic: it could start
+                # parser processes
+                proc = ctx.Process(target=self.worker_main, args=(index,))
+                proc.start()
+                processes.append(proc)
+            results = self.wait_results(processes)
+        except KeyboardInterrupt:
+            spider.interrupted = True
+            self.done_event.set()
+            self.wait_results(processes)
+            raise
+        finally:
+            self.close(processes)
+        if spider.task_queue is not None and not getattr(
+            spider.task_queue, "shared", False
+        ):
+            # Tasks of the queue have been processed by workers
+            spider.task_queue.clear()
+        self.merge_results(results)
+
+    def close(self, processes):
+        for proc in processes:
+            proc.join(PROCESS_JOIN_TIMEOUT)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        for inbox in self.inboxes:
+            inbox.close()
+        self.result_queue.close()
+
+    def merge_results(self, results):
+        """
+        Merge statistics of worker processes into the spider statistics.
+
+        Raises SpiderError if some worker process has failed.
+        """
+        spider = self.spider
+        errors = []
+        for index in sorted(results):
+            error, counters, collections, histograms, profiler = results[index]
+            for key, val in counters.items():
+                spider.stat.inc(key, val)
+            for key, items in collections.items():
+                spider.stat.collections[key].extend(items)
+            for key, hist in histograms.items():
+                spider.stat.merge_histogram(key, hist)
+            if profiler is not None and spider.handler_profiler is not None:
+                spider.handler_profiler.merge(profiler)
+            if error:
+                errors.append("Worker process %d failed:\n%s" % (index, error))
+        if spider.handler_profiler is not None:
+            spider.handler_profiler.write_report()
+        if errors:
+            raise SpiderError("\n".join(errors))
+
+    def wait_results(self, processes):
+        """
+        Collect results of worker processes and detect the end of work.
+        """
+        results = {}
+        prev_state = None
+        while len(results) < len(processes):
+            try:
+                self.add_result(results, self.result_queue.get(True, CHECK_INTERVAL))
+                continue
+            except Empty:
+                pass
+            for index, proc in enumerate(processes):
+                if index not in results and not proc.is_alive():
+                    # The process could die after it has sent the result
+                    try:
+                        self.add_result(
+                            results, self.result_queue.get(True, CHECK_INTERVAL)
+                        )
+                    except Empty:
+                        self.add_result(
+                            results,
+                            (index, "Process has died", False, {}, {}, {}, None),
+                        )
+                    break
+            if not self.done_event.is_set():
+                state = self.get_state()
+                if state == prev_state and self.is_work_done(state):
+                    self.done_event.set()
+                prev_state = state
+        return results
+
+    def add_result(self, results, item):
+        index, error, stopped, counters, collections, histograms, profiler = item
+        results[index] = (error, counters, collections, histograms, profiler)
+        if error or stopped:
+            # Stop other workers
+            self.done_event.set()
+
+    def get_state(self):
+        return (list(self.sent), list(self.received), list(self.state))
+
+    def is_work_done(self, state):
+        sent, received, idle_state = state
+        return sum(sent) == sum(received) and all(
+            val == count for val, count in zip(idle_state, received)
+        )
+
+    def worker_main(self, index):
+        """
+        Main function of worker process.
+        """
+        # KeyboardInterrupt is handled by the main process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        spider = self.spider
+        # Connections of the main process must not be used
+        get_pool_registry().clear()
+        spider.stat.reset()
+        if spider.task_queue is not None and not getattr(
+            spider.task_queue, "shared", False
+        ):
+            self.filter_initial_tasks(spider.task_queue, index)
+        if index:
+            spider.initial_urls = []
+            spider.task_generator_service.real_generator = iter(())
+        router = TaskRouter(spider, index, self)
+        spider.task_router = router
+        error = None
+        try:
+            spider.run()
+        except Exception:  # pylint: disable=broad-except
+            error = format_exc()
+            logger.error("Worker process %d failed:\n%s", index, error)
+        finally:
+            router.stop()
+        self.result_queue.put(
+            (
+                index,
+                error,
+                not spider.work_allowed,
+                spider.stat.counters,
+                dict(spider.stat.collections),
+                spider.stat.histograms,
+                spider.handler_profiler,
+            )
+        )
+        self.result_queue.close()
+        self.result_queue.join_thread()
+
+    def filter_initial_tasks(self, task_queue, index):
+        """
+        Keep the tasks of worker's hosts in the copy of the task queue
+        inherited from the main process.
+
+        Delayed tasks are kept by the first worker.
+        """
+        tasks = []
+        while True:
+            try:
+                task = task_queue.get()
+            except Empty:
+                break
+            task_queue.ack(task.lease)
+            task.lease = None
+            tasks.append(task)
+        if index:
+            task_queue.clear()
+        for task in tasks:
+            if get_task_partition(task, self.process_number) == index:
+                task_queue.put(task, task.priority, schedule_time=task.schedule_time)
@@ -1,24 +1,139 @@
 import logging
 import sys
-from threading import Event, Thread
+from queue import Queue
+from threading import Condition, Event, Thread
 
 # pylint: disable=invalid-name
 logger = logging.getLogger("grab.spider.base_service")
 # pylint: enable=invalid-name
+# Max. time to wait for new work before checking worker state again.
+# Workers waiting for new work are woken up explicitly so this timeout
+# only limits the damage of missed wakeup.
+IDLE_WAIT_TIMEOUT = 1
+# Item put into service queue to wake up the worker waiting for new item
+WAKEUP = object()
+# Result put into task dispatcher queue after the task handler has finished
+TASK_DONE = object()
+
+
+class WorkCounter:
+    """
+    Counts work items being processed by spider services.
+
+    The service increments the counter before it takes the item
+    and decrements the counter after the item is processed and all
+    derived items are passed to other services, so the counter
+    could not drop to zero while there is work in progress.
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+        self.value = 0
+
+    def inc(self):
+        with self.cond:
+            self.value += 1
+
+    def dec(self):
+        with self.cond:
+            self.value -= 1
+            if not self.value:
+                self.cond.notify_all()
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def wait(self, timeout):
+        """
+        Wait until the counter drops to zero or `notify` is called.
+        """
+        with self.cond:
+            if self.value:
+                self.cond.wait(timeout)
+
+
+class Notifier:
+    """
+    Wakes up workers waiting for some event e.g. new task in the task queue.
+
+    The worker has to remember the `generation` value before it checks
+    for the event. If the event happens after the check then `wait` returns
+    immediately.
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+        self.generation = 0
+        self.listeners = []
+
+    def add_listener(self, callback):
+        with self.cond:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self.cond:
+            self.listeners.remove(callback)
+
+    def notify(self, notify_all=False):
+        with self.cond:
+            self.generation += 1
+            if notify_all:
+                self.cond.notify_all()
+            else:
+                self.cond.notify()
+            for callback in self.listeners:
+                callback()
+
+    def wait(self, generation, timeout=IDLE_WAIT_TIMEOUT):
+        with self.cond:
+            if self.generation == generation:
+                self.cond.wait(timeout)
+
+
+class ServiceQueue(Queue):
+    """
+    Input queue of the service.
+
+    Each item put into the queue is counted by the `WorkCounter`
+    until the consumer calls `task_done` method.
+    """
+
+    def __init__(self, counter):
+        super().__init__()
+        self.counter = counter
+
+    def put(self, item, block=True, timeout=None):
+        self.counter.inc()
+        super().put(item, block, timeout)
+
+    def task_done(self):
+        super().task_done()
+        self.counter.dec()
+
+    def wakeup(self, count=1):
+        """
+        Wake up `count` workers waiting for new item.
+        """
+        for _ in range(count):
+            super().put(WAKEUP)
+
+    def qsize(self):
+        with self.mutex:
+            return sum(1 for x in self.queue if x is not WAKEUP)
 
 
 class ServiceWorker:
     def __init__(self, spider, worker_callback):
         self.spider = spider
-        self.thread = Thread(
-            target=self.worker_callback_wrapper(worker_callback), args=[self]
-        )
-        self.thread.daemon = True
-        th_name = "worker:%s:%s" % (
+        self.worker_callback = worker_callback
+        # Thread is created when the worker starts: thread object created
+        # before fork could not be started in the child process
+        self.thread = None
+        self.thread_name = "worker:%s:%s" % (
             worker_callback.__self__.__class__.__name__,
             worker_callback.__name__,
         )
-        self.thread.name = th_name
         self.pause_event = Event()
         self.stop_event = Event()
         self.resume_event = Event()
@@ -31,11 +146,17 @@ class ServiceWorker:
                 callback(*args, **kwargs)
             except Exception as ex:  # pylint: disable=broad-except
                 logger.error("Spider Service Fatal Error", exc_info=ex)
-                self.spider.fatal_error_queue.put(sys.exc_info())
+                self.spider.report_fatal_error(sys.exc_info())
 
         return wrapper
 
     def start(self):
+        self.thread = Thread(
+            target=self.worker_callback_wrapper(self.worker_callback),
+            args=[self],
+            name=self.thread_name,
+            daemon=True,
+        )
         self.thread.start()
 
     def stop(self):
@@ -61,7 +182,7 @@ class ServiceWorker:
         self.resume_event.set()
 
     def is_alive(self):
-        return self.thread.is_alive()
+        return self.thread is not None and self.thread.is_alive()
 
 
 class BaseService:
@@ -89,9 +210,21 @@ class BaseService:
     def stop(self):
         for worker in self.iterate_workers(self.worker_registry):
             worker.stop()
+        self.wakeup_workers()
+
+    def wakeup_workers(self):
+        """
+        Wake up workers waiting for new work to let them process
+        stop or pause signal.
+        """
 
     def pause(self):
-        for worker in self.iterate_workers(self.worker_registry):
+        workers = list(self.iterate_workers(self.worker_registry))
+        for worker in workers:
+            worker.resume_event.clear()
+            worker.pause_event.set()
+        self.wakeup_workers()
+        for worker in workers:
             worker.pause()
         # logging.debug('Service %s paused' % self.__class__.__name__)
 
@@ -1,15 +1,30 @@
+import asyncio
 import time
 from queue import Empty
 
+from grab import aio
 from grab.error import (
+    GrabConnectionError,
     GrabInvalidResponse,
     GrabInvalidUrl,
     GrabNetworkError,
+    GrabTimeoutError,
     GrabTooManyRedirectsError,
 )
+from grab.pool import get_pool_registry
+from grab.spider.concurrency import OVERLOAD_HTTP_CODES
 from grab.util.misc import camel_case_to_underscore
 
-from .base import BaseService
+from .base import IDLE_WAIT_TIMEOUT, BaseService
+
+NETWORK_ERRORS = (
+    GrabNetworkError,
+    GrabInvalidUrl,
+    GrabInvalidResponse,
+    GrabTooManyRedirectsError,
+)
+# Errors which are counted by the adaptive concurrency controller
+OVERLOAD_ERRORS = (GrabTimeoutError, GrabConnectionError)
 
 
 def make_class_abbr(name):
@@ -17,14 +32,11 @@ def make_class_abbr(name):
     return val.replace("_", "-")
 
 
-class NetworkServiceThreaded(BaseService):
-    def __init__(self, spider, thread_number):
-        super().__init__(spider)
-        self.thread_number = thread_number
-        self.worker_pool = []
-        for _ in range(self.thread_number):
-            self.worker_pool.append(self.create_worker(self.worker_callback))
-        self.register_workers(self.worker_pool)
+class BaseNetworkService(BaseService):
+    """
+    Common logic of network services: preparing Grab instance for the task
+    and passing result of network request to the task dispatcher.
+    """
 
     def get_active_threads_number(self):
         return sum(
@@ -33,96 +45,326 @@ class NetworkServiceThreaded(BaseService):
             if x.is_busy_event.is_set()
         )
 
+    def wakeup_workers(self):
+        self.spider.task_notifier.notify(notify_all=True)
+
+    def acquire_slot(self):
+        """
+        Check that the adaptive concurrency limit allows one more request.
+        """
+        controller = self.spider.concurrency_controller
+        return controller is None or controller.acquire()
+
+    def release_slot(self, wakeup=True):
+        """
+        Release the slot occupied with `acquire_slot`.
+
+        :param wakeup: wake up the worker waiting for free slot, it is
+            not required if the slot was not used for network request
+        """
+        controller = self.spider.concurrency_controller
+        if controller is not None:
+            controller.release()
+            if wakeup:
+                self.spider.task_notifier.notify()
+
+    def report_network_result(self, grab, exc, latency):
+        """
+        Pass result of network request to the adaptive concurrency controller.
+        """
+        controller = self.spider.concurrency_controller
+        if controller is None:
+            return
+        if exc is None:
+            is_error = grab.doc.code in OVERLOAD_HTTP_CODES
+        else:
+            is_error = isinstance(exc, OVERLOAD_ERRORS)
+        if controller.report(is_error, latency):
+            # Workers waiting for free slot could continue
+            self.spider.task_notifier.notify(notify_all=True)
+
+    def get_task(self):
+        """
+        Return task from the task queue or None if no task is available.
+        """
+        try:
+            task = self.spider.get_task_from_queue()
+        except Empty:
+            return None
+        if task is None or task is True:
+            return None
+        now = time.time()
+        if task.queue_time is not None:
+            self.spider.log_task_latency(
+                "queue-wait", task, max(0, now - task.queue_time)
+            )
+        if task.trace_id:
+            self.spider.trace_span(task, "queue", min(task.queue_time or now, now), now)
+        return task
+
+    def setup_task_grab(self, task):
+        """
+        Check limits of the task and build Grab instance for it.
+
+        Returns (grab, grab_config_backup) pair or None if task is rejected.
+        """
+        task.network_try_count += 1
+        is_valid, reason = self.spider.check_task_limits(task)
+        if not is_valid:
+            self.spider.log_rejected_task(task, reason)
+            self.spider.trace_span(task, "rejected", time.time(), reason=reason)
+            handler = task.get_fallback_handler(self.spider)
+            if handler:
+                handler(task)
+            self.spider.ack_task(task)
+            return None
+        grab = self.spider.setup_grab_for_task(task)
+        # TODO: almost duplicate of
+        # Spider.submit_task_to_transport
+        grab_config_backup = grab.dump_config()
+        self.spider.process_grab_proxy(task, grab)
+        stat = self.spider.stat
+        stat.inc("spider:request-network")
+        stat.inc(stat.format_key("spider:task-%s-network", task.name))
+        return grab, grab_config_backup
+
+    def log_network_request(self, task, grab, exc, started):
+        """
+        Update statistics and trace of the task with the completed request.
+        """
+        elapsed = time.time() - started
+        self.report_network_result(grab, exc, elapsed)
+        self.spider.log_task_latency("network", task, elapsed, grab)
+        if task.trace_id:
+            self.spider.trace_span(
+                task,
+                "request",
+                started,
+                started + elapsed,
+                network_try=task.network_try_count,
+                proxy=grab.config["proxy"],
+                code=grab.doc.code if exc is None else None,
+                error=None if exc is None else exc.__class__.__name__,
+            )
+
+    def build_result(self, task, grab, grab_config_backup, exc=None):
+        result = {
+            "ok": True,
+            "ecode": None,
+            "emsg": None,
+            "error_abbr": None,
+            "grab": grab,
+            "grab_config_backup": (grab_config_backup),
+            "task": task,
+            "exc": None,
+        }
+        if exc is not None:
+            is_redir_err = isinstance(exc, GrabTooManyRedirectsError)
+            orig_exc_name = (
+                exc.original_exc.__class__.__name__
+                if hasattr(exc, "original_exc")
+                else None
+            )
+            # UnicodeError: see #323
+            if (
+                is_redir_err
+                or isinstance(exc, GrabInvalidUrl)
+                or orig_exc_name == "error"
+                or orig_exc_name == "UnicodeError"
+            ):
+                ex_cls = exc
+            else:
+                ex_cls = exc.original_exc
+            result.update(
+                {
+                    "ok": False,
+                    "exc": exc,
+                    "error_abbr": (
+                        "too-many-redirects"
+                        if is_redir_err
+                        else make_class_abbr(ex_cls.__class__.__name__)
+                    ),
+                }
+            )
+        return result
+
+    def submit_result(self, result, task):
+        # Dispatcher latency is counted from this moment
+        result["submit_time"] = time.time()
+        self.spider.task_dispatcher.input_queue.put((result, task, None))
+
+
+class NetworkServiceThreaded(BaseNetworkService):
+    def __init__(self, spider, thread_number):
+        super().__init__(spider)
+        self.thread_number = thread_number
+        # Each network thread should be able to keep its own
+        # keep-alive connection to the same host
+        get_pool_registry().ensure_maxsize(self.thread_number)
+        self.worker_pool = []
+        for _ in range(self.thread_number):
+            self.worker_pool.append(self.create_worker(self.worker_callback))
+        self.register_workers(self.worker_pool)
+
     # TODO: supervisor worker to restore failed worker threads
     def worker_callback(self, worker):
         while not worker.stop_event.is_set():
             worker.process_pause_signal()
-            try:
-                task = self.spider.get_task_from_queue()
-            except Empty:
-                time.sleep(0.1)
+            generation = self.spider.task_notifier.generation
+            if not self.acquire_slot():
+                self.spider.task_notifier.wait(generation)
+                continue
+            # The task taken from the queue is counted
+            # until its result is passed to the task dispatcher
+            self.spider.work_counter.inc()
+            task = self.get_task()
+            if task is None:
+                self.release_slot(wakeup=False)
             else:
-                if task is None or task is True:
-                    time.sleep(0.1)
+                worker.is_busy_event.set()
+                try:
+                    prepared = self.setup_task_grab(task)
+                    if prepared:
+                        grab, grab_config_backup = prepared
+                        started = time.time()
+                        try:
+                            grab.request()
+                        except NETWORK_ERRORS as ex:
+                            exc = ex
+                        else:
+                            exc = None
+                        self.log_network_request(task, grab, exc, started)
+                        self.submit_result(
+                            self.build_result(task, grab, grab_config_backup, exc),
+                            task,
+                        )
+                finally:
+                    worker.is_busy_event.clear()
+                    self.spider.release_task(task)
+                    self.release_slot()
+            # Not called if the worker fails: the spider must not
+            # be considered idle until the fatal error is reported
+            self.spider.work_counter.dec()
+            if task is None:
+                self.spider.task_notifier.wait(
+                    generation, self.spider.get_task_wait_timeout()
+                )
+
+
+class NetworkServiceAsync(BaseNetworkService):
+    """
+    Network service which runs all network requests in one thread.
+
+    The worker thread runs asyncio event loop which drives up to
+    `thread_number` concurrent requests made with `Grab.arequest`.
+    """
+
+    def __init__(self, spider, thread_number):
+        super().__init__(spider)
+        self.thread_number = thread_number
+        self.active_tasks = set()
+        self.worker = self.create_worker(self.worker_callback)
+        self.register_workers(self.worker)
+
+    def get_active_threads_number(self):
+        return len(self.active_tasks)
+
+    def worker_callback(self, worker):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.worker_loop(worker))
+        finally:
+            try:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                # Joins threads of the default executor which resolves
+                # host names, the method is available since Python 3.9
+                if hasattr(loop, "shutdown_default_executor"):
+                    loop.run_until_complete(loop.shutdown_default_executor())
+            finally:
+                loop.close()
+
+    async def worker_loop(self, worker):
+        loop = asyncio.get_running_loop()
+        pool = aio.get_loop_pool()
+        # Keep-alive connections of all concurrent requests could be reused
+        pool.maxsize = max(pool.maxsize, self.thread_number)
+        wakeup_event = asyncio.Event()
+
+        def wakeup_listener():
+            try:
+                loop.call_soon_threadsafe(wakeup_event.set)
+            except RuntimeError:
+                # The loop is closed
+                pass
+
+        self.spider.task_notifier.add_listener(wakeup_listener)
+        try:
+            while not worker.stop_event.is_set():
+                worker.process_pause_signal()
+                if (
+                    len(self.active_tasks) >= self.thread_number
+                    or not self.acquire_slot()
+                ):
+                    waiter = asyncio.ensure_future(wakeup_event.wait())
+                    await asyncio.wait(
+                        self.active_tasks | {waiter},
+                        timeout=IDLE_WAIT_TIMEOUT,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    waiter.cancel()
+                    wakeup_event.clear()
+                    continue
+                wakeup_event.clear()
+                self.spider.work_counter.inc()
+                task = self.get_task()
+                if task is None:
+                    self.release_slot(wakeup=False)
+                    self.spider.work_counter.dec()
+                    waiter = asyncio.ensure_future(wakeup_event.wait())
+                    await asyncio.wait(
+                        self.active_tasks | {waiter},
+                        timeout=self.spider.get_task_wait_timeout(),
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    waiter.cancel()
                 else:
                     worker.is_busy_event.set()
-                    try:
-                        task.network_try_count += 1  # pylint: disable=no-member
-                        is_valid, reason = self.spider.check_task_limits(task)
-                        if is_valid:
-                            grab = self.spider.setup_grab_for_task(task)
-                            # TODO: almost duplicate of
-                            # Spider.submit_task_to_transport
-                            grab_config_backup = grab.dump_config()
-                            self.spider.process_grab_proxy(task, grab)
-                            self.spider.stat.inc("spider:request-network")
-                            self.spider.stat.inc("spider:task-%s-network" % task.name)
-
-                            # self.freelist.pop()
-                            try:
-                                result = {
-                                    "ok": True,
-                                    "ecode": None,
-                                    "emsg": None,
-                                    "error_abbr": None,
-                                    "grab": grab,
-                                    "grab_config_backup": (grab_config_backup),
-                                    "task": task,
-                                    "exc": None,
-                                }
-                                try:
-                                    grab.request()
-                                except (
-                                    GrabNetworkError,
-                                    GrabInvalidUrl,
-                                    GrabInvalidResponse,
-                                    GrabTooManyRedirectsError,
-                                ) as ex:
-                                    is_redir_err = isinstance(
-                                        ex, GrabTooManyRedirectsError
-                                    )
-                                    orig_exc_name = (
-                                        ex.original_exc.__class__.__name__
-                                        if hasattr(ex, "original_exc")
-                                        else None
-                                    )
-                                    # UnicodeError: see #323
-                                    if (
-                                        is_redir_err
-                                        or isinstance(ex, GrabInvalidUrl)
-                                        or orig_exc_name == "error"
-                                        or orig_exc_name == "UnicodeError"
-                                    ):
-                                        ex_cls = ex
-                                    else:
-                                        ex_cls = ex.original_exc
-                                    result.update(
-                                        {
-                                            "ok": False,
-                                            "exc": ex,
-                                            "error_abbr": (
-                                                "too-many-redirects"
-                                                if is_redir_err
-                                                else make_class_abbr(
-                                                    ex_cls.__class__.__name__
-                                                )
-                                            ),
-                                        }
-                                    )
-                                (
-                                    self.spider.task_dispatcher.input_queue.put(
-                                        (result, task, None)
-                                    )
-                                )
-                            finally:
-                                pass
-                                # self.freelist.append(1)
-                        else:
-                            self.spider.log_rejected_task(task, reason)
-                            # pylint: disable=no-member
-                            handler = task.get_fallback_handler(self.spider)
-                            # pylint: enable=no-member
-                            if handler:
-                                handler(task)
-                    finally:
-                        worker.is_busy_event.clear()
+                    future = asyncio.ensure_future(self.process_task(task))
+                    self.active_tasks.add(future)
+                    future.add_done_callback(self.on_task_done)
+        finally:
+            self.spider.task_notifier.remove_listener(wakeup_listener)
+            for future in list(self.active_tasks):
+                future.cancel()
+            if self.active_tasks:
+                await asyncio.wait(self.active_tasks)
+            pool.clear()
+
+    def on_task_done(self, future):
+        self.active_tasks.discard(future)
+        if not self.active_tasks:
+            self.worker.is_busy_event.clear()
+        if not future.cancelled() and future.exception() is not None:
+            exc = future.exception()
+            self.spider.report_fatal_error((type(exc), exc, exc.__traceback__))
+
+    async def process_task(self, task):
+        try:
+            prepared = self.setup_task_grab(task)
+            if prepared:
+                grab, grab_config_backup = prepared
+                started = time.time()
+                try:
+                    await grab.arequest()
+                except NETWORK_ERRORS as ex:
+                    exc = ex
+                else:
+                    exc = None
+                self.log_network_request(task, grab, exc, started)
+                self.submit_result(
+                    self.build_result(task, grab, grab_config_backup, exc), task
+                )
+        finally:
+            self.spider.release_task(task)
+            self.release_slot()
+        self.spider.work_counter.dec()
@@ -1,50 +1,95 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
 import sys
 import time
-from queue import Empty, Queue
+import traceback
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from pickle import PicklingError
+from queue import Empty
+from threading import Lock
+from traceback import format_exc
 
-from grab.spider.error import NoTaskHandler
+from grab.base import Grab
+from grab.document import Document
+from grab.spider.error import NoTaskHandler, ParserProcessError, SpiderMisuseError
+from grab.stat import Stat
 
-from .base import BaseService
+from .base import IDLE_WAIT_TIMEOUT, TASK_DONE, WAKEUP, BaseService, ServiceQueue
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # python 3.7
+    resource_tracker = shared_memory = None
+
+logger = logging.getLogger("grab.spider.service.parser")  # pylint: disable=invalid-name
+# Shared memory segments passing response bodies are at least of this size,
+# larger segments are allocated with the size rounded up to the power of two
+MIN_SHARED_BODY_SIZE = 65536
+# Parser process sends collected handler timings to the main process at most
+# once per this number of seconds and when it exits
+PROFILER_SEND_INTERVAL = 5
 
 
 class ParserService(BaseService):
     def __init__(self, spider, pool_size):
         super().__init__(spider)
-        self.input_queue = Queue()
+        self.input_queue = ServiceQueue(spider.work_counter)
         self.pool_size = pool_size
         self.workers_pool = []
+        self.pool_lock = Lock()
         for _ in range(self.pool_size):
             self.workers_pool.append(self.create_worker(self.worker_callback))
         self.supervisor = self.create_worker(self.supervisor_callback)
         self.register_workers(self.workers_pool, self.supervisor)
 
     def check_pool_health(self):
-        to_remove = []
-        for worker in self.workers_pool:
-            if not worker.is_alive():
-                self.spider.stat.inc("parser:worker-restarted")
-                new_worker = self.create_worker(self.worker_callback)
-                self.workers_pool.append(new_worker)
-                new_worker.start()
-                to_remove.append(worker)
-        for worker in to_remove:
-            self.workers_pool.remove(worker)
+        with self.pool_lock:
+            if self.supervisor.stop_event.is_set():
+                return
+            to_remove = []
+            for worker in self.workers_pool:
+                if not worker.is_alive():
+                    self.spider.stat.inc("parser:worker-restarted")
+                    new_worker = self.create_worker(self.worker_callback)
+                    self.workers_pool.append(new_worker)
+                    new_worker.start()
+                    to_remove.append(worker)
+            for worker in to_remove:
+                self.workers_pool.remove(worker)
+
+    def stop(self):
+        # Do not let supervisor start new worker which misses the stop signal
+        with self.pool_lock:
+            super().stop()
 
     def supervisor_callback(self, worker):
         while not worker.stop_event.is_set():
             worker.process_pause_signal()
             self.check_pool_health()
-            time.sleep(1)
+            worker.stop_event.wait(1)
+
+    def wakeup_workers(self):
+        self.input_queue.wakeup(len(self.workers_pool))
 
     def worker_callback(self, worker):
         process_request_count = 0
         while not worker.stop_event.is_set():
             worker.process_pause_signal()
             try:
-                result, task = self.input_queue.get(True, 0.1)
+                item = self.input_queue.get(True, IDLE_WAIT_TIMEOUT)
             except Empty:
                 pass
             else:
+                if item is WAKEUP:
+                    continue
+                result, task = item
+                # Handler could add the same task to the queue again,
+                # the new lease of the task must not be acknowledged
+                lease = task.lease
                 worker.is_busy_event.set()
                 try:
                     process_request_count += 1
@@ -58,8 +103,14 @@ class ParserService(BaseService):
                         )
                         self.spider.stat.inc("parser:handler-not-found")
                     else:
+                        started = time.time()
                         self.execute_task_handler(handler, result, task)
+                        self.log_handler_run(handler, result, task, started)
                         self.spider.stat.inc("parser:handler-processed")
+                    self.submit_task_done(task, lease)
+                    # Not called if the worker fails: the spider must not
+                    # be considered idle until the fatal error is reported
+                    self.input_queue.task_done()
                     if self.spider.parser_requests_per_process:
                         if (
                             process_request_count
@@ -72,17 +123,42 @@ class ParserService(BaseService):
                 finally:
                     worker.is_busy_event.clear()
 
+    def log_handler_run(self, handler, result, task, started):
+        """
+        Update statistics and trace of the task with the completed
+        run of the task handler.
+        """
+        now = time.time()
+        self.spider.log_task_latency("handler", task, now - started, result["grab"])
+        if task.trace_id:
+            if "dispatch_time" in result:
+                self.spider.trace_span(
+                    task, "parser_queue", result["dispatch_time"], started
+                )
+            self.spider.trace_span(
+                task,
+                "handler",
+                started,
+                now,
+                handler=getattr(handler, "__name__", "NONE"),
+            )
+
+    def submit_task_done(self, task, lease):
+        """
+        Let task dispatcher acknowledge the lease of the processed task.
+
+        The marker is put after all items generated by the task handler.
+        """
+        if lease is not None:
+            self.spider.task_dispatcher.input_queue.put(
+                (TASK_DONE, task, {"lease": lease})
+            )
+
     def execute_task_handler(self, handler, result, task):
         # pylint: disable=broad-except
         try:
-            handler_result = handler(result["grab"], task)
-            if handler_result is None:
-                pass
-            else:
-                for item in handler_result:
-                    self.spider.task_dispatcher.input_queue.put(
-                        (item, task, None),
-                    )
+            for item in iterate_handler(self.spider, handler, result["grab"], task):
+                self.spider.task_dispatcher.input_queue.put((item, task, None))
         except Exception as ex:
             self.spider.task_dispatcher.input_queue.put(
                 (
@@ -94,3 +170,562 @@ class ParserService(BaseService):
                     },
                 )
             )
+
+
+def iterate_handler(spider, handler, grab, task):
+    """
+    Call the task handler and return iterable of items produced by it.
+
+    If profiling of handlers is enabled then the handler call and steps
+    of the generator are measured, processing of yielded items is not.
+    """
+    if spider.handler_profiler is None:
+        result = handler(grab, task)
+        return () if result is None else result
+    return spider.handler_profiler.iterate_call(
+        getattr(handler, "__name__", "NONE"), handler, grab, task
+    )
+
+
+class RemoteTraceback(Exception):
+    """
+    Keeps traceback of exception raised in parser process.
+    """
+
+    def __init__(self, tb_text):
+        super().__init__(tb_text)
+        self.tb_text = tb_text
+
+    def __str__(self):
+        return self.tb_text
+
+
+def dump_grab_state(grab):
+    """
+    Return picklable state of Grab instance without the response body.
+    """
+    doc_state = grab.doc.__getstate__()
+    doc_state.update(
+        {
+            "grab": None,
+            "_bytes_body": None,
+            "_unicode_body": None,
+            "_pyquery": None,
+        }
+    )
+    return {
+        "transport": grab.transport_param,
+        "config": grab.dump_config(),
+        "request_head": grab.request_head,
+        "request_body": grab.request_body,
+        "doc": doc_state,
+    }
+
+
+def load_grab_state(state, body):
+    grab = Grab(transport=state["transport"])
+    grab.load_config(state["config"])
+    grab.request_head = state["request_head"]
+    grab.request_body = state["request_body"]
+    doc = Document.__new__(Document)
+    doc.__setstate__(state["doc"])
+    doc.process_grab(grab)
+    if body is not None:
+        doc._bytes_body = body  # pylint: disable=protected-access
+    grab.doc = doc
+    return grab
+
+
+class SharedBodyBuffer:
+    """
+    Shared memory segment which passes response bodies to the parser
+    process of one worker thread.
+
+    The segment is reused for all jobs and replaced with a larger one
+    when the body does not fit into it.
+    """
+
+    def __init__(self):
+        self.shm = None
+
+    def write(self, body):
+        """
+        Copy the body into the segment and return name of the segment.
+        """
+        size = len(body)
+        if self.shm is None or self.shm.size < size:
+            self.close()
+            self.shm = shared_memory.SharedMemory(
+                create=True,
+                size=max(MIN_SHARED_BODY_SIZE, 1 << (size - 1).bit_length()),
+            )
+        self.shm.buf[:size] = body
+        return self.shm.name
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class SharedBodyReader:
+    """
+    Reads response bodies from the shared memory segment in the parser
+    process. The segment stays attached until the main process replaces it.
+    """
+
+    def __init__(self):
+        self.shm = None
+
+    def read(self, name, size):
+        if self.shm is None or self.shm.name != name:
+            self.close()
+            self.shm = shared_memory.SharedMemory(name=name)
+        return bytes(self.shm.buf[:size])
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+
+def setup_parser_process(spider, conn):
+    """
+    Prepare the spider to run task handlers in parser process.
+
+    Returns the function which sends items to the main process.
+    """
+    # KeyboardInterrupt is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Statistics is collected by the main process
+    spider.stat = Stat(logging_period=0)
+
+    def send_item(item, meta=None):
+        try:
+            conn.send(("item", item, meta))
+        except (PicklingError, TypeError, AttributeError) as ex:
+            conn.send(
+                (
+                    "item",
+                    ParserProcessError("Could not send %r: %s" % (item, ex)),
+                    {"from": "parser", "traceback": format_exc()},
+                )
+            )
+
+    # Tasks added directly inside handler go to the main process
+    # pylint: disable=unused-argument
+    def add_task(task, queue=None, raise_error=False):
+        send_item(task)
+        return True
+
+    # pylint: enable=unused-argument
+
+    spider.add_task = add_task
+    return send_item
+
+
+def run_parser_job(spider, job, send_item, body_reader):
+    """
+    Run the task handler and send items produced by it.
+    """
+    shm_name, body_size, body, grab_state, task = job
+    try:
+        if shm_name:
+            body = body_reader.read(shm_name, body_size)
+        grab = load_grab_state(grab_state, body)
+        handler = spider.find_task_handler(task)
+        for item in iterate_handler(spider, handler, grab, task):
+            send_item(item)
+    except Exception as ex:  # pylint: disable=broad-except
+        send_item(ex, {"from": "parser", "traceback": format_exc()})
+
+
+def parser_process_main(spider, conn):
+    """
+    Main loop of parser process.
+
+    The process receives jobs from the `ParserServiceProcess` worker
+    thread and sends back items produced by the task handler.
+    """
+    send_item = setup_parser_process(spider, conn)
+    body_reader = SharedBodyReader()
+    profiler = spider.handler_profiler
+    profiler_send_time = time.time()
+    try:
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                break
+            if job is None:
+                if profiler is not None and profiler.handlers:
+                    conn.send(("profile", profiler))
+                break
+            run_parser_job(spider, job, send_item, body_reader)
+            send_profiler = (
+                profiler is not None
+                and time.time() - profiler_send_time >= PROFILER_SEND_INTERVAL
+            )
+            conn.send(
+                (
+                    "done",
+                    spider.stat.counters,
+                    dict(spider.stat.collections),
+                    profiler if send_profiler else None,
+                )
+            )
+            spider.stat.reset()
+            if send_profiler:
+                profiler.reset()
+                profiler_send_time = time.time()
+    finally:
+        body_reader.close()
+
+
+def run_forked_process(target, *args):
+    """
+    Run the function in the process created by `os.fork` and exit
+    without running cleanup of the parent process.
+    """
+    code = 0
+    try:
+        target(*args)
+    except BaseException:  # pylint: disable=broad-except
+        code = 1
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)  # pylint: disable=protected-access
+
+
+def fork_server_main(spider, sock, parent_sock):
+    """
+    Main loop of the process which forks parser processes.
+
+    The process receives one byte for each requested parser process
+    and sends back the descriptor of the connection to the new process.
+    The new process sends its PID as the first message.
+    """
+    parent_sock.close()
+    # KeyboardInterrupt is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Finished parser processes are reaped by the system
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while sock.recv(1):
+        conn, child_conn = multiprocessing.Pipe()
+        pid = os.fork()
+        if not pid:
+            sock.close()
+            conn.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            child_conn.send(os.getpid())
+            run_forked_process(parser_process_main, spider, child_conn)
+        child_conn.close()
+        reduction.sendfds(sock, [conn.fileno()])
+        conn.close()
+
+
+class ForkedProcess:
+    """
+    Parser process forked by the fork server.
+
+    The process is not a child of the main process, so it is checked
+    and stopped by its PID.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def is_alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def join(self, timeout=None):
+        started = time.time()
+        while self.is_alive():
+            if timeout is not None and time.time() - started > timeout:
+                return
+            time.sleep(0.01)
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+class ParserForkServer:
+    """
+    Process which forks parser processes.
+
+    The fork of the process running threads could deadlock: locks held
+    by other threads stay locked in the child process. The fork server is
+    forked before spider starts its threads, it is single-threaded and
+    forks parser processes on request of worker threads.
+    """
+
+    def __init__(self, mp_context):
+        self.mp_context = mp_context
+        self.proc = None
+        self.sock = None
+        self.lock = Lock()
+
+    def start(self, spider):
+        if resource_tracker is not None:
+            # Parser processes must share resource tracker with the main
+            # process, otherwise their own tracker would destroy shared
+            # memory segments created by the main process
+            resource_tracker.ensure_running()
+        self.sock, child_sock = socket.socketpair()
+        self.proc = self.mp_context.Process(
+            target=fork_server_main,
+            args=(spider, child_sock, self.sock),
+            name="parser-fork-server",
+        )
+        self.proc.daemon = True
+        self.proc.start()
+        child_sock.close()
+
+    def fork(self):
+        """
+        Start new parser process.
+
+        Returns (process, connection) pair or None if the fork server
+        has been stopped.
+        """
+        with self.lock:
+            if self.sock is None:
+                return None
+            self.sock.sendall(b"f")
+            fds = reduction.recvfds(self.sock, 1)
+        conn = Connection(fds[0])
+        return ForkedProcess(conn.recv()), conn
+
+    def stop(self):
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+        if self.proc is not None:
+            self.proc.join(1)
+            if self.proc.is_alive():
+                self.proc.terminate()
+                self.proc.join()
+            self.proc = None
+
+
+class ParserProcessSlot:
+    """
+    Parser process of one worker thread and the shared memory segment
+    passing response bodies to it.
+    """
+
+    def __init__(self):
+        self.proc = None
+        self.conn = None
+        self.request_count = 0
+        self.body_buffer = None if shared_memory is None else SharedBodyBuffer()
+
+
+class ParserServiceProcess(ParserService):
+    """
+    Parser service which runs task handlers in separate processes.
+
+    Each worker thread owns one parser process. Response body is passed
+    to the process through shared memory, other response data is pickled.
+    Items generated by handler are sent back to the worker thread which
+    puts them into the task dispatcher queue. The parser process is
+    restarted after it has processed `parser_requests_per_process` jobs.
+
+    Parser processes are forked by `ParserForkServer` which is started
+    by the `start` method, the service must be started before other
+    threads of the spider.
+    """
+
+    def __init__(self, spider, pool_size):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise SpiderMisuseError(
+                "Process parser service requires fork start method"
+                " which is not available on this platform"
+            )
+        self.fork_server = ParserForkServer(multiprocessing.get_context("fork"))
+        super().__init__(spider, pool_size)
+
+    def start(self):
+        self.fork_server.start(self.spider)
+        super().start()
+
+    def stop(self):
+        super().stop()
+        self.fork_server.stop()
+
+    def start_process(self, slot):
+        """
+        Start the parser process of the slot.
+
+        Returns False if the service is stopped.
+        """
+        forked = self.fork_server.fork()
+        if forked is None:
+            return False
+        slot.proc, slot.conn = forked
+        self.spider.stat.inc("parser:process-started")
+        return True
+
+    def stop_process(self, slot):
+        if slot.proc is None:
+            return
+        try:
+            slot.conn.send(None)
+            # Handler timings which have not been sent yet
+            if slot.conn.poll(1):
+                msg = slot.conn.recv()
+                if msg[0] == "profile" and self.spider.handler_profiler is not None:
+                    self.spider.handler_profiler.merge(msg[1])
+        except (OSError, ValueError, EOFError):
+            pass
+        slot.proc.join(1)
+        if slot.proc.is_alive():
+            slot.proc.terminate()
+            slot.proc.join()
+        slot.conn.close()
+        slot.proc, slot.conn = None, None
+        slot.request_count = 0
+
+    def worker_callback(self, worker):
+        slot = ParserProcessSlot()
+        try:
+            while not worker.stop_event.is_set():
+                worker.process_pause_signal()
+                try:
+                    item = self.input_queue.get(True, IDLE_WAIT_TIMEOUT)
+                except Empty:
+                    continue
+                if item is WAKEUP:
+                    continue
+                result, task = item
+                worker.is_busy_event.set()
+                try:
+                    self.process_task(worker, slot, result, task)
+                    self.input_queue.task_done()
+                    limit = self.spider.parser_requests_per_process
+                    if limit and slot.request_count >= limit:
+                        self.spider.stat.inc("parser:handler-req-limit")
+                        self.stop_process(slot)
+                finally:
+                    worker.is_busy_event.clear()
+        finally:
+            self.stop_process(slot)
+            if slot.body_buffer is not None:
+                slot.body_buffer.close()
+
+    def process_task(self, worker, slot, result, task):
+        lease = task.lease
+        try:
+            handler = self.spider.find_task_handler(task)
+        except NoTaskHandler as ex:
+            self.spider.task_dispatcher.input_queue.put(
+                (ex, task, {"exc_info": sys.exc_info()})
+            )
+            self.spider.stat.inc("parser:handler-not-found")
+        else:
+            if not self.run_task_handler(worker, slot, handler, result, task):
+                if worker.stop_event.is_set():
+                    # Task processing has been interrupted,
+                    # the lease expires and the task is retried
+                    lease = None
+        self.submit_task_done(task, lease)
+
+    def run_task_handler(self, worker, slot, handler, result, task):
+        """
+        Run the task handler in the parser process.
+
+        Returns False if the parser process has died or could not be started.
+        """
+        if slot.proc is None and not self.start_process(slot):
+            return False
+        started = time.time()
+        if self.process_job(worker, slot, result, task):
+            self.log_handler_run(handler, result, task, started)
+            self.spider.stat.inc("parser:handler-processed")
+            slot.request_count += 1
+            return True
+        self.stop_process(slot)
+        return False
+
+    def process_job(self, worker, slot, result, task):
+        """
+        Send the job to the parser process and wait for its completion.
+
+        Returns False if the parser process has died.
+        """
+        self.send_job(slot, result["grab"], task)
+        if self.receive_job_results(worker, slot, task):
+            return True
+        if not worker.stop_event.is_set():
+            logger.error("Parser process %d has died", slot.proc.pid)
+            self.spider.stat.inc("parser:process-died")
+            try:
+                raise ParserProcessError(
+                    "Parser process died while processing task %s" % task.name
+                )
+            except ParserProcessError as ex:
+                self.spider.task_dispatcher.input_queue.put(
+                    (ex, task, {"exc_info": sys.exc_info(), "from": "parser"})
+                )
+        return False
+
+    def send_job(self, slot, grab, task):
+        shm_name = None
+        body = None
+        body_size = 0
+        # File-backed body is read from the file by the parser process
+        if not grab.doc.body_path:
+            body = grab.doc.body or b""
+            if slot.body_buffer is not None and body:
+                shm_name = slot.body_buffer.write(body)
+                body_size = len(body)
+                body = None
+        slot.conn.send((shm_name, body_size, body, dump_grab_state(grab), task))
+
+    def receive_job_results(self, worker, slot, task):
+        """
+        Process items sent by the parser process until the job is done.
+
+        Returns False if the parser process has died.
+        """
+        while True:
+            if slot.conn.poll(0.1):
+                try:
+                    msg = slot.conn.recv()
+                except EOFError:
+                    return False
+                if msg[0] == "done":
+                    self.merge_process_stat(msg[1], msg[2], msg[3])
+                    return True
+                self.process_item(msg[1], task, msg[2])
+            elif not slot.proc.is_alive() or worker.stop_event.is_set():
+                return False
+
+    def process_item(self, item, task, meta):
+        if meta is not None:
+            item.__cause__ = RemoteTraceback(meta["traceback"])
+            meta = {
+                "exc_info": (type(item), item, None),
+                "from": meta["from"],
+            }
+        self.spider.task_dispatcher.input_queue.put((item, task, meta))
+
+    def merge_process_stat(self, counters, collections, profiler=None):
+        for key, val in counters.items():
+            self.spider.stat.inc(key, val)
+        for key, items in collections.items():
+            for item in items:
+                self.spider.stat.collect(key, item)
+        if profiler is not None and self.spider.handler_profiler is not None:
+            self.spider.handler_profiler.merge(profiler)
@@ -1,16 +1,17 @@
-from queue import Empty, Queue
+import time
+from queue import Empty
 
 from grab.error import ResponseNotValid
 from grab.spider.error import FatalError, SpiderError
 from grab.spider.task import Task
 
-from .base import BaseService
+from .base import IDLE_WAIT_TIMEOUT, TASK_DONE, WAKEUP, BaseService, ServiceQueue
 
 
 class TaskDispatcherService(BaseService):
     def __init__(self, spider):
         super().__init__(spider)
-        self.input_queue = Queue()
+        self.input_queue = ServiceQueue(spider.work_counter)
         self.worker = self.create_worker(self.worker_callback)
         self.register_workers(self.worker)
 
@@ -20,12 +21,23 @@ class TaskDispatcherService(BaseService):
     def worker_callback(self, worker):
         while not worker.stop_event.is_set():
             worker.process_pause_signal()
+            wait_time = self.spider.extend_task_leases()
+            if wait_time is None or wait_time > IDLE_WAIT_TIMEOUT:
+                wait_time = IDLE_WAIT_TIMEOUT
             try:
-                result, task, meta = self.input_queue.get(True, 0.1)
+                item = self.input_queue.get(True, wait_time)
             except Empty:
                 pass
             else:
-                self.process_service_result(result, task, meta)
+                if item is WAKEUP:
+                    continue
+                self.process_service_result(*item)
+                # Not called if the worker fails: the spider must not
+                # be considered idle until the fatal error is reported
+                self.input_queue.task_done()
+
+    def wakeup_workers(self):
+        self.input_queue.wakeup()
 
     def process_service_result(self, result, task, meta=None):
         """
@@ -39,6 +51,7 @@ class TaskDispatcherService(BaseService):
         * Arbitrary exception
         * Network response:
             {ok, ecode, emsg, error_abbr, exc, grab, grab_config_backup}
+        * TASK_DONE marker, it has meta {"lease": <...>}
 
         Exception can come only from parser_service and it always has
         meta {"from": "parser", "exc_info": <...>}
@@ -50,14 +63,24 @@ class TaskDispatcherService(BaseService):
             self.spider.add_task(result)
         elif result is None:
             pass
+        elif result is TASK_DONE:
+            self.spider.ack_task(task, meta["lease"])
         elif isinstance(result, ResponseNotValid):
-            self.spider.add_task(task.clone())
             error_code = result.__class__.__name__.replace("_", "-")
+            self.spider.trace_span(task, "retry", time.time(), error=error_code)
+            self.spider.add_task(task.clone())
             self.spider.stat.inc("integrity:%s" % error_code)
         elif isinstance(result, Exception):
             if task:
                 handler = self.spider.find_task_handler(task)
                 handler_name = getattr(handler, "__name__", "NONE")
+                self.spider.trace_span(
+                    task,
+                    "error",
+                    time.time(),
+                    error=result.__class__.__name__,
+                    handler=handler_name,
+                )
             else:
                 handler_name = "NA"
             self.spider.process_parser_error(
@@ -66,7 +89,7 @@ class TaskDispatcherService(BaseService):
                 meta["exc_info"],
             )
             if isinstance(result, FatalError):
-                self.spider.fatal_error_queue.put(meta["exc_info"])
+                self.spider.report_fatal_error(meta["exc_info"])
         elif isinstance(result, dict) and "grab" in result:
             # TODO: Move to network service
             # starts
@@ -78,6 +101,7 @@ class TaskDispatcherService(BaseService):
             elif result["ok"]:
                 res_code = result["grab"].doc.code
                 is_valid = self.spider.is_valid_network_response_code(res_code, task)
+            self.log_dispatched_result(result, task, is_valid)
             if is_valid:
                 self.spider.parser_service.input_queue.put((result, task))
             else:
@@ -90,6 +114,25 @@ class TaskDispatcherService(BaseService):
                 if self.spider.network_try_limit > 0:
                     task.setup_grab_config(result["grab_config_backup"])
                     self.spider.add_task(task)
+                else:
+                    self.spider.ack_task(task)
             self.spider.stat.inc("spider:request")
         else:
             raise SpiderError("Unknown result received from a service: %s" % result)
+
+    def log_dispatched_result(self, result, task, is_valid):
+        """
+        Log time passed since the network service has submitted the result.
+
+        The time of dispatching is saved in the result, parser service
+        counts the time of waiting in its queue from this moment.
+        """
+        now = result["dispatch_time"] = time.time()
+        if "submit_time" in result:
+            self.spider.log_task_latency(
+                "dispatcher", task, now - result["submit_time"], result["grab"]
+            )
+            if task.trace_id:
+                self.spider.trace_span(
+                    task, "dispatch", result["submit_time"], now, valid=is_valid
+                )
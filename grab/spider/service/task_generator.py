@@ -9,9 +9,19 @@ class TaskGeneratorService(BaseService):
         self.real_generator = real_generator
         self.task_queue_threshold = max(200, self.spider.thread_number * 2)
         self.worker = self.create_worker(self.worker_callback)
+        # The service is busy until the generator is exhausted
+        self.worker.is_busy_event.set()
         self.register_workers(self.worker)
 
     def worker_callback(self, worker):
+        try:
+            self.generate_tasks(worker)
+        finally:
+            worker.is_busy_event.clear()
+            # Let the spider check if the work is done
+            self.spider.work_counter.notify()
+
+    def generate_tasks(self, worker):
         while not worker.stop_event.is_set():
             worker.process_pause_signal()
             queue_size = max(
@@ -1,21 +1,83 @@
 from __future__ import absolute_import
 
+from copy import copy
 from datetime import datetime, timedelta
 
-from grab.base import copy_config
+from grab.base import MUTABLE_CONFIG_KEYS, copy_config, default_config
 from grab.error import raise_feature_is_deprecated
 from grab.spider.error import SpiderMisuseError
 
+DEFAULT_GRAB_CONFIG = default_config()
+
+
+def diff_grab_config(config):
+    """
+    Return items of grab config which differ from the default config.
+
+    The URL is not included: it is stored in `url` attribute of the task.
+    Mutable values are copied like `copy_config` does.
+    """
+    diff = {}
+    for key, val in config.items():
+        if key == "url":
+            continue
+        if key in DEFAULT_GRAB_CONFIG and DEFAULT_GRAB_CONFIG[key] == val:
+            continue
+        diff[key] = copy(val) if key in MUTABLE_CONFIG_KEYS else val
+    return diff
+
+
+def copy_grab_config_diff(diff):
+    if diff is None:
+        return None
+    diff = diff.copy()
+    for key in MUTABLE_CONFIG_KEYS:
+        if key in diff:
+            diff[key] = copy(diff[key])
+    return diff
+
 
 class BaseTask:
-    pass
+    __slots__ = ()
 
 
 class Task(BaseTask):
     """
     Task for spider.
+
+    Standard attributes are stored in slots, custom attributes passed
+    to the constructor or `clone` method or assigned to the task later
+    are stored in `custom_attrs` dict which is created only for tasks
+    having such attributes.
+
+    Grab config of the task is stored as the diff against the default
+    config, `grab_config` property builds the full config on first access
+    and caches it. The diff is built again when the state of the task
+    is saved.
     """
 
+    __slots__ = (
+        "name",
+        "url",
+        "grab_config_diff",
+        "valid_status",
+        "schedule_time",
+        "fallback_name",
+        "priority_set_explicitly",
+        "priority",
+        "network_try_count",
+        "task_try_count",
+        "use_proxylist",
+        "raw",
+        "callback",
+        "dedup",
+        "lease",
+        "queue_time",
+        "trace_id",
+        "_grab_config",
+        "custom_attrs",
+    )
+
     def __init__(
         self,
         name=None,
@@ -32,6 +94,7 @@ class Task(BaseTask):
         raw=False,
         callback=None,
         fallback_name=None,
+        dedup=True,
         # deprecated
         disable_cache=False,
         refresh_cache=False,
@@ -93,13 +156,18 @@ class Task(BaseTask):
                 raised if such 'task_*' handler does not exist.
             :param fallback_name: the name of method that is called when spider
                 gives up to do the task (due to multiple network errors)
+            :param dedup: if `dedup` is False then the task is not checked
+                by the filter of duplicate tasks configured with
+                `setup_dedup` method of spider
 
             Any non-standard named arguments passed to `Task` constructor will
             be saved as attributes of the object. You can get their values
             later as attributes or with `get` method which allows to use
             default value if attribute does not exist.
         """
-        self.grab_config = None
+        self.grab_config_diff = None
+        self._grab_config = None
+        self.custom_attrs = None
         if disable_cache or refresh_cache or cache_timeout:
             raise_feature_is_deprecated("Cache feature")
 
@@ -136,11 +204,11 @@ class Task(BaseTask):
         elif grab_config:
             self.setup_grab_config(grab_config)
         else:
-            self.grab_config = None
             self.url = url
 
         if valid_status is None:
-            self.valid_status = []
+            # Shared empty tuple, most of tasks do not use this option
+            self.valid_status = ()
         else:
             self.valid_status = valid_status
 
@@ -154,9 +222,17 @@ class Task(BaseTask):
         self.use_proxylist = use_proxylist
         self.raw = raw
         self.callback = callback
-        self.coroutines_stack = []
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+        self.dedup = dedup
+        # Lease of the task taken from the task queue, it is acknowledged
+        # when the task is processed
+        self.lease = None
+        # Time when the task has been put into the task queue
+        # or its schedule time if it is delayed
+        self.queue_time = None
+        # ID of the trace of the task or `NOT_SAMPLED` value,
+        # see `grab.spider.tracing`
+        self.trace_id = None
+        self.update_attrs(kwargs)
 
     def get(self, key, default=None):
         """
@@ -165,6 +241,68 @@ class Task(BaseTask):
         """
         return getattr(self, key, default)
 
+    def __getattr__(self, key):
+        # Called only if the task has no standard attribute with such name
+        if key != "custom_attrs" and self.custom_attrs and key in self.custom_attrs:
+            return self.custom_attrs[key]
+        raise AttributeError("'Task' object has no attribute '%s'" % key)
+
+    def __setattr__(self, key, value):
+        if key in OBJECT_ATTRS:
+            object.__setattr__(self, key, value)
+        else:
+            if self.custom_attrs is None:
+                self.custom_attrs = {}
+            self.custom_attrs[key] = value
+
+    def update_attrs(self, attrs):
+        """
+        Set standard attributes and save other items as custom attributes.
+        """
+        for key, value in attrs.items():
+            if key in STANDARD_ATTRS:
+                setattr(self, key, value)
+            else:
+                if self.custom_attrs is None:
+                    self.custom_attrs = {}
+                self.custom_attrs[key] = value
+
+    @property
+    def grab_config(self):
+        config = self._grab_config
+        if config is None:
+            if self.grab_config_diff is None:
+                return None
+            config = default_config()
+            config.update(self.grab_config_diff)
+            self._grab_config = config
+            self.grab_config_diff = None
+        config["url"] = self.url
+        return config
+
+    @grab_config.setter
+    def grab_config(self, config):
+        self._grab_config = None
+        self.grab_config_diff = None if config is None else diff_grab_config(config)
+
+    def __getstate__(self):
+        state = dict(self.custom_attrs) if self.custom_attrs else {}
+        for key in TASK_SLOTS:
+            state[key] = getattr(self, key)
+        if self._grab_config is not None:
+            state["grab_config_diff"] = diff_grab_config(self._grab_config)
+        return state
+
+    def __setstate__(self, state):
+        # States saved by previous versions could miss some attributes
+        self.grab_config_diff = None
+        self._grab_config = None
+        self.custom_attrs = None
+        self.lease = None
+        self.queue_time = None
+        self.trace_id = None
+        self.update_attrs(state)
+
     def process_delay_option(self, delay):
         if delay:
             self.schedule_time = datetime.utcnow() + timedelta(seconds=delay)
@@ -172,7 +310,7 @@ class Task(BaseTask):
             self.schedule_time = None
 
     def setup_grab_config(self, grab_config):
-        self.grab_config = copy_config(grab_config)
+        self.grab_config = grab_config
         self.url = grab_config["url"]
 
     def clone(self, **kwargs):
@@ -184,12 +322,32 @@ class Task(BaseTask):
         """
 
         # First, create exact copy of the current Task object
-        attr_copy = self.__dict__.copy()
-        if attr_copy.get("grab_config") is not None:
-            del attr_copy["url"]
-        if not attr_copy["priority_set_explicitly"]:
-            attr_copy["priority"] = None
-        task = Task(**attr_copy)
+        # without calling the constructor
+        # Attributes are copied one by one: it is much faster than
+        # the loop over names of slots
+        task = Task.__new__(Task)
+        task.name = self.name
+        task.url = self.url
+        task.grab_config_diff = copy_grab_config_diff(self.grab_config_diff)
+        task._grab_config = (
+            None if self._grab_config is None else copy_config(self._grab_config)
+        )
+        task.valid_status = self.valid_status
+        task.fallback_name = self.fallback_name
+        task.priority_set_explicitly = self.priority_set_explicitly
+        task.priority = self.priority if self.priority_set_explicitly else None
+        task.network_try_count = self.network_try_count
+        task.task_try_count = self.task_try_count
+        task.use_proxylist = self.use_proxylist
+        task.raw = self.raw
+        task.callback = self.callback
+        task.dedup = self.dedup
+        task.lease = None
+        task.queue_time = None
+        task.trace_id = self.trace_id
+        task.custom_attrs = (
+            None if self.custom_attrs is None else self.custom_attrs.copy()
+        )
 
         # Reset some task properties if they have not
         # been set explicitly in kwargs
@@ -219,14 +377,15 @@ class Task(BaseTask):
             del kwargs["grab_config"]
         elif kwargs.get("url"):
             task.url = kwargs["url"]
-            if task.grab_config:
-                task.grab_config["url"] = kwargs["url"]
             del kwargs["url"]
 
-        for key, value in kwargs.items():
-            setattr(task, key, value)
+        task.update_attrs(kwargs)
 
         task.process_delay_option(None)
+        # Retries continue the trace of the task or stay not sampled,
+        # the task with other URL gets its own sampling decision
+        if task.url != self.url:
+            task.trace_id = None
 
         return task
 
@@ -249,3 +408,14 @@ class Task(BaseTask):
             if hasattr(spider, fb_name):
                 return getattr(spider, fb_name)
         return None
+
+
+# Names of slots holding standard attributes of the task
+TASK_SLOTS = tuple(
+    x for x in Task.__slots__ if x not in ("_grab_config", "custom_attrs")
+)
+# Names of attributes which are not saved as custom attributes of the task
+STANDARD_ATTRS = frozenset(TASK_SLOTS + ("grab_config",))
+# Names of attributes which are assigned to the task object itself,
+# other attributes are assigned to `custom_attrs` dict
+OBJECT_ATTRS = frozenset(Task.__slots__ + ("grab_config",))
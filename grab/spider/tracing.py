@@ -0,0 +1,103 @@
+"""
+Tracing of spider tasks.
+
+The trace of sampled task collects timestamped spans of its processing
+stages: adding to the task queue, waiting in the task queue, network
+request, dispatching of the network result, waiting in the parser queue
+and the task handler. Only the ID of the trace is stored in
+`Task.trace_id` attribute: each span is exported when it is recorded and
+spans of one task are linked by `trace_id` value. Retries of the task
+continue the same trace, retries of the task which is not sampled are not
+sampled too.
+"""
+import json
+import random
+import uuid
+from threading import Lock
+
+from grab.spider.error import SpiderMisuseError
+
+# Value of `Task.trace_id` of the task which is not sampled
+NOT_SAMPLED = ""
+
+
+class JsonlSpanExporter:
+    """
+    Append spans to the file, one JSON object per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span, default=str) + "\n"
+        with self.lock:
+            if self.file is None:
+                # pylint: disable=consider-using-with
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class Tracer:
+    """
+    Starts traces of sampled tasks and exports their spans.
+
+    :param sample_rate: share of tasks which are traced, from 0 to 1
+    :param path: spans are appended to this JSONL file
+    :param sink: callable which receives each span as dict
+    """
+
+    def __init__(self, sample_rate=1.0, path=None, sink=None):
+        if not 0 <= sample_rate <= 1:
+            raise SpiderMisuseError("Option sample_rate must be in [0, 1] range")
+        if path is None and sink is None:
+            raise SpiderMisuseError("Option path or sink is required for tracing")
+        self.sample_rate = sample_rate
+        self.file_exporter = None if path is None else JsonlSpanExporter(path)
+        self.exporters = [x for x in (self.file_exporter, sink) if x is not None]
+
+    def start_trace(self, task):
+        """
+        Decide whether the task is sampled and set its `trace_id`.
+
+        Returns the new trace ID or None if the task is not sampled.
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            task.trace_id = NOT_SAMPLED
+            return None
+        task.trace_id = uuid.uuid4().hex
+        return task.trace_id
+
+    def add_span(self, task, name, start, end=None, **attrs):
+        """
+        Export the span of the trace of the task.
+
+        Spans without `end` time are instant events.
+        """
+        if end is None:
+            end = start
+        span = {
+            "trace_id": task.trace_id,
+            "task": task.name,
+            "url": task.url,
+            "span": name,
+            "start": start,
+            "end": end,
+            "duration": end - start,
+            "attrs": attrs,
+        }
+        for exporter in self.exporters:
+            exporter(span)
+
+    def close(self):
+        if self.file_exporter is not None:
+            self.file_exporter.close()
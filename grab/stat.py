@@ -2,16 +2,360 @@
 This module contains Stat class. It is used inside
 Grab::Spider to collect statistics about events happening
 during the scraping session.
+
+Each thread increments counters in its own shard without locking,
+shards are summed up when counters are read. Shards of finished threads
+are added to the base counters. Progress line is logged by the background
+thread started with `start_logging` method.
+
+Latencies and other positive values are recorded into histograms
+with `observe` method, histograms are also sharded per thread.
 """
 import logging
+import math
+import random
+import sys
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from contextlib import contextmanager
+from threading import Event, Lock, Thread, current_thread, local
 
+from grab.error import GrabMisuseError
 from grab.util.warning import warn
 
 DEFAULT_SPEED_KEY = "spider:request-processed"
 DEFAULT_LOGGING_PERIOD = 1
+# Max. number of cached keys built from one template by `format_key`
+KEY_CACHE_SIZE = 1000
+# Default max. number of values kept by bounded collection
+DEFAULT_COLLECTION_SIZE = 1000
+# Number of histogram buckets per power of two, relative error
+# of percentiles is less than 1 / HISTOGRAM_SUB_BUCKETS
+HISTOGRAM_SUB_BUCKETS = 16
+# Smaller values (including zero) go to the bucket of this value
+HISTOGRAM_MIN_VALUE = 1e-6
+# Default max. number of histograms in one shard, values of
+# new histograms are dropped when the limit is reached
+DEFAULT_MAX_HISTOGRAMS = 10000
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+
+class BoundedCollection:
+    """
+    Collection which keeps limited number of values.
+
+    The `total` attribute is the number of all values added
+    to the collection.
+    """
+
+    def __init__(self, size=DEFAULT_COLLECTION_SIZE):
+        self.size = size
+        self.total = 0
+        self.lock = Lock()
+
+    def append(self, val):
+        raise NotImplementedError
+
+    def merge(self, other):
+        """
+        Add values of other collection of the same type.
+        """
+        raise NotImplementedError
+
+    def values(self):
+        raise NotImplementedError
+
+    def extend(self, values):
+        if isinstance(values, self.__class__):
+            self.merge(values)
+        else:
+            for val in values:
+                self.append(val)
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __len__(self):
+        return len(self.values())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def __repr__(self):
+        return "<%s: %d of %d values>" % (
+            self.__class__.__name__,
+            len(self),
+            self.total,
+        )
+
+
+class ReservoirSample(BoundedCollection):
+    """
+    Uniform random sample of values.
+    """
+
+    def __init__(self, size=DEFAULT_COLLECTION_SIZE):
+        super().__init__(size)
+        self.items = []
+
+    def append(self, val):
+        with self.lock:
+            self.total += 1
+            if len(self.items) < self.size:
+                self.items.append(val)
+            else:
+                pos = random.randrange(self.total)
+                if pos < self.size:
+                    self.items[pos] = val
+
+    def merge(self, other):
+        with self.lock:
+            own, other_items = list(self.items), list(other.items)
+            random.shuffle(own)
+            random.shuffle(other_items)
+            total = self.total + other.total
+            # Each value of the merged sample is taken from one of samples
+            # with probability proportional to the number of its values
+            items = []
+            while len(items) < self.size and (own or other_items):
+                if other_items and (not own or random.randrange(total) < other.total):
+                    items.append(other_items.pop())
+                else:
+                    items.append(own.pop())
+            self.items = items
+            self.total = total
+
+    def values(self):
+        return list(self.items)
+
+
+class TopValues(BoundedCollection):
+    """
+    Most frequent values with their counts.
+
+    Counts of at most `2 * size` values are tracked, counts of less
+    frequent values are dropped, so counts of rare values are approximate.
+    """
+
+    def __init__(self, size=DEFAULT_COLLECTION_SIZE):
+        super().__init__(size)
+        self.counts = {}
+
+    def append(self, val):
+        with self.lock:
+            self.total += 1
+            self.counts[val] = self.counts.get(val, 0) + 1
+            if len(self.counts) > self.size * 2:
+                self.counts = dict(self.most_common())
+
+    def merge(self, other):
+        with self.lock:
+            for val, count in other.counts.items():
+                self.counts[val] = self.counts.get(val, 0) + count
+            self.total += other.total
+            if len(self.counts) > self.size * 2:
+                self.counts = dict(self.most_common())
+
+    def most_common(self):
+        """
+        Return list of (value, count) items ordered by count.
+        """
+        items = sorted(self.counts.items(), key=lambda x: x[1], reverse=True)
+        return items[: self.size]
+
+    def values(self):
+        return [x[0] for x in self.most_common()]
+
+
+class RecentValues(BoundedCollection):
+    """
+    Most recently added values.
+    """
+
+    def __init__(self, size=DEFAULT_COLLECTION_SIZE):
+        super().__init__(size)
+        self.items = deque(maxlen=size)
+
+    def append(self, val):
+        with self.lock:
+            self.total += 1
+            self.items.append(val)
+
+    def merge(self, other):
+        with self.lock:
+            self.items.extend(other.items)
+            self.total += other.total
+
+    def values(self):
+        return list(self.items)
+
+
+COLLECTION_CLASSES = {
+    "reservoir": ReservoirSample,
+    "top": TopValues,
+    "recent": RecentValues,
+}
+
+
+class CollectionDict(dict):
+    """
+    Dict of collections which creates missing collections
+    of configured types.
+    """
+
+    def __init__(self, factories):
+        super().__init__()
+        self.factories = factories
+        self.lock = Lock()
+
+    def __missing__(self, key):
+        factory = self.factories.get(key, list)
+        with self.lock:
+            return self.setdefault(key, factory())
+
+
+class CounterDict(dict):
+    """
+    Snapshot of counters returned by `Stat.counters`.
+
+    Missing counters are zero. Values assigned to items are stored in
+    the stat with `Stat.set` method, so `stat.counters[key] += 1` works
+    as it did when counters were stored in the plain dict.
+    """
+
+    def __init__(self, stat, values):
+        super().__init__(values)
+        self.stat = stat
+
+    def __missing__(self, key):
+        return 0
+
+    def __setitem__(self, key, val):
+        self.stat.set(key, val)
+        super().__setitem__(key, val)
+
+    def update(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        for key, val in dict(*args, **kwargs).items():
+            self[key] = val
+
+    def setdefault(self, key, default=0):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def raise_misuse_error(self, *args, **kwargs):
+        raise GrabMisuseError(
+            "Counters could not be removed, use `Stat.set` method to change them"
+        )
+
+    __delitem__ = pop = popitem = clear = raise_misuse_error
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+def get_collection_total(collection):
+    """
+    Return number of values added to the collection.
+    """
+    return getattr(collection, "total", None) or len(collection)
+
+
+def get_bucket_index(value):
+    mantissa, exponent = math.frexp(max(value, HISTOGRAM_MIN_VALUE))
+    # Mantissa is in [0.5, 1) range
+    return exponent * HISTOGRAM_SUB_BUCKETS + int(
+        (mantissa - 0.5) * 2 * HISTOGRAM_SUB_BUCKETS
+    )
+
+
+def get_bucket_bound(index):
+    """
+    Return upper bound of values of the bucket.
+    """
+    exponent, sub_index = divmod(index, HISTOGRAM_SUB_BUCKETS)
+    return math.ldexp(0.5 + (sub_index + 1) / (2 * HISTOGRAM_SUB_BUCKETS), exponent)
+
+
+class Histogram:
+    """
+    Histogram of positive values with logarithmic buckets.
+
+    Only counts of non-empty buckets are stored, so the histogram takes
+    constant memory regardless of the number of values.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        index = get_bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        # Copying of the dict is not interrupted by other threads
+        for index, count in dict(other.buckets).items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent):
+        """
+        Return the value which is greater than or equal to `percent`
+        percents of values or None if histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return max(self.min, min(get_bucket_bound(index), self.max))
+        return self.max
+
+    def summary(self, percentiles=DEFAULT_PERCENTILES):
+        """
+        Return dict with count, sum, min, max, mean and percentiles
+        (p50, p90, ...) of values.
+        """
+        result = {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+        }
+        for percent in percentiles:
+            result["p%s" % percent] = self.percentile(percent)
+        return result
+
+    def __repr__(self):
+        return "<Histogram: %d values>" % self.count
 
 
 class Stat:
@@ -22,7 +366,15 @@ class Stat:
         logging_period=DEFAULT_LOGGING_PERIOD,
         speed_key=DEFAULT_SPEED_KEY,
         extra_speed_keys=None,
+        collection_kinds=None,
+        max_histograms=DEFAULT_MAX_HISTOGRAMS,
     ):
+        """
+        :param collection_kinds: {key: kind} dict of bounded collections,
+            see `setup_collection`
+        :param max_histograms: max. number of histograms created
+            by one thread
+        """
         self.speed_key = speed_key
         self.setup_speed_keys(speed_key, extra_speed_keys)
         self.time = time.time()
@@ -32,7 +384,17 @@ class Stat:
         self.logger_name = logger_name
         self.logger = logging.getLogger(logger_name)
         self.setup_logging_file(log_file)
+        self.lock = Lock()
+        self.logging_thread = None
+        self.logging_stopped = Event()
+        self.key_cache = {}
+        self.max_histograms = max_histograms
+        # Factories of bounded collections by keys
+        self.collection_factories = {}
         self.reset()
+        if collection_kinds:
+            for key, kind in collection_kinds.items():
+                self.setup_collection(key, kind)
 
     def setup_speed_keys(self, speed_key, extra_keys):
         keys = [speed_key]
@@ -41,35 +403,182 @@ class Stat:
         self.speed_keys = keys
 
     def reset(self):
-        self.counters = defaultdict(int)
-        self.collections = defaultdict(list)
+        with self.lock:
+            # Values of counters which are not stored in shards:
+            # corrections made by `set` method and counters
+            # of finished threads
+            self.base_counters = defaultdict(int)
+            # (thread, counters) items, each thread changes only its own shard
+            self.shards = []
+            # Histograms of finished threads
+            self.base_histograms = {}
+            # (thread, histograms) items
+            self.histogram_shards = []
+            self.local = local()
+        self.collections = CollectionDict(self.collection_factories)
         self.counters_prev = defaultdict(int)
 
+    def setup_collection(self, key, kind="reservoir", size=DEFAULT_COLLECTION_SIZE):
+        """
+        Keep limited number of values in the collection.
+
+        :param kind: "reservoir" (random sample of values), "top" (most
+            frequent values with counts), "recent" (most recently added
+            values) or None (all values are kept)
+        :param size: max. number of values
+        """
+        if kind is None:
+            self.collection_factories.pop(key, None)
+            return
+        if kind not in COLLECTION_CLASSES:
+            raise GrabMisuseError("Unknown type of stat collection: %s" % kind)
+        cls = COLLECTION_CLASSES[kind]
+        self.collection_factories[key] = lambda: cls(size)
+        if key in self.collections:
+            collection = cls(size)
+            collection.extend(self.collections[key])
+            self.collections[key] = collection
+
+    @property
+    def counters(self):
+        """
+        Return `CounterDict` with the sum of counters of all threads.
+
+        Each access sums up all shards, use `get_counter` method
+        to get the value of one counter.
+        """
+        with self.lock:
+            self.fold_finished_shards()
+            result = dict(self.base_counters)
+            shards = [x[1] for x in self.shards]
+        for shard in shards:
+            # Copying of the dict is not interrupted by other threads
+            for key, val in dict(shard).items():
+                result[key] = result.get(key, 0) + val
+        return CounterDict(self, result)
+
+    def get_counter(self, key):
+        """
+        Return the sum of counter of all threads.
+        """
+        with self.lock:
+            val = self.base_counters.get(key, 0)
+            shards = [x[1] for x in self.shards]
+        return val + sum(x.get(key, 0) for x in shards)
+
+    def fold_finished_shards(self):
+        """
+        Add counters and histograms of finished threads to base counters
+        and histograms. It must be called with the lock held.
+        """
+        shards = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                shards.append((thread, shard))
+            else:
+                for key, val in shard.items():
+                    self.base_counters[key] += val
+        self.shards = shards
+        histogram_shards = []
+        for thread, shard in self.histogram_shards:
+            if thread.is_alive():
+                histogram_shards.append((thread, shard))
+            else:
+                for key, hist in shard.items():
+                    if key in self.base_histograms:
+                        self.base_histograms[key].merge(hist)
+                    else:
+                        self.base_histograms[key] = hist
+        self.histogram_shards = histogram_shards
+
+    def create_shard(self):
+        shard = defaultdict(int)
+        with self.lock:
+            self.fold_finished_shards()
+            self.shards.append((current_thread(), shard))
+            self.local.shard = shard
+        return shard
+
+    def create_histogram_shard(self):
+        shard = {}
+        with self.lock:
+            self.fold_finished_shards()
+            self.histogram_shards.append((current_thread(), shard))
+            self.local.histograms = shard
+        return shard
+
+    @property
+    def histograms(self):
+        """
+        Return {key: Histogram} dict of histograms merged from all threads.
+        """
+        result = {}
+        with self.lock:
+            self.fold_finished_shards()
+            for key, hist in self.base_histograms.items():
+                result[key] = Histogram()
+                result[key].merge(hist)
+            shards = [x[1] for x in self.histogram_shards]
+        for shard in shards:
+            for key, hist in list(shard.items()):
+                if key not in result:
+                    result[key] = Histogram()
+                result[key].merge(hist)
+        return result
+
+    def export_histograms(self, percentiles=DEFAULT_PERCENTILES):
+        """
+        Return {key: summary} dict, see `Histogram.summary`.
+        """
+        return {key: hist.summary(percentiles) for key, hist in self.histograms.items()}
+
+    def format_key(self, template, value):
+        """
+        Return `template % value` string.
+
+        Keys are cached, so counters like "spider:task-<name>" do not
+        build new string on each call.
+        """
+        cache = self.key_cache.get(template)
+        if cache is None:
+            cache = self.key_cache.setdefault(template, {})
+        key = cache.get(value)
+        if key is None:
+            key = sys.intern(template % value)
+            if len(cache) < KEY_CACHE_SIZE:
+                cache[value] = key
+        return key
+
     def setup_logging_file(self, log_file):
         self.log_file = log_file
         if log_file:
             self.logger.addHandler(logging.FileHandler(log_file, "w"))
             self.logger.setLevel(logging.DEBUG)
 
-    def get_counter_line(self):
+    def get_counter_line(self, counters=None):
+        if counters is None:
+            counters = self.counters
         result = []
-        for key in list(self.counters.keys()):
+        for key in list(counters.keys()):
             if not any(key.startswith(x) for x in self.logging_ignore_prefixes):
-                result.append((key, "%s=%d" % (key, self.counters[key])))
-        for key in list(self.collections.keys()):
+                result.append((key, "%s=%d" % (key, counters[key])))
+        for key, collection in list(self.collections.items()):
             if not any(key.startswith(x) for x in self.logging_ignore_prefixes):
-                result.append((key, "%s=%d" % (key, len(self.collections[key]))))
+                total = get_collection_total(collection)
+                result.append((key, "%s=%d" % (key, total)))
         tokens = [x[1] for x in sorted(result, key=lambda x: x[0])]
         return ", ".join(tokens)
 
-    def get_speed_line(self, now):
+    def get_speed_line(self, now, counters=None):
+        if counters is None:
+            counters = self.counters
         items = []
         for key in self.speed_keys:
             time_elapsed = now - self.time
             if time_elapsed == 0:
                 qps = 0
             else:
-                count_current = self.counters[key]
+                count_current = counters[key]
                 diff = count_current - self.counters_prev[key]
                 qps = diff / time_elapsed
                 self.counters_prev[key] = count_current
@@ -82,14 +591,84 @@ class Stat:
 
     def print_progress_line(self):
         now = time.time()
-        self.logger.debug("%s [%s]", self.get_speed_line(now), self.get_counter_line())
+        counters = self.counters
+        self.logger.debug(
+            "%s [%s]",
+            self.get_speed_line(now, counters),
+            self.get_counter_line(counters),
+        )
+        self.time = now
+
+    def start_logging(self):
+        """
+        Start the thread which logs progress line every `logging_period`
+        seconds.
+        """
+        if self.logging_thread is None:
+            self.logging_stopped.clear()
+            self.logging_thread = Thread(
+                target=self.logging_loop, name="stat-logging", daemon=True
+            )
+            self.logging_thread.start()
+
+    def stop_logging(self):
+        if self.logging_thread is not None:
+            self.logging_stopped.set()
+            self.logging_thread.join()
+            self.logging_thread = None
+
+    def logging_loop(self):
+        # Logging could be disabled and enabled again while the thread works
+        while not self.logging_stopped.wait(
+            self.logging_period or DEFAULT_LOGGING_PERIOD
+        ):
+            if self.logging_period:
+                self.print_progress_line()
 
     def inc(self, key, delta=1):
-        self.counters[key] += delta
-        now = time.time()
-        if self.logging_period and now - self.time > self.logging_period:
-            self.print_progress_line()
-            self.time = now
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.create_shard()
+        shard[key] += delta
+
+    def set(self, key, val):
+        """
+        Set the value of counter e.g. the current value of some metric.
+        """
+        with self.lock:
+            shard_total = sum(x[1].get(key, 0) for x in self.shards)
+            self.base_counters[key] = val - shard_total
+
+    def get_histogram(self, key):
+        """
+        Return histogram of the current thread or None if the limit
+        of histograms is reached.
+        """
+        try:
+            shard = self.local.histograms
+        except AttributeError:
+            shard = self.create_histogram_shard()
+        hist = shard.get(key)
+        if hist is None:
+            if len(shard) >= self.max_histograms:
+                self.inc("stat:histogram-dropped")
+                return None
+            hist = shard[key] = Histogram()
+        return hist
+
+    def observe(self, key, value):
+        """
+        Add the value (e.g. latency in seconds) to the histogram.
+        """
+        hist = self.get_histogram(key)
+        if hist is not None:
+            hist.add(value)
+
+    def merge_histogram(self, key, other):
+        hist = self.get_histogram(key)
+        if hist is not None:
+            hist.merge(other)
 
     def collect(self, key, val):
         self.collections[key].append(val)
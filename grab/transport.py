@@ -6,19 +6,20 @@ from __future__ import absolute_import
 import logging
 import os
 import random
+import socket
 import ssl
 import tempfile
 import time
 import urllib.request
 from contextlib import contextmanager
-from http.client import HTTPResponse
+from io import BytesIO
+from http.client import HTTPException, HTTPResponse
 from http.cookiejar import CookieJar
 from typing import cast
 from urllib.parse import urlsplit
 
 import certifi
-from urllib3 import PoolManager, ProxyManager, exceptions, make_headers
-from urllib3.contrib.socks import SOCKSProxyManager
+from urllib3 import PoolManager, exceptions
 from urllib3.exceptions import LocationParseError
 from urllib3.fields import RequestField
 from urllib3.filepost import encode_multipart_formdata
@@ -26,14 +27,34 @@ from urllib3.util.retry import Retry
 from urllib3.util.timeout import Timeout
 from user_agent import generate_user_agent
 
-from grab import error
+from grab import aio, error
 from grab.cookie import CookieManager, MockRequest, MockResponse
 from grab.document import Document
 from grab.error import GrabMisuseError, GrabTimeoutError
+from grab.pool import get_pool_registry
 from grab.upload import UploadContent, UploadFile
 from grab.util.encoding import decode_pairs, make_bytes, make_str
 from grab.util.http import normalize_http_values, normalize_post_data, normalize_url
 
+DEFAULT_BODY_CHUNK_SIZE = 16384
+MAX_BODY_CHUNK_SIZE = 1024 * 1024
+# Max. size of the body buffer allocated before the data is read, larger
+# buffers grow as data arrives, so a bogus Content-Length does not
+# allocate memory which the server never fills
+MAX_BODY_PREALLOC_SIZE = 4 * MAX_BODY_CHUNK_SIZE
+# Larger chunks for body written to disk to reduce number of write calls
+FILE_BODY_CHUNK_SIZE = 65536
+
+
+def get_read_chunk_size(body_size):
+    """
+    Calculate size of read chunk adapted to the size of the body.
+
+    Small bodies are read with one call, large bodies are read
+    with chunks up to `MAX_BODY_CHUNK_SIZE` bytes.
+    """
+    return max(DEFAULT_BODY_CHUNK_SIZE, min(MAX_BODY_CHUNK_SIZE, body_size // 8 or 1))
+
 
 class BaseTransport:
     def __init__(self):
@@ -107,6 +128,7 @@ class Request:
         self.connect_timeout = None
         self.config_nobody = None
         self.config_body_maxsize = None
+        self.connection_reuse = True
 
         self.response_file = None
         self.response_path = None
@@ -122,8 +144,9 @@ class Urllib3Transport(BaseTransport):
 
     def __init__(self):
         super().__init__()
-        # http://urllib3.readthedocs.io/en/latest/user-guide.html#certificate-verification
-        self.pool = PoolManager(10, cert_reqs="CERT_REQUIRED", ca_certs=certifi.where())
+        # Private pool manager, used only if `connection_reuse` option is disabled
+        # Otherwise the pool manager shared by all transports is used
+        self.pool = None
 
         logger = logging.getLogger("urllib3.connectionpool")
         logger.setLevel(logging.WARNING)
@@ -134,6 +157,7 @@ class Urllib3Transport(BaseTransport):
 
         self._response = None
         self._request = None
+        self._body_complete = False
 
     def reset(self):
         # self.response_header_chunks = []
@@ -147,6 +171,7 @@ class Urllib3Transport(BaseTransport):
 
         self._response = None
         self._request = None
+        self._body_complete = False
 
     def process_config(self, grab):
         req = Request(data=None)
@@ -167,6 +192,7 @@ class Urllib3Transport(BaseTransport):
 
         req.timeout = grab.config["timeout"]
         req.connect_timeout = grab.config["connect_timeout"]
+        req.connection_reuse = grab.config["connection_reuse"]
 
         extra_headers = {}
 
@@ -271,29 +297,32 @@ class Urllib3Transport(BaseTransport):
             raise error.GrabConnectionError("SSLError", ex)
         except ssl.SSLError as ex:
             raise error.GrabConnectionError("SSLError", ex)
+        # Errors raised by `http.client` when the body is read
+        # directly with `readinto`, bypassing urllib3 error handling
+        except socket.timeout as ex:
+            raise error.GrabTimeoutError("ReadTimeoutError", ex)
+        except (ConnectionError, HTTPException) as ex:
+            raise error.GrabConnectionError("ProtocolError", ex)
+
+    def get_pool(self, req):
+        if req.connection_reuse:
+            return get_pool_registry().acquire(make_str(req.url))
+        if self.pool is None:
+            # http://urllib3.readthedocs.io/en/latest/user-guide.html#certificate-verification
+            self.pool = PoolManager(
+                1, cert_reqs="CERT_REQUIRED", ca_certs=certifi.where()
+            )
+        return self.pool
 
     def request(self):
         req = self._request
 
         if req.proxy:
-            if req.proxy_userpwd:
-                headers = make_headers(proxy_basic_auth=req.proxy_userpwd)
-            else:
-                headers = None
-            proxy_url = "%s://%s" % (req.proxy_type, req.proxy)
-            if req.proxy_type == "socks5":
-                pool = SOCKSProxyManager(
-                    proxy_url, cert_reqs="CERT_REQUIRED", ca_certs=certifi.where()
-                )  # , proxy_headers=headers)
-            else:
-                pool = ProxyManager(
-                    proxy_url,
-                    proxy_headers=headers,
-                    cert_reqs="CERT_REQUIRED",
-                    ca_certs=certifi.where(),
-                )
+            pool = get_pool_registry().acquire_proxy(
+                req.proxy_type, req.proxy, req.proxy_userpwd
+            )
         else:
-            pool = self.pool
+            pool = self.get_pool(req)
         with self.wrap_transport_error():
             # Retries can be disabled by passing False:
             # http://urllib3.readthedocs.io/en/latest/reference/urllib3.util.html#module-urllib3.util.retry
@@ -358,6 +387,20 @@ class Urllib3Transport(BaseTransport):
         #                                         ex.args[1])
         # raise error.GrabNetworkError(ex.args[0], ex.args[1])
 
+    async def arequest(self):
+        """
+        Perform network request without blocking the event loop.
+        """
+        req = self._request
+        req.op_started = time.time()
+        res = await aio.fetch(req)
+
+        self.request_head = b""
+        self.request_body = b""
+        self.request_log = b""
+
+        self._response = res
+
     def prepare_response(self, grab):
         # Information about urllib3
         # On python2 urllib3 headers contains original binary data
@@ -365,6 +408,7 @@ class Urllib3Transport(BaseTransport):
         # using latin encoding
         if not self._response:
             return None
+        self._body_complete = False
         try:
             # if self.body_file:
             #    self.body_file.close()
@@ -378,50 +422,14 @@ class Urllib3Transport(BaseTransport):
             head += "\r\n"
             response.head = make_bytes(head, encoding="utf-8")
 
-            # if self.body_path:
-            #    response.body_path = self.body_path
-            # else:
-            #    response.body = b''.join(self.response_body_chunks)
-            def read_with_timeout():
-                if self._request.config_nobody:
-                    return b""
-                maxsize = self._request.config_body_maxsize
-                chunks = []
-                default_chunk_size = 10000
-                if maxsize:
-                    chunk_size = min(default_chunk_size, maxsize + 1)
-                else:
-                    chunk_size = default_chunk_size
-                bytes_read = 0
-                while True:
-                    chunk = self._response.read(chunk_size)
-                    if chunk:
-                        bytes_read += len(chunk)
-                        chunks.append(chunk)
-                        if maxsize and bytes_read > maxsize:
-                            # reached limit on bytes to read
-                            break
-                    else:
-                        break
-                    if self._request.timeout:
-                        if (
-                            time.time() - self._request.op_started
-                            > self._request.timeout
-                        ):
-                            raise GrabTimeoutError
-                data = b"".join(chunks)
-                if maxsize:
-                    data = data[:maxsize]
-                return data
-
             if self._request.response_path:
                 response.body_path = self._request.response_path
-                # FIXME: Quick dirty hack, actually, response is fully
-                # read into memory
-                self._request.response_file.write(read_with_timeout())
-                self._request.response_file.close()
+                try:
+                    self.read_body_to_file(self._request.response_file)
+                finally:
+                    self._request.response_file.close()
             else:
-                response.body = read_with_timeout()
+                response.body = self.read_body()
 
             # Clear memory
             # self.response_header_chunks = []
@@ -454,8 +462,125 @@ class Urllib3Transport(BaseTransport):
 
             return response
         finally:
+            # Connection with partially read body could not be
+            # returned into the shared pool
+            if not self._body_complete:
+                self._response.close()
             self._response.release_conn()
 
+    def check_read_timeout(self):
+        if self._request.timeout:
+            if time.time() - self._request.op_started > self._request.timeout:
+                raise GrabTimeoutError
+
+    def iterate_body_chunks(self, chunk_size=DEFAULT_BODY_CHUNK_SIZE):
+        """
+        Iterate over chunks of response body.
+
+        The size of chunk is doubled after each read until it reaches
+        `MAX_BODY_CHUNK_SIZE`, so large bodies are read with few calls.
+
+        The `body_maxsize` limit and the total `timeout` are checked
+        after each chunk.
+        """
+        if self._request.config_nobody:
+            return
+        maxsize = self._request.config_body_maxsize
+        bytes_read = 0
+        while True:
+            if maxsize:
+                chunk_size = min(chunk_size, maxsize - bytes_read + 1)
+            chunk = self._response.read(chunk_size)
+            if not chunk:
+                self._body_complete = True
+                return
+            if maxsize and bytes_read + len(chunk) > maxsize:
+                # reached limit on bytes to read
+                yield chunk[: maxsize - bytes_read]
+                return
+            bytes_read += len(chunk)
+            yield chunk
+            self.check_read_timeout()
+            chunk_size = min(chunk_size * 2, MAX_BODY_CHUNK_SIZE)
+
+    def get_body_size_hint(self):
+        """
+        Return size of the body from "Content-Length" header.
+
+        Returns None if size of decoded body could not be known in advance.
+        """
+        headers = self._response.headers
+        if headers.get("Content-Encoding", "identity").lower() != "identity":
+            return None
+        try:
+            size = int(headers["Content-Length"])
+        except (KeyError, ValueError):
+            return None
+        return size if size >= 0 else None
+
+    def read_body_into(self, out, size):
+        """
+        Read up to `size` bytes of body into `io.BytesIO` object.
+
+        The data is read with `readinto` directly into the buffer of `out`
+        without creating intermediate byte strings. The buffer is allocated
+        by parts: first part is at most `MAX_BODY_PREALLOC_SIZE` bytes,
+        next parts double the size of the buffer.
+
+        Returns number of bytes read.
+        """
+        # pylint: disable=protected-access
+        inp = self._response._original_response
+        # pylint: enable=protected-access
+        chunk_size = get_read_chunk_size(size)
+        pos = 0
+        while pos < size:
+            alloc = min(size, max(pos * 2, MAX_BODY_PREALLOC_SIZE))
+            out.seek(alloc - 1)
+            out.write(b"\0")
+            with out.getbuffer() as view:
+                while pos < alloc:
+                    num = inp.readinto(view[pos : min(pos + chunk_size, alloc)])
+                    if not num:
+                        self._body_complete = True
+                        break
+                    pos += num
+                    self.check_read_timeout()
+            if self._body_complete:
+                break
+        out.truncate(pos)
+        return pos
+
+    def read_body(self):
+        """
+        Read response body into memory.
+
+        If the body size is known in advance then the data is read
+        in place into the buffer which grows up to that size. The buffer
+        of `io.BytesIO` is returned by `getvalue` without copying.
+        """
+        if self._request.config_nobody:
+            return b""
+        out = BytesIO()
+        size = self.get_body_size_hint()
+        if size is None:
+            for chunk in self.iterate_body_chunks():
+                out.write(chunk)
+            return out.getvalue()
+        maxsize = self._request.config_body_maxsize
+        if self.read_body_into(out, min(size, maxsize or size)) == size:
+            self._body_complete = True
+        return out.getvalue()
+
+    def read_body_to_file(self, out):
+        """
+        Write response body into file object chunk by chunk.
+
+        Only one chunk of data is hold in memory at any moment.
+        """
+        for chunk in self.iterate_body_chunks(FILE_BODY_CHUNK_SIZE):
+            out.write(chunk)
+
     def extract_cookiejar(self):
         jar = CookieJar()
         # self._respose could be None
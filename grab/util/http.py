@@ -1,5 +1,5 @@
 import re
-from urllib.parse import quote, urlencode, urlsplit, urlunsplit
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
 
 from .encoding import make_bytes, make_str
 
@@ -11,6 +11,12 @@ RE_NOT_SAFE_CHAR = re.compile(
     r"[^" + UNRESERVED_CHARS + re.escape(RESERVED_CHARS) + "]"
 )
 RE_NON_ALPHA_DIGIT_NETLOC = re.compile(r"[^-.:@a-zA-Z0-9]")
+# Query parameters which do not change the document,
+# parameters with "utm_" prefix are removed too
+DEFAULT_TRACKING_PARAMS = frozenset(
+    ["gclid", "fbclid", "yclid", "msclkid", "_openstat", "mc_cid", "mc_eid"]
+)
+DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21}
 
 
 def smart_urlencode(items, charset="utf-8"):
@@ -100,6 +106,39 @@ def normalize_url(url):
     return url
 
 
+def canonicalize_url(url, tracking_params=DEFAULT_TRACKING_PARAMS):
+    """
+    Build canonical form of URL to detect URLs of the same document.
+
+    Scheme and host name are converted to lower case, default port and
+    fragment are removed, query parameters are sorted. Parameters with
+    names from `tracking_params` and names with "utm_" prefix are removed
+    if `tracking_params` is not None.
+    """
+    parts = urlsplit(normalize_url(url))
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if ":" in netloc:
+        # IPv6 address
+        netloc = "[%s]" % netloc
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += ":%d" % parts.port
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ":" + parts.password
+        netloc = userinfo + "@" + netloc
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if tracking_params is not None:
+        query = [
+            (key, val)
+            for key, val in query
+            if key not in tracking_params and not key.startswith("utm_")
+        ]
+    query.sort()
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(query), ""))
+
+
 def normalize_post_data(data, encoding="utf-8"):
     if isinstance(data, str):
         return make_bytes(data, encoding=encoding)
@@ -35,6 +35,7 @@ GRAB_TEST_LIST = (
     "tests.grab_cookies",
     "tests.grab_url_processing",
     "tests.grab_timeout",
+    "tests.grab_asyncio",
     # *** Refactor
     "tests.grab_proxy",
     "tests.grab_upload_file",
@@ -54,6 +55,7 @@ GRAB_TEST_LIST = (
     "tests.grab_error",
     "tests.ext_pyquery",
     # *** Other things
+    "tests.grab_stat",
     "tests.raw_server",
     "tests.misc",
     "tests.test_util_http",
@@ -73,6 +75,14 @@ SPIDER_TEST_LIST = (
     "tests.spider_error",
     "tests.spider_stat",
     "tests.spider_multiprocess",
+    "tests.spider_network_service",
+    "tests.spider_parser_service",
+    "tests.spider_host_scheduler",
+    "tests.spider_tracing",
+    "tests.spider_profiler",
+    "tests.spider_concurrency",
+    "tests.spider_dedup",
+    "tests.spider_runner",
 )
 
 
@@ -2,6 +2,7 @@ MONGODB_CONNECTION = {
     'database': 'grab_test',
 }
 
+# Use {'connection': fakeredis.FakeStrictRedis()} to run tests without server
 REDIS_CONNECTION = {}
 
 try:
@@ -0,0 +1,153 @@
+import asyncio
+import gzip
+import os
+import tempfile
+import time
+
+from mock import patch
+from test_server import Response
+
+from grab.error import GrabMisuseError, GrabTimeoutError, GrabTooManyRedirectsError
+from tests.util import ADDRESS, BaseGrabTestCase, build_grab, temp_dir
+
+
+def run(coro):
+    return asyncio.get_event_loop_policy().new_event_loop().run_until_complete(coro)
+
+
+class GrabAsyncioTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_ago(self):
+        self.server.add_response(Response(data=b"foo"))
+        grab = build_grab()
+        doc = run(grab.ago(self.server.get_url()))
+        self.assertEqual(200, doc.code)
+        self.assertEqual(b"foo", doc.body)
+        self.assertEqual(b"foo", grab.doc.body)
+
+    def test_post(self):
+        self.server.add_response(Response(data=b"ok"))
+        grab = build_grab()
+        run(grab.ago(self.server.get_url(), post={"foo": "bar"}))
+        self.assertEqual("POST", self.server.request.method)
+        self.assertEqual(b"foo=bar", self.server.request.data)
+
+    def test_redirect(self):
+        self.server.add_response(
+            Response(status=302, headers=[("Location", self.server.get_url("/foo"))])
+        )
+        self.server.add_response(Response(data=b"done"))
+        grab = build_grab()
+        doc = run(grab.ago(self.server.get_url()))
+        self.assertEqual(b"done", doc.body)
+        self.assertEqual(self.server.get_url("/foo"), doc.url)
+
+    def test_redirect_limit(self):
+        self.server.add_response(
+            Response(status=302, headers=[("Location", self.server.get_url())]),
+            count=-1,
+        )
+        grab = build_grab(redirect_limit=3)
+        with self.assertRaises(GrabTooManyRedirectsError):
+            run(grab.ago(self.server.get_url()))
+
+    def test_cookies(self):
+        self.server.add_response(Response(headers=[("Set-Cookie", "foo=bar")]))
+        self.server.add_response(Response())
+        grab = build_grab()
+        run(grab.ago(self.server.get_url()))
+        self.assertEqual("bar", grab.doc.cookies["foo"])
+        run(grab.ago(self.server.get_url()))
+        self.assertEqual("foo=bar", self.server.request.headers.get("cookie"))
+
+    def test_proxy(self):
+        self.server.add_response(Response(data=b"123"))
+        grab = build_grab(proxy="%s:%d" % (ADDRESS, self.server.port))
+        run(grab.ago("http://yandex.ru/foo"))
+        self.assertEqual(b"123", grab.doc.body)
+        self.assertEqual("yandex.ru", self.server.request.headers.get("host"))
+
+    def test_compressed_body_and_maxsize(self):
+        self.server.add_response(
+            Response(
+                data=gzip.compress(b"x" * 1000), headers=[("Content-Encoding", "gzip")]
+            )
+        )
+        self.server.add_response(Response(data=b"y" * 1000))
+        grab = build_grab()
+        doc = run(grab.ago(self.server.get_url()))
+        self.assertEqual(b"x" * 1000, doc.body)
+        doc = run(grab.ago(self.server.get_url(), body_maxsize=10))
+        self.assertEqual(b"y" * 10, doc.body)
+
+    def test_chunked_body_and_maxsize(self):
+        async def handle(reader, writer):
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"4\r\nfoo-\r\n4\r\nbar-\r\n3;ext=1\r\nbaz\r\n0\r\nX-Foo: 1\r\n\r\n"
+            )
+            await writer.drain()
+            writer.close()
+
+        async def fetch(**kwargs):
+            server = await asyncio.start_server(handle, ADDRESS, 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await build_grab().ago(
+                    "http://%s:%d/" % (ADDRESS, port), **kwargs
+                )
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        self.assertEqual(b"foo-bar-baz", run(fetch()).body)
+        self.assertEqual(b"foo-b", run(fetch(body_maxsize=5)).body)
+        self.assertEqual(b"foo-", run(fetch(body_maxsize=4)).body)
+
+    def test_body_inmemory_false(self):
+        data = os.urandom(300000)
+        self.server.add_response(Response(data=data))
+        with temp_dir() as tmp_dir:
+            grab = build_grab(body_inmemory=False, body_storage_dir=tmp_dir)
+            with patch(
+                "grab.aio.tempfile.TemporaryFile", wraps=tempfile.TemporaryFile
+            ) as temp_file:
+                run(grab.ago(self.server.get_url()))
+            self.assertEqual(1, temp_file.call_count)
+            with open(grab.doc.body_path, "rb") as inp:
+                self.assertEqual(data, inp.read())
+
+    def test_timeout(self):
+        def callback():
+            time.sleep(2)
+            return {"type": "response", "data": b"zzz"}
+
+        self.server.add_response(Response(callback=callback))
+        grab = build_grab(timeout=1)
+        with self.assertRaises(GrabTimeoutError):
+            run(grab.ago(self.server.get_url()))
+
+    def test_concurrent_requests(self):
+        self.server.add_response(Response(data=b"foo"), count=-1)
+
+        async def fetch_all():
+            grabs = [build_grab() for _ in range(30)]
+            return await asyncio.gather(*[x.ago(self.server.get_url()) for x in grabs])
+
+        docs = run(fetch_all())
+        self.assertEqual([b"foo"] * 30, [x.body for x in docs])
+
+    def test_transport_without_async_support(self):
+        class SyncTransport:
+            def process_config(self, grab):
+                pass
+
+            def reset(self):
+                pass
+
+        grab = build_grab(transport=SyncTransport)
+        with self.assertRaises(GrabMisuseError):
+            run(grab.ago(self.server.get_url()))
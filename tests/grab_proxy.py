@@ -1,5 +1,8 @@
+import time
 from typing import Dict
+from unittest import TestCase
 
+from grab.pool import PoolRegistry, get_pool_registry
 from grab.proxylist import BaseProxySource
 from test_server import Response, TestServer
 from tests.util import BaseGrabTestCase, build_grab, temp_file
@@ -233,3 +236,41 @@ class TestProxy(BaseGrabTestCase):
         )
         self.server.add_response(Response())
         grab.go(self.server.get_url())
+
+    def test_proxy_manager_reused(self):
+        registry = get_pool_registry()
+        registry.clear()
+        proxy = "%s:%s" % (ADDRESS, self.server.port)
+        self.server.add_response(Response(data=b"123"), count=2)
+        for _ in range(2):
+            grab = build_grab(proxy=proxy, proxy_type="http")
+            grab.go("http://yandex.ru")
+            self.assertEqual(b"123", grab.doc.body)
+        self.assertEqual(1, registry.proxy_cache_count())
+        manager = registry.acquire_proxy("http", proxy)
+        self.assertTrue(manager is registry.acquire_proxy("http", proxy))
+        self.assertFalse(manager is registry.acquire_proxy("http", proxy, "u:p"))
+        registry.clear()
+
+
+class ProxyManagerCacheTestCase(TestCase):
+    def test_cache_size_limit(self):
+        registry = PoolRegistry(proxy_cache_size=2)
+        first = registry.acquire_proxy("http", "1.1.1.1:8080")
+        registry.acquire_proxy("http", "2.2.2.2:8080")
+        # Touch first proxy to make it recently used
+        registry.acquire_proxy("http", "1.1.1.1:8080")
+        registry.acquire_proxy("socks5", "3.3.3.3:1080")
+        self.assertEqual(2, registry.proxy_cache_count())
+        self.assertTrue(first is registry.acquire_proxy("http", "1.1.1.1:8080"))
+        self.assertEqual(
+            [("http", "1.1.1.1:8080", None), ("socks5", "3.3.3.3:1080", None)],
+            sorted(registry.proxy_managers.keys()),
+        )
+
+    def test_idle_eviction(self):
+        registry = PoolRegistry(idle_timeout=1)
+        registry.acquire_proxy("http", "1.1.1.1:8080")
+        self.assertEqual(0, registry.evict_idle())
+        self.assertEqual(1, registry.evict_idle(time.time() + 2))
+        self.assertEqual(0, registry.proxy_cache_count())
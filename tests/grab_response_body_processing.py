@@ -1,10 +1,27 @@
+import gzip
+import io
 import os
+import time
+import tracemalloc
+from http.client import HTTPResponse as BaseHTTPResponse
+
+from mock import patch
+from urllib3 import HTTPResponse
 
 from grab import GrabMisuseError
+from grab.transport import MAX_BODY_PREALLOC_SIZE, Request, Urllib3Transport
 from test_server import Response
 from tests.util import TEST_DIR, BaseGrabTestCase, build_grab, temp_dir
 
 
+class FakeSocket:
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, *args, **kwargs):  # pylint: disable=unused-argument
+        return io.BufferedReader(io.BytesIO(self.data))
+
+
 class GrabSimpleTestCase(BaseGrabTestCase):
     def setUp(self):
         self.server.reset()
@@ -50,6 +67,76 @@ class GrabSimpleTestCase(BaseGrabTestCase):
             self.assertEqual(grab.doc._bytes_body, None)
             # pylint: enable=protected-access
 
+    def test_body_inmemory_false_streaming(self):
+        data = os.urandom(300000)
+        with temp_dir() as tmp_dir:
+            self.server.add_response(Response(data=data), count=2)
+            grab = build_grab(body_inmemory=False, body_storage_dir=tmp_dir)
+            with patch.object(
+                Urllib3Transport, "read_body", side_effect=AssertionError
+            ):
+                grab.go(self.server.get_url())
+            with open(grab.doc.body_path, "rb") as inp:
+                self.assertEqual(data, inp.read())
+
+            grab.setup(body_maxsize=100000)
+            grab.go(self.server.get_url())
+            with open(grab.doc.body_path, "rb") as inp:
+                self.assertEqual(data[:100000], inp.read())
+
+    def test_body_preallocated_reader(self):
+        # The buffer grows twice after the first allocation
+        data = os.urandom(2 * MAX_BODY_PREALLOC_SIZE + 7)
+        self.server.add_response(Response(data=data), count=2)
+        grab = build_grab()
+        grab.go(self.server.get_url())
+        self.assertEqual(data, grab.doc.body)
+        self.assertEqual(bytes, type(grab.doc.body))
+
+        grab.setup(body_maxsize=1000)
+        grab.go(self.server.get_url())
+        self.assertEqual(data[:1000], grab.doc.body)
+
+    def test_body_bogus_content_length(self):
+        raw = b"HTTP/1.1 200 OK\r\nContent-Length: 300000000\r\n\r\nhello"
+        orig = BaseHTTPResponse(FakeSocket(raw))
+        orig.begin()
+        transport = Urllib3Transport()
+        # pylint: disable=protected-access
+        transport._request = Request()
+        transport._request.op_started = time.time()
+        transport._response = HTTPResponse(
+            body=orig,
+            headers=dict(orig.getheaders()),
+            status=orig.status,
+            original_response=orig,
+            preload_content=False,
+        )
+        # pylint: enable=protected-access
+        tracemalloc.start()
+        try:
+            body = transport.read_body()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(b"hello", body)
+        # Memory is not allocated for the claimed size of the body
+        self.assertTrue(peak < 2 * MAX_BODY_PREALLOC_SIZE)
+
+    def test_body_compressed_reader(self):
+        data = b"foo" * 100000
+        self.server.add_response(
+            Response(data=gzip.compress(data), headers=[("Content-Encoding", "gzip")]),
+            count=2,
+        )
+        grab = build_grab()
+        grab.go(self.server.get_url())
+        self.assertEqual(data, grab.doc.body)
+
+        grab.setup(body_maxsize=100001)
+        grab.go(self.server.get_url())
+        self.assertEqual(data[:100001], grab.doc.body)
+
     def test_body_inmemory_true(self):
         grab = build_grab()
         self.server.add_response(Response(data=b"bar"))
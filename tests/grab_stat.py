@@ -1,6 +1,11 @@
+import pickle
+import time
+from threading import Thread
+
 from tests.util import BaseGrabTestCase
 
-from grab.stat import Stat
+from grab.error import GrabMisuseError
+from grab.stat import Histogram, RecentValues, ReservoirSample, Stat
 
 
 class GrabStatTestCase(BaseGrabTestCase):
@@ -10,3 +15,180 @@ class GrabStatTestCase(BaseGrabTestCase):
     def test_zero_division_error(self):
         stat = Stat()
         stat.get_speed_line(stat.time)
+
+    def test_inc_threads(self):
+        stat = Stat()
+
+        def worker():
+            for _ in range(1000):
+                stat.inc("foo")
+                stat.inc("bar", 2)
+
+        threads = [Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stat.inc("foo")
+        self.assertEqual(4001, stat.counters["foo"])
+        self.assertEqual(8000, stat.counters["bar"])
+        stat.reset()
+        self.assertEqual({}, dict(stat.counters))
+        stat.inc("foo")
+        self.assertEqual(1, stat.counters["foo"])
+
+    def test_set(self):
+        stat = Stat()
+        stat.inc("foo", 5)
+        stat.set("foo", 2)
+        self.assertEqual(2, stat.counters["foo"])
+        stat.inc("foo")
+        self.assertEqual(3, stat.counters["foo"])
+
+    def test_counters_write(self):
+        stat = Stat()
+        stat.inc("foo", 5)
+        stat.counters["foo"] += 1
+        stat.counters["bar"] = 3
+        stat.counters.update(baz=2)
+        self.assertEqual({"foo": 6, "bar": 3, "baz": 2}, dict(stat.counters))
+        self.assertEqual(0, stat.counters["missing"])
+        self.assertRaises(GrabMisuseError, stat.counters.pop, "foo")
+        self.assertEqual(6, stat.get_counter("foo"))
+        counters = pickle.loads(pickle.dumps(stat.counters))
+        self.assertIs(dict, type(counters))
+        self.assertEqual(6, counters["foo"])
+
+    def test_finished_thread_shards(self):
+        stat = Stat()
+
+        def worker():
+            stat.inc("foo")
+            stat.observe("bar", 1)
+
+        for _ in range(3):
+            thread = Thread(target=worker)
+            thread.start()
+            thread.join()
+        self.assertEqual(3, stat.counters["foo"])
+        self.assertEqual(3, stat.histograms["bar"].count)
+        self.assertEqual([], stat.shards)
+        self.assertEqual([], stat.histogram_shards)
+        stat.inc("foo")
+        self.assertEqual(4, stat.get_counter("foo"))
+        self.assertEqual(1, len(stat.shards))
+
+    def test_format_key(self):
+        stat = Stat()
+        key = stat.format_key("task-%s", "page")
+        self.assertEqual("task-page", key)
+        self.assertIs(key, stat.format_key("task-%s", "page"))
+
+    def test_logging_thread(self):
+        stat = Stat(logging_period=0.01)
+        with self.assertLogs("grab.stat", "DEBUG"):
+            stat.start_logging()
+            stat.inc("foo")
+            time.sleep(0.1)
+        stat.stop_logging()
+        self.assertIsNone(stat.logging_thread)
+
+    def test_reservoir_sample(self):
+        stat = Stat(collection_kinds={"foo": "reservoir"})
+        stat.setup_collection("bar", "reservoir", size=10)
+        for num in range(1000):
+            stat.collect("bar", num)
+        bar = stat.collections["bar"]
+        self.assertEqual(10, len(bar))
+        self.assertEqual(1000, bar.total)
+        self.assertEqual(10, len(set(bar)))
+        other = pickle.loads(pickle.dumps(bar))
+        bar.extend(other)
+        self.assertEqual(10, len(bar))
+        self.assertEqual(2000, bar.total)
+        self.assertIsInstance(stat.collections["foo"], ReservoirSample)
+
+    def test_top_values(self):
+        stat = Stat()
+        stat.setup_collection("foo", "top", size=2)
+        for val in ["a", "b", "a", "c", "a", "b", "d", "e", "f"]:
+            stat.collect("foo", val)
+        foo = stat.collections["foo"]
+        self.assertEqual([("a", 3), ("b", 2)], foo.most_common())
+        self.assertEqual(["a", "b"], list(foo))
+        self.assertEqual(9, foo.total)
+        foo.extend(pickle.loads(pickle.dumps(foo)))
+        self.assertEqual([("a", 6), ("b", 4)], foo.most_common())
+
+    def test_recent_values(self):
+        stat = Stat()
+        stat.collect("foo", 1)
+        stat.collect("foo", 2)
+        stat.setup_collection("foo", "recent", size=3)
+        for num in range(3, 6):
+            stat.collect("foo", num)
+        foo = stat.collections["foo"]
+        self.assertEqual([3, 4, 5], list(foo))
+        self.assertEqual(5, foo.total)
+        self.assertIn("foo=5", stat.get_counter_line())
+        stat.reset()
+        self.assertIsInstance(stat.collections["foo"], RecentValues)
+        stat.setup_collection("foo", None)
+        stat.reset()
+        self.assertEqual([], stat.collections["foo"])
+
+    def test_invalid_collection(self):
+        stat = Stat()
+        self.assertRaises(GrabMisuseError, stat.setup_collection, "foo", "bar")
+
+    def test_histogram(self):
+        hist = Histogram()
+        self.assertIsNone(hist.percentile(50))
+        for num in range(1, 1001):
+            hist.add(num / 1000)
+        self.assertEqual(1000, hist.count)
+        self.assertEqual(0.001, hist.min)
+        self.assertEqual(1, hist.max)
+        for percent in (50, 90, 99):
+            self.assertAlmostEqual(percent / 100, hist.percentile(percent), delta=0.07)
+        self.assertEqual(1, hist.percentile(100))
+        hist.add(0)
+        self.assertEqual(0, hist.min)
+        self.assertTrue(hist.percentile(0) < 0.00001)
+        other = pickle.loads(pickle.dumps(hist))
+        other.merge(hist)
+        self.assertEqual(2002, other.count)
+        self.assertAlmostEqual(0.5, other.percentile(50), delta=0.04)
+
+    def test_histograms_threads(self):
+        stat = Stat()
+
+        def worker(num):
+            for _ in range(1000):
+                stat.observe("foo", num)
+
+        threads = [Thread(target=worker, args=(x,)) for x in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stat.observe("bar", 0.1)
+        result = stat.export_histograms(percentiles=(25, 100))
+        self.assertEqual({"foo", "bar"}, set(result))
+        self.assertEqual(4000, result["foo"]["count"])
+        self.assertEqual(10000, result["foo"]["sum"])
+        self.assertEqual(1, result["foo"]["min"])
+        self.assertAlmostEqual(1, result["foo"]["p25"], delta=0.07)
+        self.assertEqual(4, result["foo"]["p100"])
+        self.assertEqual(0.1, result["bar"]["mean"])
+        stat.reset()
+        self.assertEqual({}, stat.histograms)
+
+    def test_max_histograms(self):
+        stat = Stat(max_histograms=2)
+        for key in ("foo", "bar", "baz"):
+            stat.observe(key, 1)
+        stat.merge_histogram("foo", stat.histograms["foo"])
+        self.assertEqual({"foo", "bar"}, set(stat.histograms))
+        self.assertEqual(2, stat.histograms["foo"].count)
+        self.assertEqual(1, stat.counters["stat:histogram-dropped"])
@@ -4,9 +4,14 @@
 
 # from test_server import Response
 
-from tests.util import BaseGrabTestCase
+import time
+
+from test_server import Response
+
+from tests.util import BaseGrabTestCase, build_grab
 from grab import Grab
 from grab.error import GrabMisuseError
+from grab.pool import PoolRegistry, get_pool_registry
 from grab.transport import Urllib3Transport
 
 #
@@ -109,3 +114,77 @@ class TestTransportTestCase(BaseGrabTestCase):
         grab = Grab()
         grab.setup_transport(Urllib3Transport)
         self.assertTrue(isinstance(grab.transport, Urllib3Transport))
+
+
+class SharedPoolTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+        get_pool_registry().clear()
+
+    def tearDown(self):
+        get_pool_registry().clear()
+
+    def get_host_pools(self):
+        manager = get_pool_registry().manager
+        return [manager.pools[x] for x in manager.pools.keys()]
+
+    def test_connection_reused_by_grab_instances(self):
+        self.server.add_response(Response(data=b"foo"), count=3)
+        for _ in range(3):
+            grab = build_grab()
+            grab.go(self.server.get_url())
+            self.assertEqual(b"foo", grab.doc.body)
+        pools = self.get_host_pools()
+        self.assertEqual(1, len(pools))
+        self.assertEqual(3, pools[0].num_requests)
+        self.assertEqual(1, pools[0].num_connections)
+
+    def test_connection_reuse_disabled(self):
+        self.server.add_response(Response(data=b"foo"), count=2)
+        grab = build_grab(connection_reuse=False)
+        grab.go(self.server.get_url())
+        grab.go(self.server.get_url())
+        self.assertEqual(0, get_pool_registry().size())
+        self.assertTrue(grab.transport.pool is not None)
+
+    def test_partially_read_connection_not_reused(self):
+        self.server.add_response(Response(data=b"x" * 1000), count=2)
+        grab = build_grab(body_maxsize=10)
+        grab.go(self.server.get_url())
+        self.assertEqual(b"x" * 10, grab.doc.body)
+        grab = build_grab()
+        grab.go(self.server.get_url())
+        self.assertEqual(b"x" * 1000, grab.doc.body)
+
+    def test_evict_idle(self):
+        registry = PoolRegistry(idle_timeout=1)
+        registry.acquire(self.server.get_url()).connection_from_url(
+            self.server.get_url()
+        )
+        self.assertEqual(1, registry.size())
+        self.assertEqual(0, registry.evict_idle())
+        self.assertEqual(1, registry.evict_idle(time.time() + 2))
+        self.assertEqual(0, registry.size())
+
+    def test_configure(self):
+        registry = PoolRegistry(maxsize=5)
+        registry.ensure_maxsize(3)
+        self.assertEqual(5, registry.maxsize)
+        registry.ensure_maxsize(20)
+        self.assertEqual(20, registry.maxsize)
+        self.assertEqual(
+            20, registry.acquire("http://example.com").connection_pool_kw["maxsize"]
+        )
+
+    def test_configure_keeps_managers_in_use(self):
+        self.server.add_response(Response(data=b"foo"))
+        registry = PoolRegistry(maxsize=5)
+        manager = registry.acquire(self.server.get_url())
+        proxy_manager = registry.acquire_proxy("http", "localhost:1")
+        pool = manager.connection_from_url(self.server.get_url())
+        registry.configure(maxsize=20)
+        self.assertIsNot(manager, registry.acquire(self.server.get_url()))
+        self.assertIsNot(proxy_manager, registry.acquire_proxy("http", "localhost:1"))
+        # Old managers are not closed, requests in progress could use them
+        self.assertIs(pool, manager.connection_from_url(self.server.get_url()))
+        self.assertEqual(b"foo", pool.request("GET", "/").data)
@@ -0,0 +1,119 @@
+import time
+from threading import Lock
+from unittest import TestCase
+
+from test_server import Response
+
+from grab.spider import Spider, Task
+from grab.spider.concurrency import AdaptiveConcurrency
+from grab.spider.error import SpiderMisuseError
+from grab.stat import Stat
+
+from tests.util import BaseGrabTestCase, build_spider
+
+
+def report_many(ctl, number, is_error=False, latency=0.1, now=None):
+    result = False
+    for _ in range(number):
+        result = ctl.report(is_error, latency, now=now)
+    return result
+
+
+class AdaptiveConcurrencyTestCase(TestCase):
+    def test_acquire_limit(self):
+        ctl = AdaptiveConcurrency(min_limit=1, max_limit=10, initial_limit=2)
+        self.assertTrue(ctl.acquire())
+        self.assertTrue(ctl.acquire())
+        self.assertFalse(ctl.acquire())
+        ctl.release()
+        self.assertTrue(ctl.acquire())
+
+    def test_increase(self):
+        stat = Stat()
+        ctl = AdaptiveConcurrency(max_limit=3, interval=1, stat=stat)
+        self.assertEqual(1, stat.counters["spider:concurrency"])
+        self.assertTrue(ctl.acquire())
+        now = time.time() + 1
+        self.assertTrue(report_many(ctl, 5, now=now))
+        self.assertEqual(2, ctl.get_limit())
+        self.assertEqual(2, stat.counters["spider:concurrency"])
+        # The limit is not reached, no reason to increase it
+        self.assertFalse(report_many(ctl, 5, now=now + 1))
+        self.assertEqual(2, ctl.get_limit())
+        self.assertTrue(ctl.acquire())
+        report_many(ctl, 5, now=now + 2)
+        self.assertTrue(ctl.acquire())
+        report_many(ctl, 5, now=now + 3)
+        # The limit is never greater than max_limit
+        self.assertEqual(3, ctl.get_limit())
+
+    def test_interval(self):
+        ctl = AdaptiveConcurrency(max_limit=3, interval=10)
+        ctl.acquire()
+        self.assertFalse(report_many(ctl, 10))
+        self.assertEqual(1, ctl.get_limit())
+
+    def test_decrease_on_errors(self):
+        stat = Stat()
+        ctl = AdaptiveConcurrency(max_limit=10, initial_limit=8, stat=stat)
+        now = time.time() + 1
+        report_many(ctl, 4, now=now)
+        report_many(ctl, 1, is_error=True, now=now)
+        self.assertEqual(4, ctl.get_limit())
+        self.assertEqual(1, stat.counters["spider:concurrency-decrease"])
+        report_many(ctl, 5, is_error=True, now=now + 1)
+        report_many(ctl, 5, is_error=True, now=now + 2)
+        report_many(ctl, 5, is_error=True, now=now + 3)
+        # The limit is never less than min_limit
+        self.assertEqual(1, ctl.get_limit())
+
+    def test_decrease_on_latency(self):
+        ctl = AdaptiveConcurrency(max_limit=10, initial_limit=8, latency_factor=2)
+        now = time.time() + 1
+        report_many(ctl, 5, latency=0.1, now=now)
+        self.assertEqual(8, ctl.get_limit())
+        report_many(ctl, 5, latency=0.5, now=now + 1)
+        self.assertEqual(4, ctl.get_limit())
+
+
+class SpiderAdaptiveConcurrencyTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_misuse(self):
+        bot = build_spider(Spider, thread_number=2)
+        self.assertRaises(
+            SpiderMisuseError, bot.setup_adaptive_concurrency, max_limit=3
+        )
+
+    def test_overload(self):
+        server = self.server
+        lock = Lock()
+        state = {"active": 0, "max_active": 0}
+
+        def callback():
+            with lock:
+                state["active"] += 1
+                state["max_active"] = max(state["max_active"], state["active"])
+            time.sleep(0.05)
+            with lock:
+                state["active"] -= 1
+            return {"type": "response", "status": 503, "data": b"busy"}
+
+        server.add_response(Response(callback=callback), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                for _ in range(30):
+                    yield Task("page", url=server.get_url(), valid_status=[503])
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.inc("page")
+
+        bot = build_spider(SimpleSpider, thread_number=4)
+        bot.setup_adaptive_concurrency(initial_limit=4, interval=0)
+        bot.run()
+        self.assertEqual(30, bot.stat.counters["page"])
+        self.assertEqual(1, bot.stat.counters["spider:concurrency"])
+        self.assertTrue(bot.stat.counters["spider:concurrency-decrease"] >= 2)
+        self.assertTrue(state["max_active"] <= 4)
@@ -0,0 +1,127 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from test_server import Response
+
+from grab import Grab
+from grab.spider import Spider, Task
+from grab.spider.dedup_backend.base import get_task_fingerprint
+from grab.spider.dedup_backend.bloom import DedupBackend as BloomDedupBackend
+from grab.spider.dedup_backend.memory import DedupBackend as MemoryDedupBackend
+from grab.spider.dedup_backend.sqlite import DedupBackend as SqliteDedupBackend
+
+from tests.util import BaseGrabTestCase, build_spider
+
+
+def fingerprint(url):
+    return get_task_fingerprint(Task("page", url=url))
+
+
+class DedupBackendTestCase(TestCase):
+    def check_backend(self, backend):
+        self.assertTrue(backend.add(fingerprint("http://example.com/1")))
+        self.assertTrue(backend.add(fingerprint("http://example.com/2")))
+        self.assertFalse(backend.add(fingerprint("http://example.com/1")))
+        self.assertEqual(2, backend.size())
+        backend.clear()
+        self.assertEqual(0, backend.size())
+        self.assertTrue(backend.add(fingerprint("http://example.com/1")))
+
+    def test_memory(self):
+        self.check_backend(MemoryDedupBackend("test"))
+
+    def test_bloom(self):
+        self.check_backend(BloomDedupBackend("test"))
+
+    def test_bloom_growth(self):
+        backend = BloomDedupBackend("test", initial_capacity=100, error_rate=0.01)
+        added = sum(
+            1
+            for x in range(1000)
+            if backend.add(fingerprint("http://example.com/%d" % x))
+        )
+        self.assertTrue(len(backend.filters) > 1)
+        # False positives are possible but rare
+        self.assertTrue(added >= 980)
+        for x in range(1000):
+            self.assertFalse(backend.add(fingerprint("http://example.com/%d" % x)))
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "dedup.sqlite")
+            backend = SqliteDedupBackend("test", path=path)
+            self.check_backend(backend)
+            backend.close()
+            # Fingerprints are kept after restart
+            backend = SqliteDedupBackend("test", path=path)
+            self.assertFalse(backend.add(fingerprint("http://example.com/1")))
+            self.assertTrue(backend.add(fingerprint("http://example.com/2")))
+            backend.close()
+
+    def test_sqlite_commit_timeout(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "dedup.sqlite")
+            backend = SqliteDedupBackend("test", path=path, commit_timeout=0)
+            backend.add(fingerprint("http://example.com/1"))
+            # Fingerprint is committed without closing the backend
+            other = SqliteDedupBackend("test", path=path)
+            self.assertEqual(1, other.size())
+            other.close()
+            backend.close()
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("http://example.com/?a=1&b=2"),
+            fingerprint("http://EXAMPLE.com/?b=2&a=1&utm_medium=x#top"),
+        )
+        post_task = Task("page", grab=Grab(url="http://example.com/", post=b"x=1"))
+        self.assertNotEqual(
+            fingerprint("http://example.com/"), get_task_fingerprint(post_task)
+        )
+
+
+class SpiderDedupTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_duplicate_tasks(self):
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url())
+                yield Task("page", url=server.get_url() + "#foo")
+                yield Task("page", url=server.get_url() + "?utm_source=bar")
+                yield Task("page", url=server.get_url(), dedup=False)
+
+            def task_page(self, unused_grab, task):
+                self.stat.inc("page")
+                # Task yielded from handler is filtered too
+                yield Task("page", url=task.url)
+
+        bot = build_spider(SimpleSpider)
+        bot.setup_dedup()
+        bot.run()
+        self.assertEqual(2, bot.stat.counters["page"])
+        self.assertEqual(4, bot.stat.counters["spider:task-duplicate"])
+
+    def test_retry_is_not_filtered(self):
+        server = self.server
+        server.add_response(Response(status=500))
+        server.add_response(Response(), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url())
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.inc("page")
+
+        bot = build_spider(SimpleSpider)
+        bot.setup_dedup(backend="bloom")
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["page"])
+        self.assertEqual(2, bot.stat.counters["spider:request"])
+        self.assertEqual(0, bot.stat.counters["spider:task-duplicate"])
@@ -0,0 +1,142 @@
+import time
+from threading import Lock
+from unittest import TestCase
+
+from test_server import Response
+
+from grab.spider import Spider, Task
+from grab.spider.host_scheduler import HostScheduler
+from grab.spider.queue_backend.memory import QueueBackend
+
+from tests.util import BaseGrabTestCase, build_spider
+
+
+def build_queue(urls):
+    queue = QueueBackend("test")
+    for priority, url in enumerate(urls):
+        queue.put(Task("page", url=url, priority=priority), priority=priority)
+    return queue
+
+
+class HostSchedulerTestCase(TestCase):
+    def test_concurrency(self):
+        queue = build_queue(
+            ["http://a.com/1", "http://a.com/2", "http://b.com/1", "http://a.com/3"]
+        )
+        sched = HostScheduler(concurrency=1)
+        task_a = sched.get_task(queue)
+        task_b = sched.get_task(queue)
+        self.assertEqual("http://a.com/1", task_a.url)
+        self.assertEqual("http://b.com/1", task_b.url)
+        self.assertEqual(None, sched.get_task(queue))
+        self.assertEqual(2, sched.size())
+        sched.release(task_a)
+        self.assertEqual("http://a.com/2", sched.get_task(queue).url)
+        self.assertEqual(None, sched.get_task(queue))
+
+    def test_delay(self):
+        queue = build_queue(["http://a.com/1", "http://a.com/2", "http://b.com/1"])
+        sched = HostScheduler(delay=0.2)
+        self.assertEqual("http://a.com/1", sched.get_task(queue).url)
+        self.assertEqual("http://b.com/1", sched.get_task(queue).url)
+        self.assertEqual(None, sched.get_task(queue))
+        self.assertTrue(0 < sched.get_wait_time() <= 0.2)
+        time.sleep(0.2)
+        self.assertEqual("http://a.com/2", sched.get_task(queue).url)
+        self.assertEqual(0, sched.size())
+
+    def test_domain_rules(self):
+        sched = HostScheduler(
+            concurrency=5, delay=1, domains={"example.com": {"concurrency": 1}}
+        )
+        self.assertEqual((1, 1), sched.get_host_rule("example.com"))
+        self.assertEqual((1, 1), sched.get_host_rule("www.example.com"))
+        self.assertEqual((5, 1), sched.get_host_rule("example.org"))
+
+    def test_host_buffer_size(self):
+        queue = build_queue(["http://a.com/%d" % x for x in range(5)])
+        queue.put(Task("page", url="http://b.com/", priority=10), priority=10)
+        sched = HostScheduler(concurrency=1, host_buffer_size=2, pull_batch_size=10)
+        self.assertEqual("http://a.com/0", sched.get_task(queue).url)
+        # Tasks of the host which has full buffer are returned
+        # to the queue as delayed tasks
+        self.assertEqual(3, sched.deferred)
+        self.assertEqual(2, sched.size())
+        self.assertEqual(3, len(queue.schedule_list))
+        self.assertEqual("http://b.com/", sched.get_task(queue).url)
+
+
+class SpiderHostSchedulerTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_host_concurrency(self):
+        server = self.server
+        lock = Lock()
+        state = {"active": 0, "max_active": 0}
+
+        def callback():
+            with lock:
+                state["active"] += 1
+                state["max_active"] = max(state["max_active"], state["active"])
+            time.sleep(0.1)
+            with lock:
+                state["active"] -= 1
+            return {"type": "response", "data": b"ok"}
+
+        server.add_response(Response(callback=callback), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                for _ in range(6):
+                    yield Task("page", url=server.get_url())
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.inc("page")
+
+        bot = build_spider(SimpleSpider, thread_number=5)
+        bot.setup_host_scheduler(concurrency=2)
+        bot.run()
+        self.assertEqual(6, bot.stat.counters["page"])
+        self.assertEqual(2, state["max_active"])
+
+    def test_host_delay(self):
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                for _ in range(3):
+                    yield Task("page", url=server.get_url())
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.collect("time", time.time())
+
+        bot = build_spider(SimpleSpider, thread_number=3)
+        bot.setup_host_scheduler(delay=0.3)
+        bot.run()
+        times = sorted(bot.stat.collections["time"])
+        self.assertEqual(3, len(times))
+        self.assertTrue(times[1] - times[0] >= 0.25)
+        self.assertTrue(times[2] - times[1] >= 0.25)
+
+    def test_buffered_task_lease(self):
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                for _ in range(2):
+                    yield Task("page", url=server.get_url())
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.inc("page")
+
+        bot = build_spider(SimpleSpider, thread_number=2)
+        bot.setup_queue(backend="memory", visibility_timeout=1)
+        bot.setup_host_scheduler(delay=1.5)
+        bot.run()
+        # The second task waits in the buffer longer than the visibility
+        # timeout, its lease is extended and it is not processed again
+        self.assertEqual(2, bot.stat.counters["page"])
+        self.assertEqual(2, bot.stat.counters["spider:request-network"])
@@ -1,3 +1,5 @@
+import time
+
 from test_server import Response
 
 from grab.spider import Spider, Task
@@ -31,3 +33,46 @@ class MiscTest(BaseGrabTestCase):
         bot = build_spider(SimpleSpider, thread_number=1)
         bot.run()
         self.assertEqual(2, bot.stat.counters["page_count"])
+
+    def test_task_chain_latency(self):
+        # Each task is created by the handler of previous task,
+        # services must pass it without waiting for polling timeouts
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url(), num=0)
+
+            def task_page(self, unused_grab, task):
+                self.stat.inc("page")
+                if task.num < 20:
+                    yield Task("page", url=server.get_url(), num=task.num + 1)
+
+        bot = build_spider(SimpleSpider, thread_number=2)
+        started = time.time()
+        bot.run()
+        self.assertEqual(21, bot.stat.counters["page"])
+        self.assertTrue(time.time() - started < 2)
+
+    def test_delayed_task_latency(self):
+        # Network workers wake up when the delayed task becomes ready
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url(), num=0)
+
+            def task_page(self, unused_grab, task):
+                self.stat.inc("page")
+                if task.num < 3:
+                    yield Task(
+                        "page", url=server.get_url(), num=task.num + 1, delay=0.2
+                    )
+
+        bot = build_spider(SimpleSpider, thread_number=1)
+        started = time.time()
+        bot.run()
+        self.assertEqual(4, bot.stat.counters["page"])
+        self.assertTrue(time.time() - started < 1.5)
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from unittest import mock
+
+from test_server import Response
+
+from grab import Grab
+from grab.spider import Spider, Task
+from grab.spider.service.network import NetworkServiceAsync, NetworkServiceThreaded
+
+from tests.util import BaseGrabTestCase, build_spider, skip_test_if
+
+
+class NetworkServiceTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_network_service_option(self):
+        bot = build_spider(Spider, network_service="threaded")
+        self.assertTrue(isinstance(bot.network_service, NetworkServiceThreaded))
+        bot = build_spider(Spider, network_service="async")
+        self.assertTrue(isinstance(bot.network_service, NetworkServiceAsync))
+        self.assertEqual(
+            1,
+            len(
+                list(
+                    bot.network_service.iterate_workers(
+                        bot.network_service.worker_registry
+                    )
+                )
+            ),
+        )
+
+    def test_async_service(self):
+        server = self.server
+        server.add_response(Response(data=b"foo"), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                for _ in range(50):
+                    yield Task("page", url=server.get_url())
+
+            def task_page(self, grab, unused_task):
+                self.stat.collect("body", grab.doc.body)
+
+        bot = build_spider(SimpleSpider, network_service="async", thread_number=20)
+        bot.run()
+        self.assertEqual([b"foo"] * 50, bot.stat.collections["body"])
+
+    @skip_test_if(
+        lambda: not hasattr(asyncio.BaseEventLoop, "shutdown_default_executor"),
+        "Python 3.9+ is required",
+    )
+    def test_async_service_loop_shutdown(self):
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url())
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.inc("page")
+
+        bot = build_spider(SimpleSpider, network_service="async")
+        with mock.patch.object(
+            asyncio.BaseEventLoop,
+            "shutdown_default_executor",
+            autospec=True,
+            side_effect=asyncio.BaseEventLoop.shutdown_default_executor,
+        ) as shutdown:
+            bot.run()
+        self.assertEqual(1, bot.stat.counters["page"])
+        # Thread of the default executor which resolved the host name
+        # is joined before the event loop is closed
+        self.assertEqual(1, shutdown.call_count)
+
+    def test_async_service_concurrency(self):
+        server = self.server
+        server.add_response(Response(sleep=0.5), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                for _ in range(10):
+                    yield Task("page", url=server.get_url())
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.inc("page")
+
+        bot = build_spider(SimpleSpider, network_service="async", thread_number=10)
+        started = time.time()
+        bot.run()
+        self.assertEqual(10, bot.stat.counters["page"])
+        # Requests are sent concurrently by one thread
+        self.assertTrue(time.time() - started < 5)
+
+    def test_async_service_network_error(self):
+        server = self.server
+        server.add_response(Response(sleep=2), count=-1)
+
+        class SimpleSpider(Spider):
+            def prepare(self):
+                self.network_try_limit = 1
+
+            def task_generator(self):
+                grab = Grab(url=server.get_url(), timeout=1)
+                yield Task("page", grab=grab)
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.inc("page")
+
+        bot = build_spider(SimpleSpider, network_service="async")
+        bot.run()
+        self.assertTrue("error:read-timeout-error" in bot.stat.counters)
+        self.assertFalse("page" in bot.stat.counters)
@@ -0,0 +1,142 @@
+import os
+
+from test_server import Response
+
+from grab.spider import Spider, Task
+from grab.spider.service.parser import (
+    ParserService,
+    ParserServiceProcess,
+    SharedBodyBuffer,
+    SharedBodyReader,
+)
+
+from tests.util import BaseGrabTestCase, build_spider
+
+
+class ParserServiceProcessTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_parser_service_option(self):
+        bot = build_spider(Spider)
+        self.assertEqual(ParserService, type(bot.parser_service))
+        bot = build_spider(Spider, parser_service="process")
+        self.assertTrue(isinstance(bot.parser_service, ParserServiceProcess))
+
+    def test_handler_runs_in_process(self):
+        server = self.server
+        server.add_response(Response(data=b"<h1>foo</h1>" * 10000))
+        main_pid = os.getpid()
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url())
+
+            def task_page(self, grab, unused_task):
+                self.stat.collect("pid", os.getpid())
+                self.stat.collect("ppid", os.getppid())
+                self.stat.collect("text", grab.doc("//h1").text())
+                self.stat.inc("body-size", len(grab.doc.body))
+
+        bot = build_spider(SimpleSpider, parser_service="process")
+        bot.run()
+        self.assertNotEqual([main_pid], bot.stat.collections["pid"])
+        # Parser processes are forked by the fork server
+        self.assertNotEqual([main_pid], bot.stat.collections["ppid"])
+        self.assertIsNone(bot.parser_service.fork_server.proc)
+        self.assertEqual(["foo"], bot.stat.collections["text"])
+        self.assertEqual(len(b"<h1>foo</h1>") * 10000, bot.stat.counters["body-size"])
+
+    def test_handler_tasks(self):
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url())
+
+            def task_page(self, grab, unused_task):
+                yield Task("yielded", url=server.get_url())
+                self.add_task(Task("added", grab=grab))
+
+            def task_yielded(self, unused_grab, unused_task):
+                self.stat.inc("yielded")
+
+            def task_added(self, unused_grab, unused_task):
+                self.stat.inc("added")
+
+        bot = build_spider(SimpleSpider, parser_service="process")
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["yielded"])
+        self.assertEqual(1, bot.stat.counters["added"])
+
+    def test_handler_error(self):
+        server = self.server
+        server.add_response(Response())
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url())
+
+            def task_page(self, unused_grab, unused_task):
+                1 / 0  # pylint: disable=pointless-statement
+
+        bot = build_spider(SimpleSpider, parser_service="process")
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["spider:error-zerodivisionerror"])
+
+    def test_process_recycled(self):
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                for _ in range(4):
+                    yield Task("page", url=server.get_url())
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.collect("pid", os.getpid())
+
+        bot = build_spider(
+            SimpleSpider,
+            parser_service="process",
+            parser_requests_per_process=2,
+            thread_number=1,
+        )
+        bot.run()
+        self.assertEqual(4, len(bot.stat.collections["pid"]))
+        self.assertEqual(2, len(set(bot.stat.collections["pid"])))
+        self.assertEqual(2, bot.stat.counters["parser:handler-req-limit"])
+
+    def test_process_died(self):
+        server = self.server
+        server.add_response(Response())
+
+        class SimpleSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url())
+
+            def task_page(self, unused_grab, unused_task):
+                os._exit(1)  # pylint: disable=protected-access
+
+        bot = build_spider(SimpleSpider, parser_service="process")
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["parser:process-died"])
+        self.assertEqual(1, bot.stat.counters["spider:error-parserprocesserror"])
+
+    def test_shared_body_buffer(self):
+        buf = SharedBodyBuffer()
+        reader = SharedBodyReader()
+        try:
+            name = buf.write(b"foo")
+            self.assertEqual(b"foo", reader.read(name, 3))
+            self.assertEqual(name, buf.write(b"bar"))
+            self.assertEqual(b"ba", reader.read(name, 2))
+            body = b"x" * 100000
+            name2 = buf.write(body)
+            self.assertNotEqual(name, name2)
+            self.assertEqual(131072, buf.shm.size)
+            self.assertEqual(body, reader.read(name2, len(body)))
+        finally:
+            reader.close()
+            buf.close()
@@ -0,0 +1,106 @@
+import os
+import pickle
+import time
+from unittest import TestCase
+
+from test_server import Response
+
+from grab.spider import Spider, Task
+from grab.spider.decorators import integrity
+from grab.spider.profiler import HandlerProfiler, ProfileSnapshot
+
+from tests.util import BaseGrabTestCase, build_spider, temp_dir
+
+
+class ProfiledSpider(Spider):
+    def check_page(self, grab):
+        assert grab.doc.code == 200
+
+    @integrity("check_page")
+    def task_page(self, grab, task):
+        sum(range(1000))
+
+
+class HandlerProfilerTestCase(TestCase):
+    def test_measure(self):
+        profiler = HandlerProfiler()
+        for _ in range(3):
+            with profiler.measure("task_page"):
+                sum(range(1000))
+        stats = profiler.handlers["task_page"]
+        self.assertEqual(3, stats.calls)
+        self.assertTrue(0 < stats.max_wall_time <= stats.wall_time)
+        self.assertEqual([], stats.snapshots)
+
+    def test_iterate_call(self):
+        def handler(num):
+            for item in range(num):
+                yield item
+
+        profiler = HandlerProfiler(profile_rate=1)
+        items = []
+        for item in profiler.iterate_call("task_page", handler, 3):
+            # Processing of yielded items is not measured
+            time.sleep(0.1)
+            items.append(item)
+        self.assertEqual([0, 1, 2], items)
+        stats = profiler.handlers["task_page"]
+        self.assertEqual(1, stats.calls)
+        self.assertTrue(stats.wall_time < 0.1)
+        self.assertEqual(1, len(stats.snapshots))
+        self.assertEqual([], list(profiler.iterate_call("task_page", lambda: None)))
+        self.assertEqual(2, stats.calls)
+
+    def test_slowest_snapshots(self):
+        profiler = HandlerProfiler(snapshot_number=2)
+        for wall_time in (3, 1, 4, 2):
+            profiler.add_call("task_page", wall_time, 0, ProfileSnapshot(wall_time, {}))
+        stats = profiler.handlers["task_page"]
+        self.assertEqual([3, 4], sorted(x[2].wall_time for x in stats.snapshots))
+        other = pickle.loads(pickle.dumps(profiler))
+        other.add_call("task_page", 5, 1, ProfileSnapshot(5, {}))
+        profiler.merge(other)
+        self.assertEqual(9, stats.calls)
+        self.assertEqual(25, stats.wall_time)
+        self.assertEqual(5, stats.max_wall_time)
+        self.assertEqual([4, 5], sorted(x[2].wall_time for x in stats.snapshots))
+
+    def test_report_logging(self):
+        profiler = HandlerProfiler(profile_rate=1)
+        with profiler.measure("task_page"):
+            sum(range(1000))
+        with self.assertLogs("grab.spider.profiler", "INFO") as logs:
+            profiler.write_report()
+        self.assertIn(
+            "Profile of 1 slowest profiled calls of task_page", logs.output[0]
+        )
+
+
+class SpiderProfilerTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def run_spider(self, **kwargs):
+        self.server.add_response(Response(), count=3)
+        bot = build_spider(ProfiledSpider, **kwargs)
+        bot.setup_queue()
+        with temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, "report.txt")
+            bot.setup_handler_profiling(profile_rate=1, snapshot_number=2, path=path)
+            for num in range(3):
+                bot.add_task(Task("page", url=self.server.get_url("/%d" % num)))
+            bot.run()
+            with open(path, encoding="utf-8") as inp:
+                report = inp.read()
+        handlers = bot.handler_profiler.handlers
+        self.assertEqual(3, handlers["task_page"].calls)
+        self.assertEqual(3, handlers["integrity:check_page"].calls)
+        self.assertEqual(2, len(handlers["task_page"].snapshots))
+        self.assertIn("Profile of 2 slowest profiled calls of task_page", report)
+        self.assertIn("integrity:check_page", report)
+
+    def test_thread_parser(self):
+        self.run_spider()
+
+    def test_process_parser(self):
+        self.run_spider(parser_service="process")
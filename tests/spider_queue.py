@@ -1,13 +1,27 @@
+import os
+import pickle
+import tempfile
 import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from queue import Empty
 from typing import Any
 from unittest import TestCase
 
+from grab import Grab
 from grab.spider import Spider, Task
-from grab.spider.error import SpiderMisuseError
-from grab.spider.queue_backend.base import QueueInterface
+from grab.spider.error import SpiderError, SpiderMisuseError
+from grab.spider.queue_backend.base import QueueInterface, pack_task, unpack_task
+from grab.spider.queue_backend.codec import TaskCodec
 from test_server import Response
 from test_settings import MONGODB_CONNECTION, REDIS_CONNECTION
-from tests.util import BaseGrabTestCase, build_spider
+from tests.util import (
+    BaseGrabTestCase,
+    build_spider,
+    is_module_available,
+    skip_test_if,
+)
 
 
 class SpiderQueueMixin:
@@ -97,6 +111,70 @@ class SpiderMemoryQueueTestCase(BaseGrabTestCase, SpiderQueueMixin):
         bot.run()
         self.assertEqual(bot.stat.collections["numbers"], [1, 3, 4, 2])
 
+    def test_lease(self):
+        bot = build_spider(self.SimpleSpider)
+        bot.setup_queue(backend="memory", visibility_timeout=0.5)
+        for num in range(2):
+            bot.task_queue.put(
+                Task("page", url="http://example.com/%d" % num), priority=num
+            )
+        task = bot.task_queue.get()
+        bot.task_queue.ack(task.lease)
+        self.assertEqual("http://example.com/1", bot.task_queue.get().url)
+        self.assertRaises(Empty, bot.task_queue.get)
+        time.sleep(0.6)
+        # Lease has expired, the task is processed again
+        task = bot.task_queue.get()
+        self.assertEqual("http://example.com/1", task.url)
+        bot.task_queue.ack(task.lease)
+        time.sleep(0.6)
+        self.assertRaises(Empty, bot.task_queue.get)
+
+    def test_slow_handler_lease(self):
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class TestSpider(Spider):
+            def task_page(self, unused_grab, unused_task):
+                self.stat.inc("page")
+                time.sleep(2.5)
+
+        bot = build_spider(TestSpider)
+        bot.setup_queue(backend="memory", visibility_timeout=1)
+        bot.add_task(Task("page", url=server.get_url()))
+        bot.run()
+        # Lease of the task is extended while its handler runs
+        self.assertEqual(1, bot.stat.counters["page"])
+        self.assertEqual(1, bot.stat.counters["spider:request-network"])
+
+    def test_spider_acks_tasks(self):
+        server = self.server
+        server.add_response(Response(), count=3)
+        server.add_response(Response(status=500), count=-1)
+
+        class TestSpider(Spider):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.final_leases = None
+
+            def task_generator(self):
+                for num in range(3):
+                    yield Task("page", url=server.get_url(), num=num)
+
+            def task_page(self, unused_grab, task):
+                if task.num == 0:
+                    yield task.clone(num=1)
+                elif task.num == 1:
+                    raise Exception("Handler error")
+
+            def shutdown(self):
+                self.final_leases = len(self.task_queue.leases)
+
+        bot = build_spider(TestSpider, network_try_limit=2)
+        bot.setup_queue(backend="memory")
+        bot.run()
+        self.assertEqual(0, bot.final_leases)
+
     def test_schedule_list_clear(self):
         bot = build_spider(self.SimpleSpider)
         self.setup_queue(bot)
@@ -109,6 +187,35 @@ class SpiderMemoryQueueTestCase(BaseGrabTestCase, SpiderQueueMixin):
         bot.task_queue.clear()
         self.assertEqual(0, len(bot.task_queue.schedule_list))
 
+    def test_schedule_order(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        now = datetime.utcnow()
+        # Tasks with same schedule time should not be compared
+        for num in (3, 1, 2, 1):
+            bot.task_queue.put(
+                Task("page", url="http://example.com/", num=num),
+                priority=10,
+                schedule_time=now - timedelta(seconds=10 - num),
+            )
+        bot.task_queue.put(
+            Task("page", url="http://example.com/", num=100),
+            priority=10,
+            schedule_time=now + timedelta(seconds=100),
+        )
+        self.assertEqual(5, bot.task_queue.size())
+        self.assertEqual(
+            now - timedelta(seconds=9), bot.task_queue.get_next_schedule_time()
+        )
+        self.assertEqual(
+            [1, 1, 2, 3], sorted(bot.task_queue.get().num for _ in range(4))
+        )
+        self.assertRaises(Empty, bot.task_queue.get)
+        self.assertEqual(1, bot.task_queue.size())
+        self.assertEqual(
+            now + timedelta(seconds=100), bot.task_queue.get_next_schedule_time()
+        )
+
 
 class BasicSpiderTestCase(SpiderQueueMixin, BaseGrabTestCase):
     backend = "mongodb"
@@ -127,9 +234,9 @@ class BasicSpiderTestCase(SpiderQueueMixin, BaseGrabTestCase):
         class TestSpider(Spider):
             def task_generator(self):
                 yield Task("page", url=server.get_url(), num=1)
-                yield Task("page", url=server.get_url(), delay=1.5, num=2)
+                yield Task("page", url=server.get_url(), delay=3.5, num=2)
                 yield Task("page", url=server.get_url(), delay=0.5, num=3)
-                yield Task("page", url=server.get_url(), delay=1, num=4)
+                yield Task("page", url=server.get_url(), delay=2, num=4)
 
             def task_page(self, unused_grab, task):
                 self.stat.collect("numbers", task.num)
@@ -138,7 +245,45 @@ class BasicSpiderTestCase(SpiderQueueMixin, BaseGrabTestCase):
         self.setup_queue(bot)
         bot.run()
         self.assertEqual(bot.stat.collections["numbers"], [1, 3, 4, 2])
-        # TODO: understand why that test fails
+
+    def test_lease(self):
+        bot = build_spider(self.SimpleSpider)
+        bot.setup_queue(backend="mongodb", lease_timeout=0.5, **MONGODB_CONNECTION)
+        bot.task_queue.clear()
+        for num in range(3):
+            bot.task_queue.put(
+                Task("page", url="http://example.com/%d" % num), priority=num
+            )
+        self.assertEqual("http://example.com/0", bot.task_queue.get().url)
+        # The spider crashes, its claimed tasks return to the queue
+        # when the lease expires
+        bot2 = build_spider(self.SimpleSpider)
+        bot2.setup_queue(backend="mongodb", **MONGODB_CONNECTION)
+        self.assertRaises(Empty, bot2.task_queue.get)
+        time.sleep(0.6)
+        self.assertEqual(
+            ["http://example.com/%d" % x for x in range(3)],
+            [bot2.task_queue.get().url for _ in range(3)],
+        )
+
+    def test_release_on_close(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+        for num in range(3):
+            bot.task_queue.put(
+                Task("page", url="http://example.com/%d" % num), priority=num
+            )
+        task = bot.task_queue.get()
+        self.assertEqual("http://example.com/0", task.url)
+        bot.task_queue.ack(task.lease)
+        # Unacknowledged task is returned to the queue too
+        self.assertEqual("http://example.com/1", bot.task_queue.get().url)
+        bot.task_queue.close()
+        bot2 = build_spider(self.SimpleSpider)
+        self.setup_queue(bot2)
+        self.assertEqual(2, bot2.task_queue.size())
+        self.assertEqual("http://example.com/1", bot2.task_queue.get().url)
 
     def test_clear_collection(self):
         bot = build_spider(self.SimpleSpider)
@@ -155,19 +300,377 @@ class SpiderRedisQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
         # data from previous tests
         bot.setup_queue(
             backend="redis",
-            queue_name=("grab_test_%d" % time.time()),
+            queue_name=("grab_test_%s" % uuid.uuid4().hex),
             **REDIS_CONNECTION
         )
 
-    def test_delay_error(self):
+    def test_schedule(self):
+        server = self.server
+        server.add_response(Response(), count=4)
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url(), num=1)
+                yield Task("page", url=server.get_url(), delay=3.5, num=2)
+                yield Task("page", url=server.get_url(), delay=0.5, num=3)
+                yield Task("page", url=server.get_url(), delay=2, num=4)
+
+            def task_page(self, unused_grab, task):
+                self.stat.collect("numbers", task.num)
+
+        bot = build_spider(TestSpider, thread_number=1)
+        self.setup_queue(bot)
+        bot.run()
+        self.assertEqual(bot.stat.collections["numbers"], [1, 3, 4, 2])
+
+    def test_same_tasks(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+        task = Task("page", url="http://example.com/", priority=1)
+        for _ in range(3):
+            bot.task_queue.put(task, priority=1)
+        self.assertEqual(3, bot.task_queue.size())
+        for _ in range(3):
+            self.assertEqual("http://example.com/", bot.task_queue.get().url)
+        self.assertRaises(Empty, bot.task_queue.get)
+
+    def test_prefetched_tasks_returned_on_close(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+        for num in range(4):
+            bot.task_queue.put(
+                Task("page", url="http://example.com/%d" % num), priority=num
+            )
+        task = bot.task_queue.get()
+        self.assertEqual("http://example.com/0", task.url)
+        bot.task_queue.ack(task.lease)
+        # Unacknowledged task is returned to the queue too
+        self.assertEqual("http://example.com/1", bot.task_queue.get().url)
+        bot.task_queue.close()
+        self.assertEqual(3, bot.task_queue.size())
+        self.assertEqual("http://example.com/1", bot.task_queue.get().url)
+
+    def test_lease(self):
         bot = build_spider(self.SimpleSpider)
         self.setup_queue(bot)
+        bot.task_queue.visibility_timeout = 0.5
         bot.task_queue.clear()
-        self.assertRaises(
-            SpiderMisuseError,
-            bot.add_task,
-            Task("page", url=self.server.get_url(), delay=1),
+        for num in range(2):
+            bot.task_queue.put(
+                Task("page", url="http://example.com/%d" % num), priority=num
+            )
+        task = bot.task_queue.get()
+        bot.task_queue.ack(task.lease)
+        self.assertEqual("http://example.com/1", bot.task_queue.get().url)
+        # Leased tasks are counted
+        self.assertEqual(1, bot.task_queue.size())
+        self.assertRaises(Empty, bot.task_queue.get)
+        time.sleep(0.6)
+        # Lease has expired, the task is processed again
+        task = bot.task_queue.get()
+        self.assertEqual("http://example.com/1", task.url)
+        bot.task_queue.ack(task.lease)
+        self.assertEqual(0, bot.task_queue.size())
+
+
+class SpiderSqliteQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "queue.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def setup_queue(self, bot):
+        bot.setup_queue(backend="sqlite", path=self.path)
+
+    def test_schedule(self):
+        server = self.server
+        server.add_response(Response(), count=4)
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url(), num=1)
+                yield Task("page", url=server.get_url(), delay=3.5, num=2)
+                yield Task("page", url=server.get_url(), delay=0.5, num=3)
+                yield Task("page", url=server.get_url(), delay=2, num=4)
+
+            def task_page(self, unused_grab, task):
+                self.stat.collect("numbers", task.num)
+
+        bot = build_spider(TestSpider, thread_number=1)
+        self.setup_queue(bot)
+        bot.run()
+        self.assertEqual(bot.stat.collections["numbers"], [1, 3, 4, 2])
+
+    def test_reopen(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        for num in range(5):
+            bot.add_task(
+                Task("page", url="http://example.com/%d" % num, priority=num + 1)
+            )
+        bot.add_task(Task("page", url="http://example.com/", delay=100))
+        bot.task_queue.ack(bot.task_queue.get().lease)
+        # Task is taken and not acknowledged
+        bot.task_queue.get()
+        bot.task_queue.close()
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        self.assertEqual(5, bot.task_queue.size())
+        delay = bot.task_queue.get_next_schedule_time() - datetime.utcnow()
+        self.assertTrue(90 < delay.total_seconds() <= 100)
+        self.assertEqual(
+            ["http://example.com/%d" % x for x in range(1, 5)],
+            sorted(bot.task_queue.get().url for _ in range(4)),
+        )
+        self.assertRaises(Empty, bot.task_queue.get)
+        bot.task_queue.close()
+
+    def test_lease(self):
+        bot = build_spider(self.SimpleSpider)
+        bot.setup_queue(
+            backend="sqlite", path=self.path, commit_timeout=0, visibility_timeout=0.5
+        )
+        for num in range(3):
+            bot.add_task(Task("page", url="http://example.com/%d" % num, priority=num))
+        task = bot.task_queue.get()
+        bot.task_queue.ack(task.lease)
+        self.assertEqual("http://example.com/1", bot.task_queue.get().url)
+        # Leased tasks are counted
+        self.assertEqual(2, bot.task_queue.size())
+        self.assertEqual("http://example.com/2", bot.task_queue.get().url)
+        self.assertRaises(Empty, bot.task_queue.get)
+        time.sleep(0.6)
+        # Leases have expired, tasks are processed again
+        task = bot.task_queue.get()
+        self.assertEqual("http://example.com/1", task.url)
+        bot.task_queue.ack(task.lease)
+        self.assertEqual(1, bot.task_queue.size())
+        self.assertEqual("http://example.com/2", bot.task_queue.get().url)
+        # The spider has crashed, leased task is restored by the next run
+        other = build_spider(self.SimpleSpider)
+        other.setup_queue(backend="sqlite", path=self.path)
+        self.assertEqual(1, other.task_queue.size())
+        self.assertEqual("http://example.com/2", other.task_queue.get().url)
+        other.task_queue.close()
+        bot.task_queue.close()
+
+    def test_resume(self):
+        server = self.server
+        server.add_response(Response(), count=-1)
+
+        class TestSpider(Spider):
+            def task_page(self, unused_grab, task):
+                self.stat.collect("numbers", task.num)
+                if task.num == 0:
+                    self.stop()
+
+        bot = build_spider(TestSpider, thread_number=1)
+        self.setup_queue(bot)
+        for num in range(5):
+            bot.add_task(Task("page", url=server.get_url(), num=num, priority=num + 1))
+        bot.run()
+        self.assertEqual(0, bot.stat.collections["numbers"][0])
+        left = bot.task_queue.size()
+        self.assertTrue(left > 0)
+        # Next run of the spider processes tasks left in the queue
+        bot = build_spider(TestSpider, thread_number=1)
+        self.setup_queue(bot)
+        bot.run()
+        self.assertEqual(0, bot.task_queue.size())
+        self.assertEqual(
+            list(range(5 - left, 5)), sorted(bot.stat.collections["numbers"])
+        )
+
+
+class SpiderTieredQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queues = []
+
+    def tearDown(self):
+        # Queues of spiders which have not been run keep temporary directories
+        for queue in self.queues:
+            queue.close()
+        super().tearDown()
+
+    def setup_queue(self, bot):
+        bot.setup_queue(backend="tiered", memory_size=2, segment_size=2, chunk_size=1)
+        self.queues.append(bot.task_queue)
+
+    def test_spill(self):
+        bot = build_spider(self.SimpleSpider)
+        bot.setup_queue(backend="tiered", memory_size=10, segment_size=8, chunk_size=3)
+        priorities = [(x * 37) % 100 for x in range(100)]
+        for priority in priorities:
+            bot.task_queue.put(
+                Task("page", url="http://example.com/", priority=priority),
+                priority=priority,
+            )
+        self.assertEqual(100, bot.task_queue.size())
+        self.assertEqual(10, len(bot.task_queue.ready.head))
+        self.assertTrue(os.listdir(bot.task_queue.path))
+        result = [bot.task_queue.get().priority for _ in range(50)]
+        # Tasks with better priority go to memory
+        for priority in (0, 1, 2):
+            bot.task_queue.put(
+                Task("page", url="http://example.com/", priority=priority),
+                priority=priority,
+            )
+        result += [bot.task_queue.get().priority for _ in range(53)]
+        self.assertEqual(sorted(priorities)[:50], result[:50])
+        self.assertEqual([0, 1, 2] + sorted(priorities)[50:], result[50:])
+        self.assertRaises(Empty, bot.task_queue.get)
+        self.assertEqual([], os.listdir(bot.task_queue.path))
+        bot.task_queue.close()
+        self.assertFalse(os.path.exists(bot.task_queue.path))
+
+    def test_spill_delayed(self):
+        bot = build_spider(self.SimpleSpider)
+        bot.setup_queue(
+            backend="tiered", delayed_memory_size=5, segment_size=4, chunk_size=2
+        )
+        now = datetime.utcnow()
+        delays = [(x * 7) % 20 for x in range(20)]
+        for delay in delays:
+            bot.task_queue.put(
+                Task("page", url="http://example.com/", num=delay),
+                priority=1,
+                schedule_time=now - timedelta(seconds=100 - delay),
+            )
+        bot.task_queue.put(
+            Task("page", url="http://example.com/", num=100),
+            priority=1,
+            schedule_time=now + timedelta(seconds=100),
+        )
+        self.assertEqual(21, bot.task_queue.size())
+        self.assertEqual(5, len(bot.task_queue.delayed.head))
+        self.assertTrue(os.listdir(bot.task_queue.path))
+        # Delayed tasks are moved to ready tasks in order of schedule time
+        self.assertEqual(list(range(20)), [bot.task_queue.get().num for _ in range(20)])
+        self.assertRaises(Empty, bot.task_queue.get)
+        self.assertEqual(1, bot.task_queue.size())
+        self.assertEqual(
+            now + timedelta(seconds=100), bot.task_queue.get_next_schedule_time()
+        )
+        bot.task_queue.close()
+
+    def test_schedule(self):
+        server = self.server
+        server.add_response(Response(), count=4)
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url(), delay=1.5, num=3)
+                yield Task("page", url=server.get_url(), delay=4.5, num=2)
+                yield Task("page", url=server.get_url(), delay=3, num=4)
+                yield Task("page", url=server.get_url(), num=1)
+
+            def task_page(self, unused_grab, task):
+                self.stat.collect("numbers", task.num)
+
+        bot = build_spider(TestSpider, thread_number=1)
+        self.setup_queue(bot)
+        bot.run()
+        self.assertEqual(bot.stat.collections["numbers"], [1, 3, 4, 2])
+
+
+class TaskPayloadTestCase(TestCase):
+    def test_pack_task(self):
+        task = Task(
+            "page",
+            grab=Grab(url="http://example.com/", timeout=3, headers={"X": "y"}),
+            priority=5,
+            num=1,
         )
+        payload = pack_task(task)
+        self.assertTrue(len(payload) < len(pickle.dumps(task)))
+        self.assertEqual(task.__getstate__(), unpack_task(payload).__getstate__())
+        task = Task("page", url="http://example.com/", delay=10)
+        self.assertEqual(
+            task.__getstate__(), unpack_task(pack_task(task)).__getstate__()
+        )
+
+
+def codec_callback(unused_grab, unused_task):
+    pass
+
+
+class TaskCodecTestCase(TestCase):
+    def build_task(self):
+        grab = Grab(url="http://example.com/", post=b"data", headers={"X": "y"})
+        grab.cookies.set("name", "value", domain="example.com")
+        return Task(
+            "page",
+            grab=grab,
+            priority=5,
+            valid_status=(503,),
+            callback=codec_callback,
+            delay=10,
+            num=1,
+            data={1: "one", "$key": b"\x00"},
+        )
+
+    def assert_task_equal(self, task, task2):
+        self.assertEqual(self.get_task_state(task), self.get_task_state(task2))
+
+    def get_task_state(self, task):
+        # Cookie objects do not support comparison
+        state = task.__getstate__()
+        config = dict(state["grab_config_diff"])
+        cookies = config["state"]["cookiejar_cookies"]
+        config["state"] = {"cookiejar_cookies": [x.__dict__ for x in cookies]}
+        state["grab_config_diff"] = config
+        return state
+
+    def test_encode_decode(self):
+        codec = TaskCodec()
+        task = self.build_task()
+        payload = codec.encode(task)
+        self.assertNotIn(b"cookiejar", payload)
+        self.assert_task_equal(task, codec.decode(payload))
+        task = Task("page", url="http://example.com/")
+        payload = codec.encode(task)
+        self.assertTrue(len(payload) < 50)
+        self.assertEqual(task.__getstate__(), codec.decode(payload).__getstate__())
+
+    def test_no_compression(self):
+        codec = TaskCodec(compression=None)
+        task = self.build_task()
+        payload = codec.encode(task)
+        self.assertIn(b"cookiejar", payload)
+        self.assert_task_equal(task, codec.decode(payload))
+        # Any codec decodes payloads of other codecs
+        self.assert_task_equal(task, TaskCodec().decode(payload))
+
+    @skip_test_if(lambda: not is_module_available("msgpack"), "msgpack")
+    def test_msgpack(self):
+        codec = TaskCodec(serializer="msgpack")
+        task = self.build_task()
+        self.assert_task_equal(task, codec.decode(codec.encode(task)))
+
+    @skip_test_if(lambda: not is_module_available("zstandard"), "zstandard")
+    def test_zstd(self):
+        codec = TaskCodec(compression="zstd")
+        task = self.build_task()
+        self.assert_task_equal(task, codec.decode(codec.encode(task)))
+
+    def test_legacy_payload(self):
+        task = Task("page", url="http://example.com/", num=1)
+        self.assertEqual(
+            task.__getstate__(),
+            TaskCodec().decode(pickle.dumps(task)).__getstate__(),
+        )
+
+    def test_invalid_options(self):
+        self.assertRaises(SpiderMisuseError, TaskCodec, serializer="foo")
+        self.assertRaises(SpiderMisuseError, TaskCodec, compression="foo")
+        self.assertRaises(SpiderError, TaskCodec().decode, b"\x09\x01\x00{}")
 
 
 class QueueInterfaceTestCase(TestCase):
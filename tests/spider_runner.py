@@ -0,0 +1,177 @@
+import os
+from unittest import TestCase
+
+from test_server import Response
+
+from grab.spider import FatalError, Spider, SpiderError, SpiderMisuseError, Task
+from grab.spider.runner import SpiderRunner, get_task_partition
+from tests.util import BaseGrabTestCase, build_spider, temp_dir
+
+
+class TaskPartitionTestCase(TestCase):
+    def test_same_host(self):
+        for url in ("http://example.com/", "http://example.com:8080/path?x=1"):
+            self.assertEqual(
+                get_task_partition(Task(url="http://EXAMPLE.com/foo"), 4),
+                get_task_partition(Task(url=url), 4),
+            )
+
+    def test_range(self):
+        partitions = {
+            get_task_partition(Task(url="http://host%d.com/" % num), 3)
+            for num in range(100)
+        }
+        self.assertEqual({0, 1, 2}, partitions)
+
+
+class SpiderRunnerTestCase(BaseGrabTestCase):
+    def get_urls(self):
+        # Both hosts are served by the test server
+        url = self.server.get_url()
+        return [url, url.replace("127.0.0.1", "localhost")]
+
+    def test_run(self):
+        urls = self.get_urls()
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for num in range(10):
+                    yield Task("page", url=urls[num % 2] + "?num=%d" % num, num=num)
+
+            def task_page(self, unused_grab, task):
+                self.stat.collect("pid", os.getpid())
+                self.stat.collect("num", task.num)
+                if task.num < 10:
+                    # Next task goes to the other host
+                    yield Task(
+                        "page",
+                        url=urls[(task.num + 1) % 2] + "?num=%d" % (task.num + 10),
+                        num=task.num + 10,
+                    )
+
+            def shutdown(self):
+                self.stat.inc("shutdown")
+
+        self.server.add_response(Response(), count=-1)
+        bot = build_spider(TestSpider, thread_number=2)
+        bot.setup_queue()
+        SpiderRunner(bot, process_number=2).run()
+        self.assertEqual(list(range(20)), sorted(bot.stat.collections["num"]))
+        self.assertEqual(2, bot.stat.counters["shutdown"])
+        self.assertEqual(20, bot.stat.counters["spider:request"])
+        self.assertEqual(20, bot.stat.histograms["latency:network"].count)
+        self.assertEqual(15, bot.stat.counters["spider:task-forwarded"])
+        self.assertNotIn(os.getpid(), bot.stat.collections["pid"])
+        self.assertEqual(2, len(set(bot.stat.collections["pid"])))
+        self.assertNotIn("parser:worker-restarted", bot.stat.counters)
+
+    def test_initial_tasks(self):
+        urls = self.get_urls()
+
+        class TestSpider(Spider):
+            def task_page(self, unused_grab, task):
+                self.stat.collect("num", task.num)
+
+        self.server.add_response(Response(), count=-1)
+        bot = build_spider(TestSpider)
+        bot.setup_queue()
+        for num in range(6):
+            bot.add_task(Task("page", url=urls[num % 2], num=num))
+        bot.add_task(Task("page", url=urls[0], num=6, delay=0.5))
+        SpiderRunner(bot, process_number=3).run()
+        self.assertEqual(list(range(7)), sorted(bot.stat.collections["num"]))
+        self.assertEqual(0, bot.task_queue.size())
+
+    def test_dedup(self):
+        url = self.get_urls()[0]
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for _ in range(3):
+                    yield Task("page", url=url)
+
+            def task_page(self, unused_grab, unused_task):
+                self.stat.inc("page")
+
+        self.server.add_response(Response(), count=-1)
+        bot = build_spider(TestSpider)
+        bot.setup_dedup()
+        SpiderRunner(bot, process_number=2).run()
+        self.assertEqual(1, bot.stat.counters["page"])
+        self.assertEqual(2, bot.stat.counters["spider:task-duplicate"])
+
+    def test_fatal_error(self):
+        urls = self.get_urls()
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for num in range(100):
+                    yield Task("page", url=urls[num % 2] + "?num=%d" % num, num=num)
+
+            def task_page(self, unused_grab, task):
+                if task.num == 1:
+                    raise FatalError("Stop the crawl")
+                self.stat.inc("page")
+
+            def shutdown(self):
+                self.stat.inc("shutdown")
+
+        self.server.add_response(Response(), count=-1)
+        bot = build_spider(TestSpider, thread_number=1)
+        runner = SpiderRunner(bot, process_number=2)
+        self.assertRaises(SpiderError, runner.run)
+        self.assertTrue(bot.stat.counters["page"] < 99)
+        self.assertEqual(2, bot.stat.counters["shutdown"])
+
+    def test_stop(self):
+        urls = self.get_urls()
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for num in range(100):
+                    yield Task("page", url=urls[num % 2] + "?num=%d" % num, num=num)
+
+            def task_page(self, unused_grab, task):
+                self.stat.inc("page")
+                if task.num == 1:
+                    self.stop()
+
+        self.server.add_response(Response(), count=-1)
+        bot = build_spider(TestSpider, thread_number=1)
+        SpiderRunner(bot, process_number=2).run()
+        self.assertTrue(bot.stat.counters["page"] < 100)
+
+    def test_file_queue(self):
+        urls = self.get_urls()
+
+        class TestSpider(Spider):
+            def prepare(self):
+                if self.task_queue is None:
+                    self.setup_queue(
+                        backend="tiered",
+                        memory_size=5,
+                        segment_size=5,
+                        chunk_size=2,
+                        path=path,
+                    )
+
+            def task_generator(self):
+                for num in range(60):
+                    yield Task("page", url=urls[num % 2] + "?num=%d" % num, num=num)
+
+            def task_page(self, unused_grab, task):
+                self.stat.collect("num", task.num)
+
+        self.server.add_response(Response(), count=-1)
+        with temp_dir() as path:
+            bot = build_spider(TestSpider)
+            bot.setup_queue(backend="tiered", memory_size=5, path=path)
+            bot.add_task(Task("page", url=urls[0], num=0))
+            # Tasks in files could not be copied to worker processes
+            self.assertRaises(SpiderMisuseError, SpiderRunner(bot).run)
+            bot.task_queue.close()
+
+            bot = build_spider(TestSpider, thread_number=1)
+            SpiderRunner(bot, process_number=2).run()
+            self.assertEqual(list(range(60)), sorted(bot.stat.collections["num"]))
+            self.assertEqual([], os.listdir(path))
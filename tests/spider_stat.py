@@ -1,3 +1,5 @@
+import time
+
 from test_server import Response
 
 from grab.spider import Spider, Task
@@ -53,3 +55,30 @@ class BasicSpiderTestCase(BaseGrabTestCase):
         bot.add_task(Task("page", url=self.server.get_url()))
         bot.run()
         bot.render_stats()
+
+    def test_latency_histograms(self):
+        self.server.add_response(Response(), count=2)
+
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        bot = build_spider(TestSpider)
+        bot.setup_queue()
+        bot.add_task(Task("page", url=self.server.get_url()))
+        task = Task("page", url=self.server.get_url(), delay=0.1)
+        bot.add_task(task)
+        # Delay of the task is not counted as queue wait
+        self.assertTrue(task.queue_time > time.time() + 0.05)
+        bot.run()
+        histograms = bot.stat.histograms
+        host = self.server.address
+        for metric in ("queue-wait", "network", "dispatcher", "handler"):
+            self.assertEqual(2, histograms["latency:%s" % metric].count)
+            self.assertEqual(2, histograms["latency:%s:task:page" % metric].count)
+            self.assertEqual(2, histograms["latency:%s:host:%s" % (metric, host)].count)
+        self.assertEqual(2, histograms["latency:network:proxy:none"].count)
+        self.assertNotIn("latency:queue-wait:proxy:none", histograms)
+        summary = bot.stat.export_histograms()["latency:network"]
+        self.assertTrue(0 < summary["p50"] <= summary["p99"])
+        self.assertIn("latency:handler:task:page: 2: ", bot.render_stats())
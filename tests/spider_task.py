@@ -1,3 +1,5 @@
+import pickle
+
 from grab import Grab
 from grab.error import ResponseNotValid
 from grab.spider import NoTaskHandler, Spider, SpiderMisuseError, Task, base
@@ -231,6 +233,77 @@ class TestSpiderTestCase(BaseGrabTestCase):
         self.assertEqual(2, task2.foo)  # pylint: disable=no-member
         # pytype: enable=attribute-error
 
+    def test_task_clone_copies_config(self):
+        grab = build_grab()
+        grab.setup(url="http://foo.com/", headers={"X": "1"}, timeout=3)
+        task = Task("foo", grab=grab, foo=1, priority=5, network_try_count=2)
+        task2 = task.clone()
+        self.assertEqual(task.grab_config, task2.grab_config)
+        self.assertEqual(1, task2.get("foo"))
+        self.assertEqual(5, task2.priority)
+        self.assertEqual(0, task2.network_try_count)
+        self.assertEqual(2, task2.task_try_count)
+        task2.grab_config["headers"]["X"] = "2"
+        self.assertEqual("1", task.grab_config["headers"]["X"])
+
+    def test_task_grab_config_changes(self):
+        grab = build_grab()
+        grab.setup(url="http://foo.com/", timeout=3)
+        task = Task("foo", grab=grab)
+        task.grab_config["timeout"] = 5
+        self.assertEqual(5, task.grab_config["timeout"])
+        self.assertEqual(5, task.clone().grab_config["timeout"])
+        task2 = pickle.loads(pickle.dumps(task))
+        self.assertEqual(5, task2.grab_config["timeout"])
+        task2.grab_config["timeout"] = 7
+        self.assertEqual(7, task2.__getstate__()["grab_config_diff"]["timeout"])
+        self.assertEqual(
+            "http://bar.com/", task.clone(url="http://bar.com/").grab_config["url"]
+        )
+
+    def test_task_compact_layout(self):
+        task = Task("foo", url="http://foo.com/")
+        self.assertFalse(hasattr(Task, "coroutines_stack"))
+        self.assertFalse(hasattr(task, "__dict__"))
+        self.assertIsNone(task.clone().custom_attrs)
+        self.assertEqual({"foo": 1}, task.clone(foo=1).custom_attrs)
+        grab = build_grab()
+        grab.setup(url="http://foo.com/", timeout=3)
+        task = Task("foo", grab=grab)
+        diff = task.__getstate__()["grab_config_diff"]
+        self.assertEqual(3, diff["timeout"])
+        self.assertNotIn("url", diff)
+        self.assertNotIn("proxy", diff)
+        self.assertEqual("http://foo.com/", task.grab_config["url"])
+        self.assertEqual(grab.dump_config(), task.grab_config)
+
+    def test_task_custom_attr_assignment(self):
+        task = Task("foo", url="http://foo.com/")
+        task.foo = 1
+        task.priority = 5
+        self.assertEqual({"foo": 1}, task.custom_attrs)
+        self.assertEqual(5, task.priority)
+        self.assertEqual(1, task.foo)
+        self.assertEqual(1, task.clone().foo)
+        self.assertEqual(1, pickle.loads(pickle.dumps(task)).foo)
+        self.assertFalse(hasattr(task, "__dict__"))
+
+    def test_task_grab_config_diff(self):
+        grab = build_grab()
+        grab.setup(url="http://foo.com/", timeout=3)
+        task = Task("foo", grab=grab)
+        # Queued task keeps only the diff of grab config
+        self.assertEqual(3, task.grab_config_diff["timeout"])
+        self.assertEqual(3, task.clone().grab_config["timeout"])
+
+    def test_task_pickle(self):
+        grab = build_grab()
+        grab.setup(url="http://foo.com/", timeout=3)
+        task = Task("foo", grab=grab, foo=1, delay=1)
+        task2 = pickle.loads(pickle.dumps(task))
+        self.assertEqual(task.__getstate__(), task2.__getstate__())
+        self.assertEqual(1, task2.get("foo"))
+
     def test_task_comparison(self):
         task1 = Task("foo", url="http://foo.com/", priority=1)
         task2 = Task("foo", url="http://foo.com/", priority=2)
@@ -0,0 +1,141 @@
+import json
+import os
+import pickle
+from unittest import mock
+
+from test_server import Response
+
+from grab.error import ResponseNotValid
+from grab.spider import Spider, SpiderMisuseError, Task
+from grab.spider.decorators import integrity
+from grab.spider.queue_backend.codec import TaskCodec
+from grab.spider.tracing import NOT_SAMPLED, Tracer
+
+from tests.util import BaseGrabTestCase, build_spider, temp_dir
+
+
+class SimpleSpider(Spider):
+    def task_page(self, grab, task):
+        pass
+
+
+class SpiderTracingTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_spans(self):
+        spans = []
+        self.server.add_response(Response())
+        bot = build_spider(SimpleSpider)
+        bot.setup_queue()
+        bot.setup_tracing(sink=spans.append)
+        task = Task("page", url=self.server.get_url())
+        bot.add_task(task)
+        bot.run()
+        self.assertEqual(
+            ["add_task", "queue", "request", "dispatch", "parser_queue", "handler"],
+            [x["span"] for x in spans],
+        )
+        self.assertEqual({task.trace_id}, {x["trace_id"] for x in spans})
+        self.assertTrue(all(x["start"] <= x["end"] for x in spans))
+        self.assertEqual(200, spans[2]["attrs"]["code"])
+        self.assertEqual("task_page", spans[5]["attrs"]["handler"])
+
+    def test_retry_continues_trace(self):
+        spans = []
+
+        class TestSpider(Spider):
+            def check_page(self, grab):
+                if grab.doc.body == b"bad":
+                    raise ResponseNotValid
+
+            @integrity("check_page")
+            def task_page(self, grab, task):
+                pass
+
+        self.server.add_response(Response(data=b"bad"))
+        self.server.add_response(Response(data=b"good"))
+        bot = build_spider(TestSpider)
+        bot.setup_queue()
+        bot.setup_tracing(sink=spans.append)
+        bot.add_task(Task("page", url=self.server.get_url()))
+        bot.run()
+        self.assertEqual(1, len({x["trace_id"] for x in spans}))
+        names = [x["span"] for x in spans]
+        self.assertEqual(2, names.count("request"))
+        self.assertEqual(2, names.count("handler"))
+        retry = [x for x in spans if x["span"] == "add_task"][-1]
+        self.assertEqual(2, retry["attrs"]["task_try"])
+
+    def test_retry_not_sampled(self):
+        spans = []
+
+        class TestSpider(Spider):
+            def check_page(self, grab):
+                if grab.doc.body == b"bad":
+                    raise ResponseNotValid
+
+            @integrity("check_page")
+            def task_page(self, grab, task):
+                self.stat.inc("page")
+
+        self.server.add_response(Response(data=b"bad"))
+        self.server.add_response(Response(data=b"good"))
+        bot = build_spider(TestSpider)
+        bot.setup_queue()
+        bot.setup_tracing(sample_rate=0.5, sink=spans.append)
+        # The retry would be sampled if sampling was repeated
+        with mock.patch("random.random", side_effect=[0.9, 0.1]):
+            bot.add_task(Task("page", url=self.server.get_url()))
+            bot.run()
+        self.assertEqual(1, bot.stat.counters["page"])
+        self.assertEqual([], spans)
+
+    def test_jsonl_file(self):
+        self.server.add_response(Response(), count=2)
+        with temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, "spans.jsonl")
+            bot = build_spider(SimpleSpider)
+            bot.setup_queue()
+            bot.setup_tracing(path=path)
+            bot.add_task(Task("page", url=self.server.get_url("/1")))
+            bot.add_task(Task("page", url=self.server.get_url("/2")))
+            bot.run()
+            with open(path, encoding="utf-8") as inp:
+                spans = [json.loads(x) for x in inp]
+        self.assertEqual(12, len(spans))
+        self.assertEqual(2, len({x["trace_id"] for x in spans}))
+
+    def test_sampling(self):
+        spans = []
+        self.server.add_response(Response(), count=10)
+        bot = build_spider(SimpleSpider)
+        bot.setup_queue()
+        bot.setup_tracing(sample_rate=0, sink=spans.append)
+        for num in range(10):
+            bot.add_task(Task("page", url=self.server.get_url("/%d" % num)))
+        bot.run()
+        self.assertEqual([], spans)
+        self.assertEqual(10, bot.stat.counters["spider:task-page"])
+
+    def test_invalid_options(self):
+        self.assertRaises(SpiderMisuseError, Tracer)
+        self.assertRaises(SpiderMisuseError, Tracer, sample_rate=2, sink=print)
+
+    def test_task_trace(self):
+        task = Task("page", url="http://example.com/")
+        Tracer(sink=print).start_trace(task)
+        self.assertEqual(32, len(task.trace_id))
+        self.assertEqual(task.trace_id, task.clone().trace_id)
+        self.assertIsNone(task.clone(url="http://example.com/2").trace_id)
+        for restored in (
+            pickle.loads(pickle.dumps(task)),
+            TaskCodec().decode(TaskCodec().encode(task)),
+        ):
+            self.assertEqual(task.trace_id, restored.trace_id)
+        task = Task("page", url="http://example.com/")
+        Tracer(sample_rate=0, sink=print).start_trace(task)
+        self.assertEqual(NOT_SAMPLED, task.trace_id)
+        self.assertEqual(
+            NOT_SAMPLED, TaskCodec().decode(TaskCodec().encode(task)).trace_id
+        )
@@ -1,4 +1,4 @@
-from grab.util.http import normalize_url
+from grab.util.http import canonicalize_url, normalize_url
 from tests.util import BaseGrabTestCase
 
 
@@ -10,3 +10,21 @@ class GrabApiTestCase(BaseGrabTestCase):
         url = b"http://\xa0http://localhost:7777/"
         with self.assertRaises(UnicodeDecodeError):
             normalize_url(url)
+
+    def test_canonicalize_url(self):
+        self.assertEqual(
+            "http://example.com/a?a=1&b=2",
+            canonicalize_url("HTTP://Example.COM:80/a?b=2&a=1#top"),
+        )
+        self.assertEqual(
+            "https://example.com:8443/?x=1",
+            canonicalize_url("https://example.com:8443?x=1&utm_source=y&gclid=z"),
+        )
+        self.assertEqual(
+            "http://example.com/?gclid=z&x=1",
+            canonicalize_url("http://example.com/?x=1&gclid=z", tracking_params=None),
+        )
+        self.assertEqual(
+            "http://example.com/?x=1",
+            canonicalize_url("http://example.com/?x=1&sid=2", tracking_params={"sid"}),
+        )
@@ -1,3 +1,4 @@
+import importlib.util
 import itertools
 import logging
 import os
@@ -96,5 +97,9 @@ def skip_test_if(condition, why_message):
     return decorator
 
 
+def is_module_available(name):
+    return importlib.util.find_spec(name) is not None
+
+
 def reset_request_counter():
     base.REQUEST_COUNTER = itertools.count(1)